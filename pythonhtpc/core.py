@@ -6,18 +6,27 @@
 # =============================================================================
 """"""
 
-from pebble import thread
-from apscheduler.scheduler import Scheduler
+# RPC errors and futures are also available from here
+from pythonhtpc.utils.futures import RPCError, RPCTimeoutError, RPCFuture
+from pythonhtpc.utils.dispatcher import get_dispatcher, Coalescer, PASSTHROUGH
+from pythonhtpc.utils.scheduler import get_scheduler
+
+# Execution modes of EventHandler callbacks
+INLINE = 'inline'
+THREAD = 'thread'
+PROCESS = 'process'
 
 class HTPCObject(object):
     """Base object for HTPClib.
 
-    Provides basic notification capabilities.
+    Provides basic notification capabilities. Notifications are delivered
+    by a NotificationDispatcher, by default the one shared by the whole process.
 
     """
-    def __init__(self, name):
+    def __init__(self, name, dispatcher=None):
         super(HTPCObject, self).__init__()
         self.name = name
+        self._dispatcher = dispatcher
         # Notifications are {name: config} pairs (config can be None)
         self._published_notifications = []
         # Subscribed are {name: [list of callbacks]} pairs
@@ -49,22 +58,49 @@ class HTPCObject(object):
     def get_notification_info(self, notification):
         raise NotImplementedError("I don't know how to give you information")
 
-    def add_notification_subscription(self, name, callback):
+    def add_notification_subscription(self, name, callback, mode=PASSTHROUGH, window=0.1):
+        """Subscribe callback to the given notification.
+
+        The callback is called as callback(sender, value). With mode 'latest'
+        or 'batch', notifications arriving within window seconds of the first
+        one are coalesced and the callback gets either only the latest value
+        or the list of values.
+
+        @return: name of the notification, None if it's not published
+
+        """
         if not name in self._published_notifications:
             return None
         if not name in self._subscribed_notifications:
             self._subscribed_notifications[name] = []
+        if mode != PASSTHROUGH:
+            callback = Coalescer(callback, mode, window)
         self._subscribed_notifications[name].append(callback)
         return name
 
-    @thread
+    def _process_notification(self, notification, value):
+        """Prepare the value of a notification before delivering it."""
+        return value
+
     def notify(self, notification, value):
         if not (notification in self._subscribed_notifications):
             # Nobody is subscribed
             return None
         self.logger.debug("Sending notification %s with value %s" % (notification, value))
+        dispatcher = self._dispatcher or get_dispatcher()
+        callbacks = []
         for callback in self._subscribed_notifications[notification]:
-            callback(self, value)
+            if isinstance(callback, Coalescer):
+                callback.push(dispatcher, self, notification, value)
+            else:
+                callbacks.append(callback)
+        if callbacks:
+            try:
+                value = self._process_notification(notification, value)
+            except:
+                self.logger.exception("Problem processing notification %s with value %s:" % (notification, value))
+                return None
+            dispatcher.dispatch(self, notification, callbacks, value)
 
 class RPCServer(HTPCObject):
     # Server is notifications + possibility to execute methods
@@ -100,6 +136,9 @@ class RPCServer(HTPCObject):
             regex = re.compile(pattern)
             return [m.group(0) for m in [regex.match(method) for method in self._methods] if m]
 
+    def _has_method(self, method):
+        return method in self._methods
+
     def get_method_info(self, method):
         self.logger.critical("I don't know how to give you information yet")
         raise NotImplementedError("I don't know how to give you information yet")
@@ -108,7 +147,7 @@ class RPCServer(HTPCObject):
         if params is None:
             params = {}
         self.logger.debug("Executing method %s with parameters %s" % (method, params))
-        if not method in self._methods:
+        if not self._has_method(method):
             self.logger.error("Unknown method %s" % method)
             return None
         return self._execute_method(method, params, wait_for_response)
@@ -117,8 +156,170 @@ class RPCServer(HTPCObject):
         self.logger.critical("I don't know how to execute methods")
         raise NotImplementedError("I don't know how to execute methods")
 
+    def execute_method_async(self, method, params=None, timeout=None):
+        """Execute method without waiting for its result.
+
+        @arg  timeout: time (in s) after which the request fails
+        @type timeout: float
+
+        @return: RPCFuture
+
+        """
+        if params is None:
+            params = {}
+        self.logger.debug("Executing method %s asynchronously with parameters %s" % (method, params))
+        if not self._has_method(method):
+            self.logger.error("Unknown method %s" % method)
+            future = RPCFuture(timeout=timeout)
+            future.set_exception(RPCError("Unknown method %s" % method))
+            return future
+        return self._execute_method_async(method, params, timeout)
+
+    def _execute_method_async(self, method, params, timeout):
+        # Fallback: execute synchronously
+        future = RPCFuture(timeout=timeout)
+        result = self._execute_method(method, params, True)
+        if result is None:
+            future.set_exception(RPCError("Error executing method %s" % method))
+        else:
+            future.set_result(result)
+        return future
+
+    def execute_batch(self, calls, timeout=None):
+        """Execute several methods in one go.
+
+        @arg  calls: (method, params) pairs, params can be None
+        @type calls: list
+        @arg  timeout: maximum time (in s) to wait for the answers, None for
+            the request timeout of the server
+        @type timeout: float
+
+        @return: list of results in the same order as calls, with RPCError
+            instances for the entries that failed
+
+        """
+        results = [None] * len(calls)
+        to_execute = []
+        for index, (method, params) in enumerate(calls):
+            if params is None:
+                params = {}
+            if not self._has_method(method):
+                self.logger.error("Unknown method %s" % method)
+                results[index] = RPCError("Unknown method %s" % method)
+            else:
+                to_execute.append((index, method, params))
+        if not to_execute:
+            return results
+        self.logger.debug("Executing batch of %s methods" % len(to_execute))
+        batch_results = self._execute_batch([(call_method, call_params) for _, call_method, call_params in to_execute],
+                                            timeout)
+        for (index, _, _), result in zip(to_execute, batch_results):
+            results[index] = result
+        return results
+
+    def execute_batch_async(self, calls, timeout=None):
+        """Execute several methods in one go without waiting for their results.
+
+        @arg  calls: (method, params) pairs, params can be None
+        @type calls: list
+        @arg  timeout: time (in s) after which the requests fail
+        @type timeout: float
+
+        @return: list of RPCFuture in the same order as calls
+
+        """
+        futures = [None] * len(calls)
+        to_execute = []
+        for index, (method, params) in enumerate(calls):
+            if params is None:
+                params = {}
+            if not self._has_method(method):
+                self.logger.error("Unknown method %s" % method)
+                futures[index] = RPCFuture(timeout=timeout)
+                futures[index].set_exception(RPCError("Unknown method %s" % method))
+            else:
+                to_execute.append((index, method, params))
+        if not to_execute:
+            return futures
+        self.logger.debug("Executing batch of %s methods asynchronously" % len(to_execute))
+        batch_futures = self._execute_batch_async([(call_method, call_params) for _, call_method, call_params in to_execute],
+                                                  timeout)
+        for (index, _, _), future in zip(to_execute, batch_futures):
+            futures[index] = future
+        return futures
+
+    def _execute_batch_async(self, calls, timeout):
+        # Fallback: one request per call
+        return [self._execute_method_async(method, params, timeout) for method, params in calls]
+
+    def _execute_batch(self, calls, timeout):
+        # Fallback: one request per call
+        results = []
+        for method, params in calls:
+            result = self._execute_method(method, params, True)
+            if result is None:
+                result = RPCError("Error executing method %s" % method)
+            results.append(result)
+        return results
+
+class SenderInfo(object):
+    """Picklable stand-in for the sender of a notification.
+
+    Callbacks running in a worker process get it instead of the sender,
+    which can't be sent there. It has the name of the sender and the name
+    of its class.
+
+    """
+    def __init__(self, sender):
+        self.name = sender.name
+        self.type = type(sender).__name__
+
+    def __repr__(self):
+        return '%s(%s %r)' % (self.__class__.__name__, self.type, self.name)
+
+class _OffloadedCallback(object):
+    """Callback run in a pool instead of the dispatcher thread.
+
+    Callbacks are called as callback(sender, value) in every mode, but in
+    PROCESS mode the sender is a SenderInfo.
+
+    """
+    def __init__(self, handler, callback, mode):
+        from pythonhtpc.utils.pool import get_process_pool
+        if mode not in (THREAD, PROCESS):
+            raise ValueError("Unknown execution mode %s" % mode)
+        self.handler = handler
+        self.callback = callback
+        self.mode = mode
+        if mode == PROCESS:
+            # Known before the workers are forked, so they don't need to be replaced
+            get_process_pool().register(callback)
+
+    def __call__(self, sender, value):
+        from pythonhtpc.utils.pool import get_thread_pool, get_process_pool
+        if self.mode == THREAD:
+            future = get_thread_pool().submit(self.callback, sender, value)
+        else:
+            future = get_process_pool().submit(self.callback, SenderInfo(sender), value)
+        future.add_done_callback(self._check)
+
+    def _check(self, future):
+        exception = future.exception()
+        if exception is not None:
+            self.handler.logger.error("Error in %s callback %s: %r" % (self.mode, future.request_id, exception))
+
 class EventHandler(HTPCObject):
-    # {RPC type: {notification: callback}}
+    """Object reacting to notifications of RPCs.
+
+    Callbacks run inline (in the thread delivering the notification), unless
+    they are registered as (callback, mode) pairs: THREAD runs them in a
+    shared pool of threads, and PROCESS in a shared pool of worker processes,
+    for CPU-heavy callbacks (see ProcessPool), where they get a SenderInfo as
+    sender. A crash in a worker process only loses the notification being
+    handled.
+
+    """
+    # {RPC type: {notification: callback or (callback, mode)}}
     _notifications_to_register = {}
     # List
     _notifications_to_publish = []
@@ -126,6 +327,8 @@ class EventHandler(HTPCObject):
         super(EventHandler, self).__init__(name)
         # {RPC name: RPC object} pairs
         self._connected_rpcs = {}
+        # {(callback, mode): wrapped callback}, so it's wrapped once for all RPCs
+        self._offloaded_callbacks = {}
         for rpc in rpcs:
             self._registered_notifications = self.connect_to_rpc(rpc)
         self._subscribed_notifications = {}
@@ -133,6 +336,16 @@ class EventHandler(HTPCObject):
         for notification in self._notifications_to_publish:
             self._published_notifications.append(notification)
 
+    def _get_callback(self, callback):
+        if not isinstance(callback, tuple):
+            return callback
+        callback, mode = callback
+        if mode == INLINE:
+            return callback
+        if (callback, mode) not in self._offloaded_callbacks:
+            self._offloaded_callbacks[(callback, mode)] = _OffloadedCallback(self, callback, mode)
+        return self._offloaded_callbacks[(callback, mode)]
+
     def connect_to_rpc(self, rpc_object):
         # Connect
         rpc_name = rpc_object.name
@@ -146,7 +359,7 @@ class EventHandler(HTPCObject):
         notifications = self._notifications_to_register.get(rpc_type, dict())
         registered_notifications = 0
         for notification_name, callback in notifications.items():
-            if rpc_object.add_notification_subscription(notification_name, callback):
+            if rpc_object.add_notification_subscription(notification_name, self._get_callback(callback)):
                 registered_notifications += 1
         return registered_notifications
 
@@ -159,23 +372,71 @@ class EventHandler(HTPCObject):
         pass
 
 class CronJob(HTPCObject):
+    """Object whose run method is executed on a schedule.
+
+    Jobs are scheduled in a JobScheduler, by default the one shared by the
+    whole process, when they are started. By default a run is skipped if the
+    previous one is still going.
+
+    """
     # List
     _notifications_to_publish = []
-    def __init__(self, name, schedule):
+    def __init__(self, name, schedule, max_instances=1, coalesce=True,
+                 misfire_grace_time=None, jitter=0, scheduler=None):
+        """Configure the job.
+
+        @arg  schedule: (day, hour, minute) cron fields
+        @type schedule: tuple
+        @arg  max_instances: maximum number of runs at the same time
+        @type max_instances: int
+        @arg  coalesce: run only once when several runs were missed?
+        @type coalesce: bool
+        @arg  misfire_grace_time: time (in s) after the scheduled time a run
+            is still allowed to start, None for the scheduler default
+        @type misfire_grace_time: int
+        @arg  jitter: maximum random start offset (in s) of the runs
+        @type jitter: int
+        @arg  scheduler: scheduler to use instead of the shared one
+        @type scheduler: JobScheduler
+
+        """
         super(CronJob, self).__init__(name)
-        # Configure scheduler
-        self.scheduler = Scheduler(schedule)
-        day, hour, minute = schedule
-        self.scheduler.add_cron_job(self.run, day=day, hour=hour, minute=minute)
+        self.schedule = schedule
+        self.scheduler = scheduler
+        self._job_options = {'max_instances': max_instances,
+                             'coalesce': coalesce,
+                             'misfire_grace_time': misfire_grace_time,
+                             'jitter': jitter}
+        self._job = None
         # Initialize notifications to offer
         for notification in self._notifications_to_publish:
             self._published_notifications.append(notification)
 
     def start(self):
-        self.scheduler.start()
+        if self._job is not None:
+            return self
+        if self.scheduler is None:
+            self.scheduler = get_scheduler()
+        day, hour, minute = self.schedule
+        self._job = self.scheduler.add_cron_job(self.name, self.run, day=day, hour=hour, minute=minute,
+                                                **self._job_options)
+        return self
 
     def stop(self):
-        self.scheduler.shutdown()
+        if self._job is None:
+            return
+        self.scheduler.remove_job(self._job)
+        self._job = None
+
+    def stats(self):
+        """Report runs, errors, missed runs, durations and lateness of the job.
+
+        @return: dict, None if the job is not scheduled
+
+        """
+        if self._job is None:
+            return None
+        return self._job.func.stats()
 
     def run(self):
         raise NotImplementedError("I don't know how to run the cron job!")
@@ -4,11 +4,23 @@
 # @author Albert Puig (albert.puig@epfl.ch)
 # @date   02.04.2014
 # =============================================================================
-"""Monitor system."""
+"""Monitor system.
+
+Monitors give instant values. SamplingEngine runs them periodically, keeping
+their history in RingBuffers and checking threshold rules on it.
+SystemCollector reads all the system metrics from /proc and /sys in one pass.
+
+"""
+import os
 import re
+import glob
+import time
+import heapq
+import threading
 
-from pythonhtpc.core import CronJob
-from pythonhtpc.utils.system import run_command
+from pythonhtpc.core import CronJob, HTPCObject
+from pythonhtpc.utils.system import run_command, CommandError
+from pythonhtpc.utils.containers import RingBuffer
 
 class Monitor(object):
     """Generic monitoring class."""
@@ -18,28 +30,464 @@ class Monitor(object):
     def monitor(self):
         return self._monitor_func()
 
+class _FileReader(object):
+    """Keep a file open and read it whole from the start on each read."""
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def read(self, size=65536):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDONLY)
+        chunks = []
+        offset = 0
+        while True:
+            if hasattr(os, 'pread'):
+                chunk = os.pread(self._fd, size, offset)
+            else:
+                os.lseek(self._fd, offset, os.SEEK_SET)
+                chunk = os.read(self._fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class SystemCollector(object):
+    """Collect system metrics from /proc and /sys in one pass.
+
+    Files are kept open between collections. Counters (CPU times, disk and
+    network I/O) are turned into rates using the previous collection, so the
+    first collection only gives instant values. The GPU temperature needs to
+    run vcgencmd, so it's only refreshed every gpu_interval seconds.
+
+    Metrics are returned as a flat dictionary:
+      * cpu_load, cpu<N>_load: busy fraction of the CPU time, between 0 and 1.
+      * cpu<N>_freq: current frequency (in MHz).
+      * mem_total, mem_free, mem_available, mem_buffers, mem_cached, swap_total,
+        swap_free: memory (in kB).
+      * disk_<device>_read_bytes, disk_<device>_write_bytes: disk I/O rates (in B/s).
+      * net_<interface>_rx_bytes, net_<interface>_tx_bytes: network rates (in B/s).
+      * cpu_temp, gpu_temp: temperatures (in C), when available.
+
+    """
+    _meminfo_keys = {'MemTotal': 'mem_total', 'MemFree': 'mem_free', 'MemAvailable': 'mem_available',
+                     'Buffers': 'mem_buffers', 'Cached': 'mem_cached',
+                     'SwapTotal': 'swap_total', 'SwapFree': 'swap_free'}
+    _gpu_regex = re.compile(r'temp=([0-9\.]+)')
+
+    def __init__(self, root='/', vcgencmd='/opt/vc/bin/vcgencmd', gpu_interval=30):
+        """Find the files to read.
+
+        @arg  root: root of the filesystem where /proc and /sys are looked for
+        @type root: str
+        @arg  vcgencmd: command giving the GPU temperature, None to disable it
+        @type vcgencmd: str
+        @arg  gpu_interval: minimum time (in s) between runs of vcgencmd
+        @type gpu_interval: float
+
+        """
+        self.root = root
+        self._readers = {}
+        for name, path in (('stat', 'proc/stat'), ('meminfo', 'proc/meminfo'),
+                           ('diskstats', 'proc/diskstats'), ('net', 'proc/net/dev'),
+                           ('cpu_temp', 'sys/class/thermal/thermal_zone0/temp')):
+            path = os.path.join(root, path)
+            if os.path.exists(path):
+                self._readers[name] = _FileReader(path)
+        self._freq_readers = {}
+        for path in glob.glob(os.path.join(root, 'sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq')):
+            cpu = path.split(os.sep)[-3]
+            self._freq_readers[cpu] = _FileReader(path)
+        self._vcgencmd = vcgencmd if vcgencmd and os.path.exists(vcgencmd) else None
+        self._gpu_interval = gpu_interval
+        self._gpu_temp = None
+        self._gpu_time = None
+        # Separate from _lock, since collect calls get_gpu_temp
+        self._gpu_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._last_time = None
+        self._last_metrics = {}
+
+    def close(self):
+        """Close the open files."""
+        for reader in self._readers.values() + self._freq_readers.values():
+            reader.close()
+
+    def collect(self, max_age=None):
+        """Read all the metrics.
+
+        @arg  max_age: if the last collection is younger than max_age seconds,
+            return it instead of collecting again
+        @type max_age: float
+
+        @return: dict of metrics
+
+        """
+        with self._lock:
+            now = time.time()
+            if max_age is not None and self._last_time is not None and now - self._last_time < max_age:
+                return self._last_metrics
+            metrics = {}
+            counters = {}
+            for name, parse in (('stat', self._parse_stat), ('meminfo', self._parse_meminfo),
+                                ('diskstats', self._parse_diskstats), ('net', self._parse_net),
+                                ('cpu_temp', self._parse_cpu_temp)):
+                reader = self._readers.get(name)
+                if reader is None:
+                    continue
+                try:
+                    parse(reader.read(), metrics, counters)
+                except (OSError, ValueError, IndexError):
+                    reader.close()
+            for cpu, reader in self._freq_readers.items():
+                try:
+                    metrics['%s_freq' % cpu] = int(reader.read()) / 1000.0
+                except (OSError, ValueError):
+                    reader.close()
+            gpu_temp = self.get_gpu_temp(now)
+            if gpu_temp is not None:
+                metrics['gpu_temp'] = gpu_temp
+            self._compute_rates(now, counters, metrics)
+            self._counters, self._last_time, self._last_metrics = counters, now, metrics
+            return metrics
+
+    def _compute_rates(self, now, counters, metrics):
+        if self._last_time is None:
+            return
+        elapsed = now - self._last_time
+        for key, value in counters.items():
+            previous = self._counters.get(key)
+            if previous is None:
+                continue
+            if key.endswith('_times'):
+                # CPU times: (busy, total)
+                busy, total = value[0] - previous[0], value[1] - previous[1]
+                metrics[key[:-len('_times')] + '_load'] = float(busy) / total if total > 0 else 0.0
+            elif elapsed > 0 and value >= previous:
+                metrics[key] = (value - previous) / elapsed
+
+    @staticmethod
+    def _parse_stat(data, metrics, counters):
+        for line in data.splitlines():
+            if not line.startswith('cpu'):
+                continue
+            fields = line.split()
+            times = [int(field) for field in fields[1:9]]
+            # Idle time includes I/O wait
+            idle = times[3] + (times[4] if len(times) > 4 else 0)
+            counters['%s_times' % fields[0]] = (sum(times) - idle, sum(times))
+
+    def _parse_meminfo(self, data, metrics, counters):
+        for line in data.splitlines():
+            key, _, value = line.partition(':')
+            if key in self._meminfo_keys:
+                metrics[self._meminfo_keys[key]] = int(value.split()[0])
+
+    @staticmethod
+    def _parse_diskstats(data, metrics, counters):
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) < 10 or fields[2].startswith(('loop', 'ram')):
+                continue
+            # Sectors are 512 bytes
+            counters['disk_%s_read_bytes' % fields[2]] = int(fields[5]) * 512
+            counters['disk_%s_write_bytes' % fields[2]] = int(fields[9]) * 512
+
+    @staticmethod
+    def _parse_net(data, metrics, counters):
+        for line in data.splitlines()[2:]:
+            interface, _, fields = line.partition(':')
+            fields = fields.split()
+            counters['net_%s_rx_bytes' % interface.strip()] = int(fields[0])
+            counters['net_%s_tx_bytes' % interface.strip()] = int(fields[8])
+
+    @staticmethod
+    def _parse_cpu_temp(data, metrics, counters):
+        metrics['cpu_temp'] = float(data.strip()) / 1000.0
+
+    def get_gpu_temp(self, now=None):
+        """Get the GPU temperature, running vcgencmd at most every gpu_interval seconds.
+
+        Concurrent callers wait for the running vcgencmd instead of running
+        their own.
+
+        @return: temperature, None if it's not available
+
+        """
+        if self._vcgencmd is None:
+            return None
+        with self._gpu_lock:
+            now = time.time() if now is None else now
+            if self._gpu_time is None or now - self._gpu_time >= self._gpu_interval:
+                self._gpu_time = now
+                try:
+                    self._gpu_temp = float(self._gpu_regex.match(run_command(self._vcgencmd, 'measure_temp', timeout=5)[0]).group(1))
+                except (CommandError, IndexError, AttributeError):
+                    # Command failed or regex didn't match
+                    self._gpu_temp = None
+            return self._gpu_temp
+
+    def monitor(self, metric, max_age=0.5):
+        """Get a Monitor of one of the metrics.
+
+        Monitors of the same collector sampled at the same time share one
+        collection (see max_age in collect).
+
+        @arg  metric: name of the metric
+        @type metric: str
+
+        @return: Monitor
+
+        """
+        return Monitor(lambda: self.collect(max_age).get(metric))
+
+_default_collector = None
+
+def get_collector():
+    """Get the SystemCollector shared by the temperature monitors."""
+    global _default_collector
+    if _default_collector is None:
+        _default_collector = SystemCollector()
+    return _default_collector
+
 class CPUTempMonitor(Monitor):
     """Monitor CPU Temperature."""
-    def __init__(self):
+    def __init__(self, collector=None):
         super(CPUTempMonitor, self).__init__(self.__monitor)
+        self._collector = collector or get_collector()
 
     def __monitor(self):
-        with open('/sys/class/thermal/thermal_zone0/temp') as f:
-            temp = float(f.readlines()[0].strip('\n'))/1000.0
-        return temp
+        return self._collector.collect(max_age=0.5).get('cpu_temp', 0.0)
 
 class GPUTempMonitor(Monitor):
-    """Monitor GPU Temperature."""
-    def __init__(self):
+    """Monitor GPU Temperature.
+
+    vcgencmd is only run every gpu_interval seconds of the collector.
+
+    """
+    def __init__(self, collector=None):
         super(GPUTempMonitor, self).__init__(self.__monitor)
-        self._regex = re.compile('temp=([0-9\.]+)')
+        self._collector = collector or get_collector()
 
     def __monitor(self):
+        temp = self._collector.get_gpu_temp()
+        return 0.0 if temp is None else temp
+
+class ThresholdRule(object):
+    """Alarm raised when a statistic of a monitor goes over a threshold.
+
+    With hysteresis, the alarm is only cleared when the statistic goes back
+    under threshold - hysteresis (over threshold + hysteresis if below is
+    True), so values oscillating around the threshold don't flood
+    notifications.
+
+    """
+    def __init__(self, name, monitor, threshold, hysteresis=0.0, statistic='last', window=None, below=False):
+        """Configure the rule.
+
+        @arg  name: name of the rule, published as notification
+        @type name: str
+        @arg  monitor: name of the monitor to check
+        @type monitor: str
+        @arg  threshold: value that triggers the alarm
+        @type threshold: float
+        @arg  hysteresis: margin to clear the alarm
+        @type hysteresis: float
+        @arg  statistic: 'last', 'min', 'max', 'mean', 'ewma' or a function
+            called as statistic(ring_buffer, window)
+        @type statistic: str or callable
+        @arg  window: window (in s) of the statistic, None for the whole buffer
+        @type window: float
+        @arg  below: trigger when the statistic goes under threshold instead of over?
+        @type below: bool
+
+        """
+        self.name = name
+        self.monitor = monitor
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.statistic = statistic
+        self.window = window
+        self.below = below
+        self.triggered = False
+
+    def evaluate(self, buffer):
+        """Compute the statistic checked by the rule."""
+        if callable(self.statistic):
+            return self.statistic(buffer, self.window)
+        if self.statistic == 'last':
+            last = buffer.last()
+            return last[1] if last else None
+        return getattr(buffer, self.statistic)(window=self.window)
+
+    def check(self, buffer):
+        """Check the rule against the samples of its monitor.
+
+        @arg  buffer: samples of the monitor
+        @type buffer: RingBuffer
+
+        @return: 'triggered' or 'cleared' if the state changed, None otherwise, and the value
+
+        """
+        value = self.evaluate(buffer)
+        if value is None:
+            return None, value
+        sign = -1 if self.below else 1
+        if not self.triggered and sign * (value - self.threshold) > 0:
+            self.triggered = True
+            return 'triggered', value
+        if self.triggered and sign * (value - self.threshold) < -self.hysteresis:
+            self.triggered = False
+            return 'cleared', value
+        return None, value
+
+class SamplingEngine(HTPCObject):
+    """Run monitors periodically, storing their samples in ring buffers.
+
+    Each monitor has its own interval and buffer, so memory use is fixed
+    whatever the time it runs. After each sample, the rules of the monitor
+    are checked and state changes are published as the notification named
+    as the rule, with value {'monitor', 'state', 'value', 'threshold'}.
+
+    """
+    def __init__(self, name, capacity=3600):
+        """Configure the engine.
+
+        @arg  capacity: default number of samples kept per monitor
+        @type capacity: int
+
+        """
+        super(SamplingEngine, self).__init__(name)
+        self._capacity = capacity
+        self._monitors = {}
+        self.buffers = {}
+        self._rules = {}
+        self._schedule = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def add_monitor(self, name, monitor, interval, capacity=None):
+        """Sample monitor every interval seconds.
+
+        Adding a monitor with the name of an existing one replaces it, and
+        its samples are discarded.
+
+        @arg  name: name of the monitor
+        @type name: str
+        @arg  monitor: monitor to sample
+        @type monitor: Monitor or callable
+        @arg  interval: time (in s) between samples
+        @type interval: float
+        @arg  capacity: number of samples to keep, the default one if None
+        @type capacity: int
+
+        @return: RingBuffer with the samples
+
+        """
+        if isinstance(monitor, Monitor):
+            monitor = monitor.monitor
+        with self._cond:
+            if name in self._monitors:
+                self._schedule = [(due, scheduled) for due, scheduled in self._schedule if scheduled != name]
+                heapq.heapify(self._schedule)
+            self._monitors[name] = (monitor, interval)
+            self.buffers[name] = RingBuffer(capacity or self._capacity)
+            self._rules.setdefault(name, [])
+            heapq.heappush(self._schedule, (time.time(), name))
+            self._cond.notify()
+        return self.buffers[name]
+
+    def add_rule(self, rule):
+        """Check rule after each sample of its monitor.
+
+        @arg  rule: rule to check
+        @type rule: ThresholdRule
+
+        """
+        with self._cond:
+            self._rules.setdefault(rule.monitor, []).append(rule)
+        if not rule.name in self._published_notifications:
+            self._published_notifications.append(rule.name)
+
+    def stats(self, name, window=None, percentiles=(50, 95)):
+        """Get the statistics of a monitor.
+
+        @arg  name: name of the monitor
+        @type name: str
+        @arg  window: window (in s), None for all the samples
+        @type window: float
+
+        @return: dict with min, max, mean, ewma, the percentiles (as p50, ...) and number of samples
+
+        """
+        buffer = self.buffers[name]
+        stats = {'min': buffer.min(window),
+                 'max': buffer.max(window),
+                 'mean': buffer.mean(window),
+                 'ewma': buffer.ewma(window=window),
+                 'samples': len(buffer.samples(window)[1])}
+        for percent in percentiles:
+            stats['p%s' % percent] = buffer.percentile(percent, window)
+        return stats
+
+    def sample(self, name):
+        """Take a sample of a monitor and check its rules."""
+        monitor, _ = self._monitors[name]
         try:
-            return float(self._regex.match(run_command('/opt/vc/bin/vcgencmd', 'measure_temp')[0]).group(1))
-        except:
-            # Regex didn't match
-            return 0.0
+            value = float(monitor())
+        except Exception:
+            self.logger.exception("Error sampling %s" % name)
+            return
+        buffer = self.buffers[name]
+        buffer.append(value)
+        for rule in self._rules.get(name, []):
+            state, value = rule.check(buffer)
+            if state:
+                self.notify(rule.name, {'monitor': name, 'state': state, 'value': value, 'threshold': rule.threshold})
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='htpc-%s' % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    if not self._schedule:
+                        self._cond.wait()
+                        continue
+                    delay = self._schedule[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if not self._running:
+                    return
+                due, name = heapq.heappop(self._schedule)
+                interval = self._monitors[name][1]
+                # Keep the cadence, but don't try to catch up on missed samples
+                heapq.heappush(self._schedule, (max(due + interval, time.time()), name))
+            self.sample(name)
 
 if __name__ == '__main__':
     _fmt = "%30s = %.1f"
@@ -6,109 +6,532 @@
 # =============================================================================
 """"""
 import os
+import re
+import time
+import collections
+import zlib
+import hashlib
+import urlparse
+import tempfile
 from datetime import datetime
 from lxml import etree
 import urllib2, socket
 
 from pythonhtpc.core import CronJob
-from pythonhtpc.utils.containers import TimedDict
-import pythonhtpc.utils.picklefile as picklefile
+from pythonhtpc.utils.pool import ThreadPool, KeyedLimiter
+from pythonhtpc.utils.sqlitedict import SQLiteStore, is_sqlite_file, migrate_pickle
+
+def not_720p(title, link):
+    """Default quality filter of ShowRSS: skip 720p releases."""
+    return not ('720p' in title.lower() or '720p' in link.lower())
+
+_parsed_dates = {}
+
+def parse_date(date_string, date_format='%a, %d %b %Y %H:%M:%S +0000'):
+    """Parse the pubDate of a feed item, caching the result.
+
+    Aggregated feeds repeat the same dates a lot, and strptime is slow.
+
+    @arg  date_string: date to parse
+    @type date_string: str
+    @arg  date_format: strptime format of the date
+    @type date_format: str
+
+    @return: datetime
+
+    """
+    key = (date_string, date_format)
+    date = _parsed_dates.get(key)
+    if date is None:
+        if len(_parsed_dates) > 4096:
+            _parsed_dates.clear()
+        date = _parsed_dates[key] = datetime.strptime(date_string, date_format)
+    return date
+
+_EPISODE_PATTERNS = [re.compile(r'^(?P<show>.+?)[\s._-]+S(?P<season>\d{1,2})[\s._-]?E(?P<episode>\d{1,3})\b', re.I),
+                     re.compile(r'^(?P<show>.+?)[\s._-]+(?P<season>\d{1,2})x(?P<episode>\d{2,3})\b', re.I),
+                     re.compile(r'^(?P<show>.+?)[\s._-]+(?P<year>(19|20)\d\d)[\s._-](?P<month>\d\d)[\s._-](?P<day>\d\d)\b')]
+_NOT_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+def episode_key(title):
+    """Get a key identifying the episode of a release title.
+
+    Titles like 'Show.Name.S01E02.720p.HDTV', 'Show Name 1x02 [PROPER]' or
+    'Show Name 2014 03 01 HDTV' (for daily shows) give the same key for the
+    same episode, whatever the release tags.
+
+    @arg  title: release title
+    @type title: str
+
+    @return: tuple (show, season, episode) or (show, air date), None if the
+        title is not understood
+
+    """
+    for pattern in _EPISODE_PATTERNS:
+        match = pattern.search(title)
+        if match:
+            show = _NOT_ALPHANUMERIC.sub(' ', match.group('show').lower()).strip()
+            groups = match.groupdict()
+            if 'season' in groups:
+                return show, int(groups['season']), int(groups['episode'])
+            return show, '%s-%s-%s' % (groups['year'], groups['month'], groups['day'])
+    return None
+
+class QualityPolicy(object):
+    """Preference between releases of the same episode.
+
+    Releases are ranked by the first of the preferred patterns they match
+    (earlier is better, not matching any is worst), and then PROPER and
+    REPACK releases are preferred if proper_first is True.
+
+    """
+    _proper = re.compile(r'\b(PROPER|REPACK)\b', re.I)
+
+    def __init__(self, preferred=(), proper_first=True):
+        """Configure the policy.
+
+        @arg  preferred: regex patterns of the releases, from most to least preferred
+        @type preferred: list
+        @arg  proper_first: prefer PROPER/REPACK releases?
+        @type proper_first: bool
+
+        """
+        self.preferred = [re.compile(pattern, re.I) for pattern in preferred]
+        self.proper_first = proper_first
+
+    def rank(self, title):
+        """Rank a release title, lower is better.
+
+        @return: tuple
+
+        """
+        preference = len(self.preferred)
+        for index, regex in enumerate(self.preferred):
+            if regex.search(title):
+                preference = index
+                break
+        proper = 0 if self.proper_first and self._proper.search(title) else 1
+        return preference, proper
+
+def _to_str(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return str(text)
 
 class ShowRSS(CronJob):
     _notifications_to_publish = ['torrent_found']
-    def __init__(self, name, feed_list, cache_file, schedule):
-        super(ShowRSS, self).__init__(name, schedule)
+    def __init__(self, name, feed_list, cache_file, schedule,
+                 workers=8, connections_per_host=2, run_timeout=300, retries=2, retry_backoff=5,
+                 item_filter=not_720p, download_workers=2, quality_policy=None, **job_options):
+        """Configure the job.
+
+        Feeds are fetched in parallel by a pool of workers, with at most
+        connections_per_host of them talking to the same host. Failed feeds
+        are retried with exponential backoff, and feeds not fetched within
+        run_timeout seconds of the start of the run are skipped (downloads
+        still going on at the deadline are aborted). Once all
+        feeds are fetched, the new torrents are handled (act_on_torrent) by a
+        separate pool of download_workers.
+
+        Releases of the same episode (see episode_key) are only downloaded once:
+        among those found in a run, the best one according to quality_policy
+        is chosen, and episodes already downloaded are skipped.
+
+        @arg  feed_list: feed addresses
+        @type feed_list: list
+        @arg  cache_file: file storing the downloaded episodes
+        @type cache_file: str
+        @arg  schedule: (day, hour, minute) of the runs
+        @type schedule: tuple
+        @arg  workers: number of feeds fetched at the same time
+        @type workers: int
+        @arg  connections_per_host: maximum number of feeds fetched from the same host at the same time
+        @type connections_per_host: int
+        @arg  run_timeout: maximum time (in s) to fetch all the feeds
+        @type run_timeout: float
+        @arg  retries: number of retries of a failed feed
+        @type retries: int
+        @arg  retry_backoff: wait (in s) before the first retry, doubled on each retry
+        @type retry_backoff: float
+        @arg  item_filter: function called as item_filter(title, link) that returns
+            False for the items to skip
+        @type item_filter: callable
+        @arg  download_workers: number of torrents handled at the same time
+        @type download_workers: int
+        @arg  quality_policy: preference between releases of the same episode
+        @type quality_policy: QualityPolicy
+
+        The rest of keyword arguments (max_instances, jitter...) configure the
+        scheduling of the runs, see CronJob.
+
+        """
+        super(ShowRSS, self).__init__(name, schedule, **job_options)
         # Open cache
         if isinstance(feed_list, str):
             feed_list = [feed_list]
         cache_file = os.path.expanduser(cache_file)
-        if os.path.exists(cache_file):
-            cache = picklefile.load(cache_file)
-        else:
-            cache = TimedDict(3*7*24*3600) # Keys last for a week
-        self.cache = cache
+        if os.path.exists(cache_file) and not is_sqlite_file(cache_file):
+            # Old pickled cache
+            migrate_pickle(cache_file, cache_file).close()
+        # All the tables of the cache share one connection
+        self.store = SQLiteStore(cache_file)
+        self.cache = self.store.timed_dict(3*7*24*3600) # Keys last for three weeks
         self.cache_file = cache_file
+        # Validators, content hash and parsed info of each feed
+        self.feed_cache = self.store.timed_dict(3*7*24*3600, table='feeds')
+        # Bytes downloaded, parse time and outcome of the last fetch of each feed
+        self.feed_stats = {}
         # Feeds
         self.feed_list = feed_list
+        self._pool = ThreadPool(workers, name='%s.feeds' % name)
+        self._host_limiter = KeyedLimiter(connections_per_host)
+        self._download_pool = ThreadPool(download_workers, name='%s.downloads' % name)
+        self.run_timeout = run_timeout
+        # Fetches of the last run
+        self._fetches = []
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.item_filter = item_filter
+        self.quality_policy = quality_policy or QualityPolicy()
+        # Episode key -> title of the downloaded episodes, looked up by key
+        self.episodes = self.store.timed_dict(3*7*24*3600, table='episodes')
+        if not len(self.episodes) and len(self.cache):
+            # Cache from before the episodes table existed: index it once
+            self.episodes.update_many((episode_key(episode) or episode, episode, expiration)
+                                      for episode, _, expiration in self.cache.items_with_expiration())
 
     def run(self):
-        for feed in self.feed_list:
-            feed_info = self.get_info(feed)
+        running = len([future for future in self._fetches if not future.done()])
+        if running:
+            # Fetches stop soon after their deadline, so this only happens
+            # when runs are closer than the time a fetch can overrun it
+            self.logger.warning("Skipping run, %s fetches of the previous run are still going on" % running)
+            return
+        deadline = time.time() + self.run_timeout
+        # Episode key -> (rank, release), keeping the order they are found in
+        candidates = collections.OrderedDict()
+        futures = self._fetches = [self._pool.submit(self.fetch_feed, feed, deadline) for feed in self.feed_list]
+        # Process the feeds in the configured order, whatever the order they arrive in
+        for feed, future in zip(self.feed_list, futures):
+            if not future.wait(max(deadline - time.time(), 0)):
+                self.logger.error("Run deadline reached before fetching %s" % feed)
+                continue
+            if future.exception() is not None:
+                self.logger.error("Error fetching %s: %s" % (feed, future.exception()))
+                continue
+            feed_info = future.result()
+            if feed_info is None:
+                continue
             for episode, episode_date, torrent_file in feed_info:
                 #print episode
                 if (datetime.today() - episode_date).days > 3*7: # Too old!
                     continue
                 if episode in self.cache: # Already downloaded
                     continue
-                self.notify('torrent_found', {'episode': episode, 'torrent_file': torrent_file})
-                sc = self.act_on_torrent(torrent_file)
-                if not sc:
-                    self.logger.error("Problems downloading %s" % episode)
-                else:
-                    self.cache.add(episode, episode_date)
+                key = episode_key(episode) or episode
+                if self._is_downloaded(key): # Another release already downloaded
+                    continue
+                rank = self.quality_policy.rank(episode)
+                if key not in candidates or rank < candidates[key][0]:
+                    candidates[key] = (rank, (episode, episode_date, torrent_file))
+        # Download
+        downloads = []
+        for _, (episode, episode_date, torrent_file) in candidates.values():
+            self.notify('torrent_found', {'episode': episode, 'torrent_file': torrent_file})
+            downloads.append(self._download_pool.submit(self._download_torrent, episode, episode_date, torrent_file))
+        for future in downloads:
+            future.wait()
         self.cache.delete_expired()
-        picklefile.write(self.cache_file, self.cache)
+        self.episodes.delete_expired()
+        fetched = [self.feed_stats[feed] for feed in self.feed_list if feed in self.feed_stats]
+        self.logger.info("Fetched %s feeds: %s bytes downloaded, %.3f s parsing" % (len(fetched),
+                                                                                 sum(stats['bytes'] for stats in fetched),
+                                                                                 sum(stats['parse_time'] for stats in fetched)))
+
+    def _is_downloaded(self, key):
+        episode = self.episodes.get(key, refresh=False)
+        if episode is None:
+            return False
+        # The release may have expired from the cache before its key
+        return self.cache.has_key(episode)
 
-    def get_info(self, feed):
+    def _download_torrent(self, episode, episode_date, torrent_file):
+        # Run in the download pool, so the cache is updated as soon as each torrent is handled
+        try:
+            sc = self.act_on_torrent(torrent_file)
+        except Exception:
+            self.logger.exception("Problems downloading %s" % episode)
+            return
+        if not sc:
+            self.logger.error("Problems downloading %s" % episode)
+        else:
+            self.cache.add(episode, episode_date)
+            self.episodes.add(episode_key(episode) or episode, episode)
+
+    def fetch_feed(self, feed, deadline):
+        """Get the info of feed, retrying on failure until deadline.
+
+        @arg  feed: feed address
+        @type feed: string
+        @arg  deadline: time after which the feed is not tried anymore
+        @type deadline: float
+
+        @return: list of tuples (title, date, torrent file), None on failure
+
+        """
+        host = urlparse.urlparse(feed).netloc
+        for attempt in range(self.retries + 1):
+            if attempt:
+                backoff = self.retry_backoff * 2 ** (attempt - 1)
+                if time.time() + backoff >= deadline:
+                    break
+                self.logger.info("Retrying %s in %s s" % (feed, backoff))
+                time.sleep(backoff)
+            with self._host_limiter.hold(host):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                feed_info = self.get_info(feed, min(30, remaining), deadline)
+            if feed_info is not None:
+                return feed_info
+        return None
+
+    def get_info(self, feed, timeout=30, deadline=None):
         """Get title, published date and torrent of shows from feed.
 
+        The feed is requested with the ETag and Last-Modified of the previous
+        fetch, and it's only parsed if it has changed: on 304 responses, or if
+        the content hash is the same, the previously parsed info is returned.
+        The body is spooled to a temporary file (in memory if it's small) while
+        it's downloaded.
+
         @arg  feed: feed address
         @type feed: string
+        @arg  timeout: timeout (in s) of the connection
+        @type timeout: float
+        @arg  deadline: time after which the download is aborted, None for no limit
+        @type deadline: float
 
-        @return: list of tuples (title, date, torrent file)
+        @return: list of tuples (title, date, torrent file), None on failure
 
         """
+        cached = self.feed_cache.get(feed, refresh=False) or {}
+        headers = {'User-Agent': "Magic Browser", # Hack to avoid 403 HTTP
+                   'Accept-Encoding': 'gzip'}
+        if 'info' in cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        stats = {'bytes': 0, 'parse_time': 0.0}
+        self.feed_stats[feed] = stats
+        url = body = None
         try:
-            req = urllib2.Request(feed, headers={'User-Agent': "Magic Browser"}) # Hack to avoid 403 HTTP
-            url = urllib2.urlopen(req, timeout=30)
-            tree = etree.parse(url)
-            titles = tree.xpath("/rss/channel/item/title[not (contains(., '720p') or contains(., '720P'))]/text()")
-            published_dates = tree.xpath("/rss/channel/item/pubDate/text()")
-            torrent_files = tree.xpath("/rss/channel/item/link[not (contains(., '720p') or contains(., '720P'))]/text()")
-            return [(str(titles[i]),
-                    datetime.strptime(published_dates[i], '%a, %d %b %Y %H:%M:%S +0000'),
-                    str(torrent_files[i])) for i in range(len(titles))]
-        except (etree.XMLSyntaxError, urllib2.URLError, socket.timeout):
+            req = urllib2.Request(feed, headers=headers)
+            try:
+                url = urllib2.urlopen(req, timeout=timeout)
+            except urllib2.HTTPError, error:
+                # Only trust a 304 if the request was conditional
+                if error.code != 304 or 'info' not in cached:
+                    raise
+                stats['status'] = 'not modified'
+                self.feed_cache.add(feed, cached)
+                return cached['info']
+            body, content_hash = self._download(url, stats, deadline)
+            if content_hash == cached.get('hash') and 'info' in cached:
+                stats['status'] = 'unchanged'
+                info = cached['info']
+            else:
+                stats['status'] = 'parsed'
+                start = time.time()
+                info = list(self.parse_feed(body))
+                stats['parse_time'] = time.time() - start
+            self.feed_cache.add(feed, {'etag': url.info().get('ETag'),
+                                       'last_modified': url.info().get('Last-Modified'),
+                                       'hash': content_hash,
+                                       'info': info})
+            return info
+        except (etree.XMLSyntaxError, urllib2.URLError, socket.timeout, IOError, zlib.error):
+            stats['status'] = 'failed'
             self.logger.exception('Service Unavailable')
+        finally:
+            if body is not None:
+                body.close()
+            if url is not None:
+                url.close()
+            self.logger.debug("Fetched %s: %s, %s bytes, parsed in %.3f s" % (feed, stats.get('status'),
+                                                                          stats['bytes'], stats['parse_time']))
+
+    def _download(self, response, stats, deadline=None, chunk_size=65536):
+        # Spool the (decompressed) body, hashing it on the way
+        spool = tempfile.SpooledTemporaryFile(max_size=1024*1024)
+        content_hash = hashlib.sha1()
+        decompressor = None
+        if response.info().get('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                if deadline is not None and time.time() > deadline:
+                    # Each read has the connection timeout, but a slow server
+                    # could keep the download going on past the end of the run
+                    raise socket.timeout("Deadline reached downloading %s" % response.geturl())
+                stats['bytes'] += len(chunk)
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                content_hash.update(chunk)
+                spool.write(chunk)
+            if decompressor:
+                chunk = decompressor.flush()
+                content_hash.update(chunk)
+                spool.write(chunk)
+        except:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool, content_hash.hexdigest()
+
+    def parse_feed(self, feed_file):
+        """Get title, published date and torrent of shows from a feed document.
+
+        The document is parsed incrementally, one item at a time, and items are
+        freed once processed. Items rejected by the quality filter, or with
+        missing fields, are skipped.
+
+        @arg  feed_file: feed contents
+        @type feed_file: file
+
+        @return: generator of tuples (title, date, torrent file)
+
+        """
+        for _, item in etree.iterparse(feed_file, events=('end',), tag='item'):
+            title, date, link = item.findtext('title'), item.findtext('pubDate'), item.findtext('link')
+            # Free the item and the already processed ones
+            item.clear()
+            while item.getprevious() is not None:
+                del item.getparent()[0]
+            if not (title and date and link):
+                continue
+            title, link = _to_str(title.strip()), _to_str(link.strip())
+            if self.item_filter and not self.item_filter(title, link):
+                continue
+            try:
+                date = parse_date(date.strip())
+            except ValueError:
+                self.logger.warning("Wrong date in item %s -> %s" % (title, date))
+                continue
+            yield title, date, link
 
     def act_on_torrent(self, torrent_file):
+        """Handle a new torrent. Called from the download pool.
+
+        @arg  torrent_file: torrent address
+        @type torrent_file: str
+
+        @return: boolean upon success/failure
+
+        """
         self.logger.critical("I don't know what to do with the torrent file!")
         raise NotImplementedError("I don't know what to do with the torrent file!")
 
 class ShowRSSToDeluge(ShowRSS):
     pass
 
+# Content types accepted by ShowRSSToFolder
+TORRENT_CONTENT_TYPES = ('application/x-bittorrent', 'application/octet-stream')
+
 class ShowRSSToFolder(ShowRSS):
     _notifications_to_publish = ShowRSS._notifications_to_publish + ['torrent_downloaded']
-    def __init__(self, name, feed_list, cache_file, schedule, download_folder):
-        super(ShowRSSToFolder, self).__init__(name, feed_list, cache_file, schedule)
+    def __init__(self, name, feed_list, cache_file, schedule, download_folder,
+                 max_torrent_size=10*1024*1024, content_types=TORRENT_CONTENT_TYPES, **kwargs):
+        """Configure the job.
+
+        @arg  download_folder: folder to save the torrents in
+        @type download_folder: str
+        @arg  max_torrent_size: maximum size (in bytes) of a torrent file
+        @type max_torrent_size: int
+        @arg  content_types: accepted content types of the torrents, None to accept any
+        @type content_types: tuple
+
+        See ShowRSS for the rest of arguments.
+
+        """
+        super(ShowRSSToFolder, self).__init__(name, feed_list, cache_file, schedule, **kwargs)
         # Check download folder
         self.download_folder = os.path.abspath(download_folder)
         if not os.path.exists(self.download_folder):
             self.logger.critical("Dowload folder doesn't exist -> %s" % self.download_folder)
             raise OSError("Folder doesn't exist -> %s" % self.download_folder)
+        self.max_torrent_size = max_torrent_size
+        self.content_types = content_types
+        # mkstemp creates files only readable by us: torrents get the usual
+        # permissions. The umask can only be read by setting it, so do it once
+        umask = os.umask(0)
+        os.umask(umask)
+        self._file_mode = 0666 & ~umask
 
     def act_on_torrent(self, torrent_file):
         """Download the torrent in the configured folder.
 
+        The torrent is streamed to a hidden temporary file in the download folder
+        which is renamed when complete, so an interrupted download never leaves
+        a partial torrent behind. Torrents with the wrong content type, larger
+        than the maximum size or not looking like a torrent are discarded.
+
         @arg  torrent_file: torrent to download
         @type torrent_file: str
-        @arg  dest_file: file name to save
-        @type dest_file: str
 
         @return: boolean upon success/failure
 
         """
-
         file_name = os.path.split(torrent_file)[1]
         dest_file = os.path.join(self.download_folder, file_name)
         if os.path.exists(dest_file):
             self.logger.error("Destination torrent already exists -> %s" % dest_file)
             return False
-        torrent = urllib2.urlopen(torrent_file, timeout=30)
-        output = open(dest_file, 'wb')
-        output.write(torrent.read())
-        output.close()
+        temp_file = None
+        try:
+            torrent = urllib2.urlopen(torrent_file, timeout=30)
+            content_type = torrent.info().gettype()
+            if self.content_types and content_type not in self.content_types:
+                self.logger.error("Wrong content type of %s -> %s" % (torrent_file, content_type))
+                return False
+            length = torrent.info().get('Content-Length')
+            if length and length.isdigit() and int(length) > self.max_torrent_size:
+                self.logger.error("Torrent too large -> %s (%s bytes)" % (torrent_file, length))
+                return False
+            fd, temp_file = tempfile.mkstemp(prefix='.%s.' % file_name, suffix='.part', dir=self.download_folder)
+            size = 0
+            with os.fdopen(fd, 'wb') as output:
+                while True:
+                    chunk = torrent.read(65536)
+                    if not chunk:
+                        break
+                    if not size and not chunk.startswith('d'):
+                        # Torrents are bencoded dictionaries
+                        self.logger.error("Not a torrent file -> %s" % torrent_file)
+                        return False
+                    size += len(chunk)
+                    if size > self.max_torrent_size:
+                        self.logger.error("Torrent too large -> %s (more than %s bytes)" % (torrent_file, self.max_torrent_size))
+                        return False
+                    output.write(chunk)
+                output.flush()
+                os.fsync(output.fileno())
+            if not size:
+                self.logger.error("Empty torrent file -> %s" % torrent_file)
+                return False
+            os.chmod(temp_file, self._file_mode)
+            os.rename(temp_file, dest_file)
+            temp_file = None
+        except (urllib2.URLError, socket.timeout, IOError, OSError):
+            self.logger.exception("Error downloading %s" % torrent_file)
+            return False
+        finally:
+            if temp_file and os.path.exists(temp_file):
+                os.remove(temp_file)
         self.notify('torrent_downloaded', {'torrent_file': torrent_file, 'output_file': dest_file})
         return True
 
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   asyncxbmcrpc.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Non-blocking JSON-RPC interaction with XBMC.
+
+AsyncXBMCRPC runs on asyncore, so a single thread calling loop() can drive
+any number of XBMC connections, with their schema discovery, without a
+reader thread per socket. Requests return RPCFutures and notifications go
+through the usual HTPCObject subscription machinery, or can be iterated over
+with a NotificationStream.
+
+"""
+
+import re
+import json
+import socket
+import asyncore
+import threading
+from Queue import Queue, Empty, Full
+
+from pythonhtpc.core import RPCError, RPCFuture
+from pythonhtpc.rpcs.xbmcrpc import XBMCRPC, RequestTracker, process_schema
+
+def loop(timeout=0.1, socket_map=None, count=None):
+    """Run the asyncore loop.
+
+    Requests issued from other threads are sent on the next iteration, so
+    timeout is also the maximum delay they will suffer.
+
+    """
+    asyncore.loop(timeout=timeout, use_poll=True, map=socket_map, count=count)
+
+class JSONStreamDecoder(object):
+    """Split a stream of concatenated JSON objects and arrays into values."""
+    _special = re.compile(r'[{}\[\]"]')
+    _string_special = re.compile(r'["\\]')
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+
+    def feed(self, data):
+        """Add data to the stream.
+
+        @arg  data: received data
+        @type data: str
+
+        @return: list of the values completed by data
+
+        """
+        values = []
+        buf = self._buffer + data
+        pos = self._pos
+        while pos < len(buf):
+            if self._in_string:
+                match = self._string_special.search(buf, pos)
+                if not match:
+                    pos = len(buf)
+                elif match.group() == '\\':
+                    if match.end() == len(buf):
+                        # Wait for the escaped character
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                else:
+                    self._in_string = False
+                    pos = match.end()
+                continue
+            match = self._special.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            char, pos = match.group(), match.end()
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                if self._depth == 0:
+                    # Drop anything between values
+                    buf, pos = buf[match.start():], 1
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    values.append(self._decoder.decode(buf[:pos]))
+                    buf, pos = buf[pos:], 0
+        if self._depth == 0 and not self._in_string:
+            buf, pos = '', 0
+        self._buffer, self._pos = buf, pos
+        return values
+
+class AsyncHTTPGet(asyncore.dispatcher):
+    """Non-blocking HTTP GET setting the body of the response in a future."""
+    def __init__(self, host, port, path, future, socket_map=None):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self._future = future
+        self._out_buffer = 'GET %s HTTP/1.0\r\nHost: %s:%s\r\n\r\n' % (path, host, port)
+        self._in_buffer = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    def writable(self):
+        return not self.connected or bool(self._out_buffer)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out_buffer)
+        self._out_buffer = self._out_buffer[sent:]
+
+    def handle_read(self):
+        self._in_buffer.append(self.recv(65536))
+
+    def handle_close(self):
+        self.close()
+        response = ''.join(self._in_buffer)
+        head, _, body = response.partition('\r\n\r\n')
+        status = head.split('\r\n', 1)[0].split()
+        if len(status) < 2 or status[1] != '200':
+            self._future.set_exception(RPCError("Bad HTTP response: %s" % ' '.join(status)))
+        else:
+            self._future.set_result(body)
+
+    def handle_error(self):
+        self.close()
+        self._future.set_exception(RPCError("Error getting the schema from XBMC"))
+
+class AsyncRPCConnection(RequestTracker, asyncore.dispatcher):
+    """JSON-RPC connection to XBMC handled by the asyncore loop."""
+    def __init__(self, address, notification_callback, socket_map=None):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self._init_tracker()
+        self._request_id = 0
+        self._send_lock = threading.Lock()
+        self._out_buffer = ''
+        self._decoder = JSONStreamDecoder()
+        self._notification_callback = notification_callback
+        self._closed = threading.Event()
+        import logging
+        self.logger = logging.getLogger('htpc.asyncrpc')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def _write_value(self, value):
+        self._out_buffer += json.dumps(value)
+
+    def request(self, method, params=None):
+        """Send a request whose response is not needed."""
+        with self._send_lock:
+            self._request_id += 1
+            self._write_value({'jsonrpc': '2.0', 'method': method, 'params': params or {}, 'id': self._request_id})
+            return self._request_id
+
+    def readable(self):
+        # Called once per loop iteration
+        self._expire()
+        return True
+
+    def writable(self):
+        return not self.connected or bool(self._out_buffer)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        with self._send_lock:
+            sent = self.send(self._out_buffer)
+            self._out_buffer = self._out_buffer[sent:]
+
+    def handle_read(self):
+        for value in self._decoder.feed(self.recv(65536)):
+            self._dispatch(value)
+
+    def _dispatch(self, value):
+        if isinstance(value, list):
+            for element in value:
+                self._dispatch(element)
+        elif not isinstance(value, dict):
+            self.logger.warning("Unexpected value received: %s" % value)
+        elif 'result' in value or 'error' in value:
+            if value.get('id') in self._pending:
+                self._resolve(value)
+            elif value.get('id') is None and 'error' in value:
+                self._fail_batch(value)
+        elif 'method' in value:
+            self._notification_callback(value['method'], value.get('params'))
+
+    def handle_close(self):
+        self.close()
+        self._fail_pending(RPCError("Connection to XBMC closed"))
+        self._closed.set()
+
+    def handle_error(self):
+        self.logger.exception("Error in connection to XBMC:")
+        self.handle_close()
+
+    def shutdown(self):
+        self.handle_close()
+
+    def join(self, timeout=None):
+        self._closed.wait(timeout)
+
+class _Closed(object):
+    """End of a NotificationStream."""
+    pass
+
+class NotificationStream(object):
+    """Iterator over the notifications received by an AsyncXBMCRPC.
+
+    Notifications are queued as they arrive and iterated over as
+    (notification, value) pairs. Iterating blocks until the next one
+    arrives, so it's meant for threads other than the one running loop();
+    that one can use received() to get those already queued. Iteration ends
+    when the stream or the RPC is closed.
+
+    If the queue is full, new notifications are dropped and counted in
+    the dropped attribute.
+
+    """
+    def __init__(self, pattern=None, maxsize=1000):
+        """Configure the stream.
+
+        @arg  pattern: regex matching the notifications to queue, None for all
+        @type pattern: str
+        @arg  maxsize: maximum number of queued notifications, 0 for no limit
+        @type maxsize: int
+
+        """
+        self._regex = re.compile(pattern) if pattern else None
+        self._queue = Queue(maxsize)
+        self.closed = False
+        self.dropped = 0
+
+    def _push(self, notification, value):
+        # Called from the loop thread, so it must not block
+        if self.closed or (self._regex and not self._regex.match(notification)):
+            return
+        try:
+            self._queue.put_nowait((notification, value))
+        except Full:
+            self.dropped += 1
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        item = self._queue.get()
+        if isinstance(item, _Closed):
+            # Let other iterating threads finish too
+            self._queue.put(item)
+            raise StopIteration
+        return item
+
+    def received(self):
+        """Get the notifications already queued, without blocking.
+
+        @return: list of (notification, value) pairs
+
+        """
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                break
+            if isinstance(item, _Closed):
+                self._queue.put(item)
+                break
+            items.append(item)
+        return items
+
+    def close(self):
+        """Stop queueing notifications and end the iteration once the queue is empty."""
+        if self.closed:
+            return
+        self.closed = True
+        # Not put_nowait: the closing mark can't be dropped
+        while True:
+            try:
+                self._queue.put(_Closed(), timeout=0.1)
+                break
+            except Full:
+                self.received()
+
+class AsyncXBMCRPC(XBMCRPC):
+    """XBMC RPC whose connection and discovery run on the asyncore loop.
+
+    Methods and notifications are only known once the future returned by
+    discover() (also available as the discovered attribute) is done.
+    execute_method and execute_batch return RPCFutures instead of blocking.
+
+    """
+    def __init__(self, name, address, http_port=8080, tcp_port=9090, socket_map=None):
+        self._socket_map = socket_map
+        self.discovered = None
+        self._streams = []
+        self._streams_lock = threading.Lock()
+        XBMCRPC.__init__(self, name, address, http_port, tcp_port)
+
+    def _initial_schema(self, discover):
+        # The schema is discovered on the loop, see discover()
+        return {'methods': {}, 'notifications': {}, 'types': {}}
+
+    def discover(self):
+        """Start fetching the schema from the http jsonrpc.
+
+        @return: RPCFuture with the processed schema
+
+        """
+        address, port, _ = self._address
+        future = RPCFuture(transform=lambda body: process_schema(json.loads(body)))
+        def configure(future):
+            if future.exception() is not None:
+                self.logger.error("Error loading schema from http://%s:%s/jsonrpc: %s" % (address, port, future.exception()))
+            else:
+                self._configure(future.result())
+        future.add_done_callback(configure)
+        self.discovered = future
+        AsyncHTTPGet(address, port, '/jsonrpc', future, self._socket_map)
+        return future
+
+    def _init_rpc(self):
+        if self.discovered is None:
+            self.discover()
+        address, _, port = self._address
+        return AsyncRPCConnection((address, port), self.notification_callback, self._socket_map)
+
+    def execute_method(self, method, params=None, wait_for_response=True):
+        """Execute method without blocking.
+
+        @return: RPCFuture, or None if wait_for_response is False
+
+        """
+        if not wait_for_response:
+            return super(AsyncXBMCRPC, self).execute_method(method, params, False)
+        return self.execute_method_async(method, params)
+
+    def execute_batch(self, calls, timeout=None):
+        """Execute several methods in one go without blocking.
+
+        Waiting for the results in the thread running loop() would never
+        end, since the loop couldn't read them.
+
+        @return: list of RPCFuture in the same order as calls
+
+        """
+        return self.execute_batch_async(calls, timeout)
+
+    def notifications(self, pattern=None, maxsize=1000):
+        """Get a stream of the notifications received from now on.
+
+        See NotificationStream for the arguments.
+
+        @return: NotificationStream
+
+        """
+        stream = NotificationStream(pattern, maxsize)
+        with self._streams_lock:
+            self._streams = [other for other in self._streams if not other.closed] + [stream]
+        return stream
+
+    def notification_callback(self, notification, value):
+        super(AsyncXBMCRPC, self).notification_callback(notification, value)
+        with self._streams_lock:
+            streams = list(self._streams)
+        for stream in streams:
+            stream._push(notification, value)
+
+    def wait(self):
+        try:
+            while self._rpc.connected or self._rpc.connecting:
+                loop(socket_map=self._socket_map, count=10)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.logger.debug("Shutting down RPC")
+        self._rpc.shutdown()
+        with self._streams_lock:
+            streams, self._streams = self._streams, []
+        for stream in streams:
+            stream.close()
+
+# EOF
@@ -7,32 +7,408 @@
 """JSON-RPC interaction with XBMC."""
 #https://github.com/gazpachoking/jsonref
 
+import os
+import re
+import json
+import time
+import heapq
+import threading
+from collections import deque
+
 import symmetricjsonrpc
 
-from pythonhtpc.core import RPCServer
+from pythonhtpc.core import RPCServer, RPCError, RPCFuture
+import pythonhtpc.utils.picklefile as picklefile
+from pythonhtpc.utils.validation import ValidatorCache, resolve_references
+from pythonhtpc.utils.containers import TimedDict
+from pythonhtpc.utils.dispatcher import get_dispatcher
+
+# Increase when the format of the processed schema changes
+_SCHEMA_CACHE_FORMAT = 2
+
+def process_method(method, config):
+    """Process the introspection config of a single method."""
+    params = dict([(element.pop('name'), element) for element in config['params']])
+    processed_config = {'description': config['description'],
+                        'params': {'type': 'object', 'properties': params},
+                        'returns': config['returns'],
+                        }
+    if method == 'JSONRPC.Version':
+        processed_config['returns'] = {'type': 'object',
+                                       'properties': {'version': {'properties': processed_config['returns']['properties']}}
+                                       }
+    return processed_config
+
+def process_schema(schema):
+    """Process the XBMC introspection schema into method and notification configs.
+
+    See http://forum.xbmc.org/showthread.php?tid=190653 for details.
+
+    """
+    processed_schema = {'methods': {}, 'notifications': schema['notifications'], 'types': schema.get('types', {})}
+    for method, config in schema['methods'].items():
+        processed_schema['methods'][method] = process_method(method, config)
+    # Hack for notifications
+    processed_schema['notifications']['GUI.OnScreensaverActivated'] = processed_schema['notifications']['VideoLibrary.OnCleanStarted']
+    processed_schema['notifications']['GUI.OnScreensaverActivated']['description'] = "The screensaver has been activated."
+    processed_schema['notifications']['GUI.OnScreensaverDeactivated'] = processed_schema['notifications']['VideoLibrary.OnCleanStarted']
+    processed_schema['notifications']['GUI.OnScreensaverDeactivated']['description'] = "The screensaver has been deactivated."
+    # Point references to the shared type definitions
+    resolve_references(processed_schema, processed_schema['types'])
+    return processed_schema
+
+class RequestTracker(object):
+    """Keep track of the requests in flight on a JSON-RPC connection.
+
+    Classes using it need to provide _request_id, _send_lock and
+    _write_value(value), and call _init_tracker() on initialization.
+
+    """
+    def _init_tracker(self):
+        # {request id: future} pairs of requests in flight
+        self._pending = {}
+        # Heap of (deadline, request id) for requests with timeout
+        self._deadlines = []
+        # Futures of the batches in flight, oldest first
+        self._batches = deque()
+        # Protects _pending, _deadlines and _batches, which are used by the caller and reader threads
+        self._tracker_lock = threading.Lock()
+
+    def _new_request(self, method, params, timeout, transform):
+        # Needs to be called with the send lock acquired
+        self._request_id += 1
+        future = RPCFuture(self._request_id, timeout, transform)
+        with self._tracker_lock:
+            self._pending[self._request_id] = future
+            if future.deadline is not None:
+                heapq.heappush(self._deadlines, (future.deadline, self._request_id))
+        future.add_done_callback(self._forget_request)
+        return future, {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': self._request_id}
+
+    def _forget_request(self, future):
+        with self._tracker_lock:
+            self._pending.pop(future.request_id, None)
+            # Answered requests stay in the heap until their deadline: drop
+            # them if they are too many
+            if len(self._deadlines) > 2 * len(self._pending) + 64:
+                self._deadlines = [(deadline, request_id) for deadline, request_id in self._deadlines
+                                   if request_id in self._pending]
+                heapq.heapify(self._deadlines)
+
+    def request_async(self, method, params=None, timeout=None, transform=None):
+        """Send a request without waiting for its response.
+
+        Any number of requests can be in flight at the same time, their
+        responses are matched back by id.
+
+        @return: RPCFuture
+
+        """
+        self._expire()
+        with self._send_lock:
+            future, request = self._new_request(method, params or {}, timeout, transform)
+            self._write_value(request)
+        return future
+
+    def request_batch(self, calls, timeout=None, transform=None):
+        """Send the (method, params) pairs as a single JSON-RPC batch.
+
+        transform can be a single function, applied to all the results, or
+        a list with a function for each call.
+
+        @return: list of RPCFuture in the same order as calls
+
+        """
+        transforms = transform if isinstance(transform, list) else [transform] * len(calls)
+        self._expire()
+        with self._send_lock:
+            futures, requests = [], []
+            for (method, params), call_transform in zip(calls, transforms):
+                future, request = self._new_request(method, params, timeout, call_transform)
+                futures.append(future)
+                requests.append(request)
+            with self._tracker_lock:
+                self._prune_batches()
+                self._batches.append(futures)
+            self._write_value(requests)
+        return futures
+
+    def _prune_batches(self):
+        # Needs to be called with the tracker lock acquired
+        while self._batches and all(future.done() for future in self._batches[0]):
+            self._batches.popleft()
+
+    def _fail_batch(self, response):
+        """Fail the oldest batch in flight with an error without id.
+
+        Errors about a whole batch (e.g., if it couldn't be parsed) can't be
+        matched to its requests, but the server answers in order.
+
+        @return: bool, whether there was a batch to fail
+
+        """
+        with self._tracker_lock:
+            self._prune_batches()
+            if not self._batches:
+                return False
+            futures = self._batches.popleft()
+        error = response['error'] or {}
+        for future in futures:
+            future.set_exception(RPCError(error.get('message'), error.get('code'), error.get('data')))
+        return True
+
+    def _resolve(self, response):
+        with self._tracker_lock:
+            future = self._pending.pop(response['id'], None)
+        if future is not None:
+            error = response.get('error')
+            if error is not None:
+                future.set_exception(RPCError(error.get('message'), error.get('code'), error.get('data')))
+            else:
+                future.set_result(response.get('result'))
+        self._expire()
+
+    def _expire(self):
+        now = time.time()
+        expired = []
+        with self._tracker_lock:
+            while self._deadlines and (self._deadlines[0][0] <= now or self._deadlines[0][1] not in self._pending):
+                _, request_id = heapq.heappop(self._deadlines)
+                future = self._pending.pop(request_id, None)
+                if future is not None:
+                    expired.append(future)
+        # Outside of the lock, since done callbacks take it
+        for future in expired:
+            future.expire(now)
+
+    def _fail_pending(self, error):
+        """Make all the requests in flight fail with error."""
+        with self._tracker_lock:
+            pending, self._pending = self._pending, {}
+            self._deadlines = []
+            self._batches = deque()
+        for future in pending.values():
+            future.set_exception(error)
+
+# Read-only methods whose responses can be cached
+CACHEABLE_METHODS = r'(VideoLibrary\.Get|AudioLibrary\.Get|Application\.GetProperties$)'
+# (notification pattern, method pattern) pairs: the notification invalidates the cached methods
+CACHE_INVALIDATIONS = [(r'VideoLibrary\.On(Update|Remove|ScanFinished|CleanFinished)$', r'VideoLibrary\.'),
+                       (r'AudioLibrary\.On(Update|Remove|ScanFinished|CleanFinished)$', r'AudioLibrary\.'),
+                       (r'Application\.On(VolumeChanged|Exit)$', r'Application\.'),
+                       (r'System\.On(Restart|Wake)$', r''),
+                       ]
+
+class ResponseCache(object):
+    """Cache of method responses invalidated by notifications.
+
+    Entries are keyed by method and canonicalized params, and expire after ttl
+    seconds. When full, the least recently used entries are evicted. Cached
+    results are shared between callers, so they should not be modified.
+
+    """
+    def __init__(self, ttl=300, max_items=1000, methods=CACHEABLE_METHODS, invalidations=CACHE_INVALIDATIONS):
+        """Configure the cache.
+
+        @arg  ttl: life span (in s) of the entries
+        @type ttl: int
+        @arg  max_items: maximum number of cached responses
+        @type max_items: int
+        @arg  methods: regex of the methods to cache
+        @type methods: str
+        @arg  invalidations: (notification pattern, method pattern) pairs
+        @type invalidations: list
+
+        """
+        self._entries = TimedDict(ttl, cleanup_func=self._forget, max_items=max_items)
+        self._methods = re.compile(methods)
+        self._invalidations = [(re.compile(notification), re.compile(method))
+                               for notification, method in invalidations]
+        self._cacheable = {}
+        # Keys by method
+        self._by_method = {}
+        # Increased on each invalidation, to discard responses to requests sent before
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._invalidations_count = 0
+
+    def is_cacheable(self, method):
+        cacheable = self._cacheable.get(method)
+        if cacheable is None:
+            cacheable = self._cacheable[method] = bool(self._methods.match(method))
+        return cacheable
+
+    @staticmethod
+    def _key(method, params):
+        return method, json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+    def get(self, method, params):
+        """Get a cached response.
+
+        @return: tuple (found, result)
+
+        """
+        key = self._key(method, params)
+        with self._lock:
+            entry = self._entries.get(key, refresh=False)
+        if entry is None:
+            return False, None
+        return True, entry[1]
+
+    def add(self, method, params, result, generation=None):
+        """Cache a response.
+
+        If generation is given and there have been invalidations since, the
+        response may be stale and it's not cached.
+
+        """
+        key = self._key(method, params)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.delete(key)
+            self._entries.add(key, (key, result))
+            self._by_method.setdefault(method, set()).add(key)
+
+    def _forget(self, entry):
+        key = entry[0]
+        keys = self._by_method.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_method[key[0]]
+
+    def invalidate(self, notification):
+        """Drop the responses invalidated by notification.
+
+        @return: number of dropped entries
+
+        """
+        patterns = [method for regex, method in self._invalidations if regex.match(notification)]
+        if not patterns:
+            return 0
+        dropped = 0
+        with self._lock:
+            self.generation += 1
+            for method in list(self._by_method):
+                if any(pattern.match(method) for pattern in patterns):
+                    for key in list(self._by_method.get(method, ())):
+                        self._entries.delete(key)
+                        dropped += 1
+            self._invalidations_count += dropped
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.delete_all()
+
+    def stats(self):
+        """Report hits, misses, invalidations, evictions and size."""
+        with self._lock:
+            entries_stats = self._entries.stats()
+        stats = dict((counter, entries_stats[counter]) for counter in ('hits', 'misses', 'evictions'))
+        stats['invalidations'] = self._invalidations_count
+        stats['size'] = entries_stats['items']
+        return stats
 
 class XBMCRPC(RPCServer):
-    class RPCClient(symmetricjsonrpc.RPCClient):
+    class RPCClient(RequestTracker, symmetricjsonrpc.RPCClient):
         class Request(symmetricjsonrpc.RPCClient.Request):
+            def dispatch(self, subject):
+                # Batch responses come as a list of responses
+                if isinstance(subject, list):
+                    for element in subject:
+                        self.dispatch(element)
+                elif isinstance(subject, dict) and subject.get('id') in self.parent._pending:
+                    self.parent._resolve(subject)
+                elif isinstance(subject, dict) and subject.get('id') is None and 'error' in subject \
+                        and self.parent._fail_batch(subject):
+                    pass
+                else:
+                    symmetricjsonrpc.RPCClient.Request.dispatch(self, subject)
+
             def dispatch_notification(self, notification):
                 # Handle callbacks from the server
                 method = notification.pop('method', None)
                 params = notification.pop('params', None)
                 self.parent._notification_callback(method, params)
 
+        def _init(self, subject, parent=None, *arg, **kw):
+            self._init_tracker()
+            symmetricjsonrpc.RPCClient._init(self, subject=subject, parent=parent, *arg, **kw)
+
         def set_notification_callback(self, notification_callback):
             self._notification_callback = notification_callback
             return self
 
-    def __init__(self, name, address, http_port=8080, tcp_port=9090):
+        def _write_value(self, value):
+            self.writer.write_value(value)
+
+        def run_thread(self):
+            try:
+                symmetricjsonrpc.RPCClient.run_thread(self)
+            finally:
+                # No responses can arrive anymore
+                self._fail_pending(RPCError("Connection to XBMC closed"))
+
+    # Fill the schema from XBMC as methods are used?
+    _lazy_schema = False
+    # Opt-in ResponseCache
+    response_cache = None
+    # Maximum time (in s) execute_method waits for a response
+    request_timeout = 60
+    # Wait (in s) before saving methods fetched lazily, so they are saved together
+    schema_save_delay = 5
+
+    def __init__(self, name, address, http_port=8080, tcp_port=9090, schema_cache=None, discover=True):
+        """Configure the RPC and load its schema.
+
+        The schema is loaded from schema_cache if given, and checked against
+        the JSONRPC.Version of XBMC on start. Otherwise it is discovered
+        from the http jsonrpc, unless discover is False, in which case the
+        configuration of each method is requested the first time it's used.
+
+        @arg  schema_cache: file where to cache the processed schema
+        @type schema_cache: str
+        @arg  discover: discover the full schema if not cached?
+        @type discover: bool
+
+        """
         super(XBMCRPC, self).__init__(name)
         self._address = (address, http_port, tcp_port)
-        schema = self._discover()
+        self._schema_cache = os.path.expanduser(schema_cache) if schema_cache else None
+        self._lazy_schema = not discover
+        # Version of the loaded schema, None if it has just been discovered
+        self._schema_version = None
+        self._schema_discovered = False
+        # Protects the schema while methods are fetched lazily and saved
+        self._schema_lock = threading.Lock()
+        self._schema_save_pending = False
+        # Compiled schema validators (XBMC follows draft 3 defaults)
+        self.validators = ValidatorCache(required_by_default=False, blank_by_default=True)
+        self._configure(self._initial_schema(discover))
+
+    def _initial_schema(self, discover):
+        """Get the schema to start with, from the cache or from XBMC (blocking)."""
+        schema = None
+        if self._schema_cache:
+            schema, self._schema_version = self._load_cached_schema()
+        if schema is None and discover:
+            schema = self._discover()
+            self._schema_discovered = True
+        if schema is None:
+            schema = {'methods': {}, 'notifications': {}, 'types': {}}
+        return schema
+
+    def _configure(self, schema):
+        """Load the processed schema into the method and notification lists."""
         self._method_config, self._notification_config = schema['methods'], schema['notifications']
-        for method in self._method_config:
-            self._methods.append(method)
-        for notification in self._notification_config:
-            self._published_notifications.append(notification)
+        self._types = schema.get('types', {})
+        self._notification_schemas = {}
+        self.validators.clear()
+        self._methods[:] = list(self._method_config)
+        self._published_notifications[:] = list(self._notification_config)
 
     def wait(self):
         try:
@@ -47,31 +423,143 @@ class XBMCRPC(RPCServer):
 
     def stop(self):
         self.logger.debug("Shutting down RPC")
+        self._save_pending_schema()
         self._rpc.shutdown()
         self._rpc.join()
+        self._rpc._fail_pending(RPCError("Connection to XBMC closed"))
+
+    def start(self):
+        super(XBMCRPC, self).start()
+        if self._schema_cache:
+            self._check_schema_version()
+        return self
+
+    def _cache_key(self):
+        address, http_port, tcp_port = self._address
+        return '%s:%s:%s/%s' % (address, http_port, tcp_port, _SCHEMA_CACHE_FORMAT)
+
+    def _load_cached_schema(self):
+        """Load the schema from the cache.
+
+        @return: tuple (schema, version), (None, None) if not cached
+
+        """
+        try:
+            cache = picklefile.load(self._schema_cache) or {}
+        except:
+            self.logger.exception("Error loading schema cache %s" % self._schema_cache)
+            return None, None
+        version, schema = cache.get(self._cache_key(), (None, None))
+        if schema is not None:
+            self.logger.debug("Loaded schema for version %s from cache" % version)
+        return schema, version
+
+    def _save_cached_schema(self, version):
+        try:
+            cache = picklefile.load(self._schema_cache) or {}
+        except:
+            cache = {}
+        cache[self._cache_key()] = (version, {'methods': self._method_config,
+                                              'notifications': self._notification_config,
+                                              'types': self._types})
+        try:
+            picklefile.write(self._schema_cache, cache, protocol=-1)
+        except:
+            self.logger.exception("Error writing schema cache %s" % self._schema_cache)
+
+    def _check_schema_version(self, timeout=10):
+        """Compare the version of the loaded schema with the one of XBMC.
+
+        The full schema is discovered again if they don't match.
+
+        """
+        try:
+            version = self._rpc.request_async('JSONRPC.Version').result(timeout)['version']
+            version = '%s.%s.%s' % (version.get('major'), version.get('minor'), version.get('patch'))
+        except:
+            self.logger.exception("Error getting JSONRPC version from XBMC:")
+            return
+        if version == self._schema_version:
+            return
+        if not self._schema_discovered:
+            self.logger.info("Schema version changed from %s to %s" % (self._schema_version, version))
+            if self._lazy_schema:
+                self._configure({'methods': {}, 'notifications': {}, 'types': {}})
+            else:
+                self._configure(self._discover())
+        self._schema_version = version
+        self._save_cached_schema(version)
+
+    def enable_response_cache(self, ttl=300, max_items=1000, methods=CACHEABLE_METHODS,
+                              invalidations=CACHE_INVALIDATIONS):
+        """Cache the responses of read-only methods.
+
+        See ResponseCache for the arguments.
+
+        @return: ResponseCache
+
+        """
+        self.response_cache = ResponseCache(ttl, max_items, methods, invalidations)
+        return self.response_cache
+
+    def set_validation_policy(self, pattern, policy, rate=1.0):
+        """Set how results and notifications matching pattern are validated.
+
+        @arg  pattern: regex to match method and notification names against
+        @type pattern: str
+        @arg  policy: 'always', 'sampled' or 'never'
+        @type policy: str
+        @arg  rate: fraction of validated calls for 'sampled'
+        @type rate: float
+
+        """
+        self.validators.set_policy(pattern, policy, rate)
+
+    def _has_method(self, method):
+        if method in self._methods:
+            return True
+        if not self._lazy_schema or self._rpc is None:
+            return False
+        # Ask XBMC for the configuration of the method
+        try:
+            schema = self._rpc.request_async('JSONRPC.Introspect',
+                                             {'filter': {'id': method, 'type': 'method'}}).result(10)
+            config = schema['methods'][method]
+        except Exception, error:
+            self.logger.error("Error getting the configuration of method %s: %s" % (method, error))
+            return False
+        with self._schema_lock:
+            self._types.update(schema.get('types', {}))
+            self._method_config[method] = resolve_references(process_method(method, config), self._types)
+            self._methods.append(method)
+        self._schedule_schema_save()
+        return True
+
+    def _schedule_schema_save(self):
+        """Save the schema to the cache in a while, unless it's already scheduled."""
+        if not self._schema_cache:
+            return
+        with self._schema_lock:
+            if self._schema_save_pending:
+                return
+            self._schema_save_pending = True
+        (self._dispatcher or get_dispatcher()).call_later(self.schema_save_delay, self._save_pending_schema)
+
+    def _save_pending_schema(self):
+        with self._schema_lock:
+            if not self._schema_save_pending:
+                return
+            self._schema_save_pending = False
+            self._save_cached_schema(self._schema_version)
+
+    def add_notification_subscription(self, name, callback, *args, **kwargs):
+        # The notification config is unknown, so it won't be validated
+        if self._lazy_schema and not name in self._published_notifications:
+            self._published_notifications.append(name)
+        return super(XBMCRPC, self).add_notification_subscription(name, callback, *args, **kwargs)
 
     def _discover(self):
         """Discover methods and schema from the http jsonrpc."""
-        def process_schema(schema):
-            """See http://forum.xbmc.org/showthread.php?tid=190653 for details."""
-            processed_schema = {'methods': {}, 'notifications': schema['notifications']}
-            for method, config in schema['methods'].items():
-                params = dict([(element.pop('name'), element) for element in config['params']])
-                processed_schema['methods'][method] = {'description': config['description'],
-                                                    'params': {'type': 'object', 'properties': params},
-                                                    'returns': config['returns'],
-                                                    }
-            # Hack for notifications
-            processed_schema['methods']['JSONRPC.Version']['returns'] = {'type': 'object',
-                                                                        'properties': {'version': {'properties': processed_schema['methods']['JSONRPC.Version']['returns']['properties']}}
-                                                                        }
-            processed_schema['notifications']['GUI.OnScreensaverActivated'] = processed_schema['notifications']['VideoLibrary.OnCleanStarted']
-            processed_schema['notifications']['GUI.OnScreensaverActivated']['description'] = "The screensaver has been activated."
-            processed_schema['notifications']['GUI.OnScreensaverDeactivated'] = processed_schema['notifications']['VideoLibrary.OnCleanStarted']
-            processed_schema['notifications']['GUI.OnScreensaverDeactivated']['description'] = "The screensaver has been deactivated."
-            # Ref resolving!
-            return processed_schema
-
         from json import loads
         import urllib2
         address, port, _ = self._address
@@ -98,50 +586,160 @@ class XBMCRPC(RPCServer):
 
 
     def _execute_method(self, method, params, wait_for_response):
-        from validictory import validate
         # Find config
         config = self._method_config.get(method, None)
         if not config:
             self.logger.error("I don't have any configuration for method %s" % method)
             return None
-        # Check parameters
-        try:
-            pass
-            #self.logger.debug("Validating %s against %s" % (params, config['params']))
-            #validate(params, config['params'])
-        except:
-            self.logger.exception("Error validating parameters:")
+        if not wait_for_response:
+            try:
+                self._rpc.request(method, params=params)
+            except:
+                self.logger.exception("Error sending request to XBMC:")
             return None
         try:
-            result = self._rpc.request(method, wait_for_response=wait_for_response, params=params)
-            #if isinstance(result, dict):
-                #result = result[result.keys()[0]]
+            return self._execute_method_async(method, params, self.request_timeout).result()
         except:
-            self.logger.exception("Error sending request to XBMC:")
+            self.logger.exception("Error executing %s in XBMC:" % method)
             return None
-        # Check returns
+
+    def _execute_method_async(self, method, params, timeout):
+        config = self._method_config.get(method, None)
+        if not config:
+            self.logger.error("I don't have any configuration for method %s" % method)
+            future = RPCFuture(timeout=timeout)
+            future.set_exception(RPCError("No configuration for method %s" % method))
+            return future
+        transform = self._result_validator(method)
+        cache = self.response_cache
+        if cache is not None and cache.is_cacheable(method):
+            found, result = cache.get(method, params)
+            if found:
+                future = RPCFuture(timeout=timeout)
+                future.set_result(result)
+                return future
+            transform = self._caching_transform(method, params, transform, cache.generation)
         try:
-            #self.logger.debug("Validating %s against %s" % (result, config['returns']))
-            validate(result, config['returns'])
+            return self._rpc.request_async(method, params, timeout=timeout, transform=transform)
+        except Exception, error:
+            self.logger.exception("Error sending request to XBMC:")
+            future = RPCFuture(timeout=timeout)
+            future.set_exception(error)
+            return future
+
+    def _caching_transform(self, method, params, transform, generation):
+        def cache_result(result):
+            result = transform(result)
+            self.response_cache.add(method, params, result, generation)
+            return result
+        return cache_result
+
+    def _result_validator(self, method):
+        def validate_result(result):
+            try:
+                self.validators.validate(method, self._method_config[method]['returns'], result)
+            except:
+                self.logger.exception("Error validating answer from XBMC for method %s:" % method)
+                raise
             return result
+        return validate_result
+
+    def _execute_batch(self, calls, timeout):
+        if timeout is None:
+            timeout = self.request_timeout
+        results = []
+        for (method, _), future in zip(calls, self._execute_batch_async(calls, timeout)):
+            if future.exception() is not None:
+                self.logger.error("Error from XBMC executing %s: %s" % (method, future.exception()))
+                results.append(future.exception())
+            else:
+                results.append(future.result())
+        return results
+
+    def _execute_batch_async(self, calls, timeout):
+        futures = [None] * len(calls)
+        to_send = []
+        for index, (method, params) in enumerate(calls):
+            if not method in self._method_config:
+                self.logger.error("I don't have any configuration for method %s" % method)
+                futures[index] = RPCFuture(timeout=timeout)
+                futures[index].set_exception(RPCError("No configuration for method %s" % method))
+            else:
+                to_send.append(index)
+        if not to_send:
+            return futures
+        try:
+            # Check returns as they arrive
+            sent = self._rpc.request_batch([calls[index] for index in to_send], timeout=timeout,
+                                           transform=[self._batch_result_validator(calls[index][0])
+                                                      for index in to_send])
         except:
-            self.logger.exception("Error validating answer from XBMC:")
-            return None
+            self.logger.exception("Error sending batch request to XBMC:")
+            sent = []
+            for index in to_send:
+                future = RPCFuture(timeout=timeout)
+                future.set_exception(RPCError("Error sending batch request to XBMC"))
+                sent.append(future)
+        for index, future in zip(to_send, sent):
+            futures[index] = future
+        return futures
+
+    def _batch_result_validator(self, method):
+        validate_result = self._result_validator(method)
+        def validate_batch_result(result):
+            try:
+                return validate_result(result)
+            except Exception, error:
+                raise RPCError("Invalid answer for method %s: %s" % (method, error))
+        return validate_batch_result
 
     def notification_callback(self, notification, value):
         self.logger.debug("Received notification %s with value %s" % (notification, value))
         try:
+            if self.response_cache is not None:
+                self.response_cache.invalidate(notification)
             if notification in self._subscribed_notifications:
-                params = self._process_notification(notification, value)
-                self.notify(notification, params)
+                # Validated by notify when delivered
+                self.notify(notification, value)
         except:
             self.logger.exception("Problem processing notification %s with value %s:" % (notification, value))
 
     def _process_notification(self, notification, value):
-        from validictory import validate
-        validate(value, {'params': self._notification_config[notification]['params']})
+        if self._lazy_schema and not notification in self._notification_config:
+            return value
+        self.validators.validate(notification, self._notification_schema(notification), value)
         return value
 
+    def _notification_schema(self, notification):
+        """Get the schema of the params of a notification, built like the one of method params."""
+        schema = self._notification_schemas.get(notification)
+        if schema is None:
+            properties = {}
+            for param in self._notification_config[notification]['params']:
+                param = dict(param)
+                properties[param.pop('name')] = param
+            schema = self._notification_schemas[notification] = {'type': 'object', 'properties': properties}
+        return schema
+
+    @property
+    def is_lazy(self):
+        """Is the schema filled from XBMC as methods are used?"""
+        return self._lazy_schema
+
+    def has_method(self, method):
+        """Is method in the loaded schema?
+
+        Unlike executing it, this never asks XBMC for the configuration of
+        the method, so with a lazy schema unused methods are not known yet.
+
+        """
+        return method in self._method_config
+
+    def get_method_description(self, method):
+        """Get the description of a method in the loaded schema, None if it's unknown."""
+        config = self._method_config.get(method)
+        return config['description'] if config else None
+
     def get_method_info(self, method_name, verbose=False):
         if not method_name in self._methods:
             self.logger.warning("Cannot give info for method %s because I don't know it" % method_name)
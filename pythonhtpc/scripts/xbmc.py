@@ -6,6 +6,7 @@
 # =============================================================================
 """Run and interact with XBMC on command line,"""
 
+import re
 import sys
 import argparse
 import logging
@@ -37,35 +38,103 @@ def initialize_xbmc(args, format_=None):
     formatter = logging.Formatter(format_)
     stdout.setFormatter(formatter)
     logging.getLogger('htpc').addHandler(stdout)
-    return XBMCRPC("XBMC", args.ip, args.httpport, args.tcpport)
+    return XBMCRPC("XBMC", args.ip, args.httpport, args.tcpport,
+                   schema_cache=args.schemacache or None, discover=not args.lazy)
+
+class MethodCaller(object):
+    """Callable executing an XBMC method.
+
+    Besides calling it, which is equivalent to xbmc.execute_method, the
+    method can be executed asynchronously with async (equivalent to
+    xbmc.execute_method_async) and for a list of params in one request
+    with batch (equivalent to xbmc.execute_batch).
+
+    """
+    def __init__(self, parent, method):
+        self._parent = parent
+        self._method = method
+        self.__doc__ = parent.get_method_description(method)
+
+    def __call__(self, *args, **kwargs):
+        return self._parent.execute_method(self._method, *args, **kwargs)
+
+    def async(self, *args, **kwargs):
+        return self._parent.execute_method_async(self._method, *args, **kwargs)
+
+    def batch(self, params_list, timeout=None):
+        return self._parent.execute_batch([(self._method, params) for params in params_list], timeout)
+
+    def __repr__(self):
+        return '<XBMC method %s>' % self._method
+
+class Namespace(object):
+    """XBMC namespace whose methods are created on first access."""
+    def __init__(self, name, parent):
+        self._name = name
+        self._parent = parent
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        method = '%s.%s' % (self._name, attr)
+        if not self._parent.has_method(method) and not self._parent.is_lazy:
+            raise AttributeError("XBMC has no method %s" % method)
+        caller = MethodCaller(self._parent, method)
+        # Cache it, __getattr__ won't be called again
+        setattr(self, attr, caller)
+        return caller
+
+    def __dir__(self):
+        prefix = '%s.' % self._name
+        return [method[len(prefix):] for method in self._parent.get_available_methods()
+                if method.startswith(prefix)]
+
+class XBMCConsole(object):
+    """XBMC RPC with its namespaces as attributes.
+
+    Namespaces (capitalized attributes) are created on first access, so
+    those discovered later or unknown with a lazy schema work too. Any
+    other attribute is taken from the RPC.
+
+    """
+    def __init__(self, xbmc):
+        self._xbmc = xbmc
+
+    def __getattr__(self, attr):
+        if not attr[:1].isupper():
+            return getattr(self._xbmc, attr)
+        if not self._xbmc.is_lazy and not self._xbmc.get_available_methods(r'%s\.' % re.escape(attr)):
+            raise AttributeError("XBMC has no namespace %s" % attr)
+        namespace = Namespace(attr, self._xbmc)
+        # Cache it, __getattr__ won't be called again
+        setattr(self, attr, namespace)
+        return namespace
+
+    def __dir__(self):
+        namespaces = set(method.split('.')[0] for method in self._xbmc.get_available_methods())
+        return sorted(namespaces | set(dir(self._xbmc)))
+
+    def start(self):
+        self._xbmc.start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._xbmc.__exit__(exc_type, exc_value, traceback)
+
+    def __repr__(self):
+        return '<XBMC console for %s>' % self._xbmc.name
 
 def decorate_xbmc(xbmc):
-    class Namespace(object):
-        def __init__(self, name, parent, methods):
-            self._name = name
-            self._parent = parent
-            self.configure_methods(methods)
-
-        def configure_methods(self, method_list):
-            def wrapper(func_name):
-                from functools import wraps
-                @wraps(self._parent.execute_method)
-                def method_caller(*args, **kwargs):
-                    return self._parent.execute_method('%s.%s' % (self._name, func_name), *args, **kwargs)
-                return method_caller
-            for method in method_list:
-                setattr(self, method, wrapper(method))
-                getattr(self, method).__doc__ = self._parent._method_config['%s.%s' % (self._name, method)]['description']
-
-    methods = {}
-    for method in xbmc.get_available_methods():
-        namespace, method = method.split('.')
-        if not namespace in methods:
-            methods[namespace] = []
-        methods[namespace].append(method)
-    for namespace, method_list in methods.items():
-        setattr(xbmc, namespace, Namespace(namespace, xbmc, method_list))
-    return xbmc
+    """Wrap xbmc in an XBMCConsole.
+
+    The result is not an XBMCRPC, so isinstance checks fail and attributes
+    set on it don't reach the RPC; set them on the RPC before wrapping it.
+
+    """
+    return XBMCConsole(xbmc)
 
 def start_console(xbmc, _globals, _locals):
     """Opens interactive console with current execution state.
@@ -87,6 +156,8 @@ if __name__ == '__main__':
     parser.add_argument('--tcpport', action='store', type=int, default=9090)
     parser.add_argument('--ip', action='store', type=str, default='192.168.1.120')
     parser.add_argument('--loglevel', action='store', type=str, default='INFO')
+    parser.add_argument('--schemacache', action='store', type=str, default='~/.pythonhtpc_schema.pkl')
+    parser.add_argument('--lazy', action='store_true', default=False)
     args = parser.parse_args()
     # Start XBMC
     xbmc = decorate_xbmc(initialize_xbmc(args))
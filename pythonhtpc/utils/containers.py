@@ -7,14 +7,23 @@
 """Container objects with special properties:
   * Dictionary with case-insensitive keys (CaseInsensitiveDict).
   * Dictionary where keys have a definite timespan (TimedDict and the locking
-    TimedLockingDict) and a list
+    TimedLockingDict), and its thread-safe sharded version
+    (ShardedTimedLockingDict) and a list
   * Dictionary with a limited number of items (Limitedlist).
+  * Fixed-size buffer of timestamped samples with window statistics (RingBuffer).
 
 """
 
+import os
+import sys
+import time
+import heapq
+import bisect
+import itertools
 import collections
-from threading import Lock
+from threading import Lock, RLock, Event, Thread
 import datetime
+from array import array
 
 
 class CaseInsensitiveDict(collections.MutableMapping):
@@ -90,6 +99,55 @@ class CaseInsensitiveDict(collections.MutableMapping):
         return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
 
 
+# Seconds from an arbitrary point in the past, never going backwards. Without
+# time.monotonic (Python 2), the elapsed time of os.times is used, whose
+# resolution is a clock tick (10 ms on most systems)
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = lambda: os.times()[4]
+
+def _acquire(lock, blocking=True, timeout=None):
+    """Acquire lock, waiting at most timeout seconds if blocking."""
+    if not blocking or timeout is None:
+        return lock.acquire(blocking)
+    # Locks don't support timeouts, so poll like threading.Condition.wait does
+    endtime = _monotonic() + timeout
+    delay = 0.0005
+    while not lock.acquire(False):
+        remaining = endtime - _monotonic()
+        if remaining <= 0:
+            return False
+        delay = min(delay * 2, remaining, .05)
+        time.sleep(delay)
+    return True
+
+
+# Eviction policies
+LRU = 'lru'
+LFU = 'lfu'
+
+
+class _TimedEntry(object):
+    """Value of a TimedDict key with its expiration time in the monotonic clock."""
+    __slots__ = ('value', 'expiration', 'hits', 'size')
+
+    def __init__(self, value, expiration):
+        self.value = value
+        self.expiration = expiration
+        self.hits = 0
+        self.size = 0
+
+
+class _TimedLockingEntry(_TimedEntry):
+    """TimedLockingDict entry, with its lock."""
+    __slots__ = ('lock',)
+
+    def __init__(self, value, expiration):
+        super(_TimedLockingEntry, self).__init__(value, expiration)
+        self.lock = Lock()
+
+
 class TimedDict:
     """Dictionary-like class where keys have expiration time.
 
@@ -97,19 +155,91 @@ class TimedDict:
     they are removed from the pool. There are also functions to sistematically
     clean expired keys.
 
+    Expiration times are kept in a min-heap, so deleting the K expired keys
+    costs O(K log n). Keys refreshed by get are pushed back into the heap when
+    their old expiration time is reached. Pickles keep the original format,
+    with datetime expiration times.
+
+    The dictionary can also be bounded in number of items and/or bytes (as
+    measured by sizeof on the values). When full, expired keys are deleted
+    first and then the least recently (LRU) or least frequently (LFU) used
+    ones are evicted. The cleanup function is called for evicted keys too.
+
     """
-    def __init__(self, expiration_time, cleanup_func=None):
+    _entry_class = _TimedEntry
+
+    def __init__(self, expiration_time, cleanup_func=None, max_items=None, max_bytes=None,
+                 eviction=LRU, sizeof=sys.getsizeof):
         """Initialize internal dictionary, time limit and cleanup function.
 
         @param expiration_time: life span (in s) of the keys
         @type expiration_time: int
         @param cleanup_func: function to execute when the key is expired and removed
         @type cleanup_func: callable
+        @param max_items: maximum number of keys (None for no limit)
+        @type max_items: int
+        @param max_bytes: maximum total size of the values (None for no limit)
+        @type max_bytes: int
+        @param eviction: eviction policy, LRU or LFU
+        @type eviction: str
+        @param sizeof: function giving the size (in bytes) of a value
+        @type sizeof: callable
 
         """
-        self._dict = {}
         self._cleanup_func = cleanup_func
         self.expiration_time = expiration_time
+        self._configure(max_items, max_bytes, eviction, sizeof)
+        self._reset()
+
+    def _configure(self, max_items, max_bytes, eviction, sizeof):
+        if eviction not in (LRU, LFU):
+            raise ValueError("Unknown eviction policy %s" % eviction)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self._sizeof = sizeof
+        # Usage is only tracked if there is something to evict
+        self._bounded = max_items is not None or max_bytes is not None
+
+    def _reset(self):
+        self._dict = {}
+        # (expiration time, counter, key, entry) tuples, may contain stale entries
+        self._heap = []
+        self._counter = itertools.count()
+        # Keys from least to most recently used (LRU)
+        self._recency = collections.OrderedDict()
+        # (hits, counter, key, entry) tuples, hits may be outdated (LFU)
+        self._frequency = []
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'expirations': 0, 'evictions': 0}
+
+    def __getstate__(self):
+        """Get the state in the original format, with datetime expiration times."""
+        now, monotonic_now = datetime.datetime.now(), _monotonic()
+        entries = dict((key, {'expiration_time': now + datetime.timedelta(seconds=entry.expiration - monotonic_now),
+                              'value': entry.value})
+                       for key, entry in self._dict.items())
+        return {'_dict': entries,
+                '_cleanup_func': self._cleanup_func,
+                'expiration_time': self.expiration_time,
+                'max_items': self.max_items,
+                'max_bytes': self.max_bytes,
+                'eviction': self.eviction,
+                '_sizeof': self._sizeof}
+
+    def __setstate__(self, state):
+        """Load the state in the original format."""
+        now, monotonic_now = datetime.datetime.now(), _monotonic()
+        self._cleanup_func = state.get('_cleanup_func')
+        self.expiration_time = state['expiration_time']
+        self._configure(state.get('max_items'), state.get('max_bytes'),
+                        state.get('eviction', LRU), state.get('_sizeof', sys.getsizeof))
+        self._reset()
+        # Oldest first, to have some sensible LRU order
+        for key, entry in sorted(state['_dict'].items(), key=lambda item: item[1]['expiration_time']):
+            remaining = entry['expiration_time'] - now
+            expiration = monotonic_now + remaining.days * 86400 + remaining.seconds + remaining.microseconds / 1e6
+            self._insert(key, self._entry_class(entry['value'], expiration))
 
     def __iter__(self):
         """Return internal dictionary iterator."""
@@ -119,16 +249,100 @@ class TimedDict:
         """Return length of internal dictionary."""
         return len(self._dict)
 
+    def __contains__(self, key):
+        """Check if the key is in the internal dictionary, without checking its expiration."""
+        return key in self._dict
+
     def __repr__(self):
         """Nice representation of each key, with its expiration time and value."""
+        now, monotonic_now = datetime.datetime.now(), _monotonic()
         data = []
-        for key in self._dict:
+        for key, entry in self._dict.items():
             data.append( "%s:" % str( key ) )
-            data.append( "    Exp. time: %s" % self._dict[ key ][ 'expiration_time' ] )
-            if self._dict[ key ][ 'value' ]:
-                data.append( "    Value: %s" % self._dict[ key ][ 'value' ] )
+            data.append( "    Exp. time: %s" % (now + datetime.timedelta(seconds=entry.expiration - monotonic_now)) )
+            if entry.value:
+                data.append( "    Value: %s" % entry.value )
         return "\n".join( data )
 
+    def _insert(self, key, entry):
+        self._discard(key)
+        if self._bounded:
+            if self.max_bytes is not None:
+                entry.size = self._sizeof(entry.value)
+            self._make_room(entry.size)
+            if self.eviction == LRU:
+                self._recency[key] = None
+            else:
+                heapq.heappush(self._frequency, (entry.hits, next(self._counter), key, entry))
+        self._dict[key] = entry
+        self._bytes += entry.size
+        heapq.heappush(self._heap, (entry.expiration, next(self._counter), key, entry))
+        # Drop stale heap items if they are too many
+        if len(self._heap) > 2 * len(self._dict) + 64:
+            self._heap = [(item.expiration, next(self._counter), item_key, item)
+                          for item_key, item in self._dict.items()]
+            heapq.heapify(self._heap)
+        if len(self._frequency) > 2 * len(self._dict) + 64:
+            self._frequency = [(item.hits, next(self._counter), item_key, item)
+                               for item_key, item in self._dict.items()]
+            heapq.heapify(self._frequency)
+
+    def _discard(self, key):
+        # Remove the key without cleaning it up
+        entry = self._dict.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+            if self._bounded and self.eviction == LRU:
+                del self._recency[key]
+
+    def _is_full(self, size):
+        if self.max_items is not None and len(self._dict) >= self.max_items:
+            return True
+        return self.max_bytes is not None and self._bytes + size > self.max_bytes
+
+    def _make_room(self, size):
+        # A value larger than max_bytes is kept alone
+        if not self._is_full(size):
+            return
+        self.delete_expired()
+        while self._dict and self._is_full(size):
+            self._evict()
+
+    def _evict(self):
+        if self.eviction == LRU:
+            key = next(iter(self._recency))
+        else:
+            while True:
+                hits, _, key, entry = heapq.heappop(self._frequency)
+                if self._dict.get(key) is not entry:
+                    # Deleted or replaced
+                    continue
+                if hits == entry.hits:
+                    break
+                heapq.heappush(self._frequency, (entry.hits, next(self._counter), key, entry))
+        self._stats['evictions'] += 1
+        self.delete(key)
+
+    def _lookup(self, key, refresh):
+        # Get the valid entry of key, accounting for the hit or miss
+        entry = self._dict.get(key)
+        if entry is not None:
+            now = _monotonic()
+            if entry.expiration > now:
+                self._stats['hits'] += 1
+                if refresh:
+                    entry.expiration = now + self.expiration_time
+                if self._bounded:
+                    entry.hits += 1
+                    if self.eviction == LRU:
+                        del self._recency[key]
+                        self._recency[key] = None
+                return entry
+            self._stats['expirations'] += 1
+            self.delete(key)
+        self._stats['misses'] += 1
+        return None
+
     def has_key(self, key):
         """Check if internal dictionary has given key. If the key is expired, delete
         it and return False.
@@ -139,13 +353,7 @@ class TimedDict:
         @return: bool
 
         """
-        if key in self._dict:
-            expiration_time = self._dict[key]['expiration_time']
-            if expiration_time > datetime.datetime.now():
-                return True
-            else:
-                self.delete(key)
-        return False
+        return self._lookup(key, False) is not None
 
     def delete(self, key):
         """Delete a given key and execute the cleanup function.
@@ -160,40 +368,52 @@ class TimedDict:
         if key not in self._dict:
             return
         if self._cleanup_func:
-            self._cleanup_func(self._dict[key]['value'])
-        del(self._dict[key])
+            self._cleanup_func(self._dict[key].value)
+        self._discard(key)
 
     def delete_expired(self):
         """Delete expired keys.
 
-        Loop over all keys and check if they have expired. If that happens, cleanup
-        and delete them.
+        Pop the keys from the expiration heap until the first one that has not
+        expired. If their expiration time has been refreshed, push them back,
+        otherwise cleanup and delete them.
 
         """
-        for key in self._dict.keys():
-            expiration_time = self._dict[key]['expiration_time']
-            if expiration_time < datetime.datetime.now():
+        now = _monotonic()
+        heap = self._heap
+        while heap and heap[0][0] < now:
+            _, _, key, entry = heapq.heappop(heap)
+            if self._dict.get(key) is not entry:
+                # Deleted or replaced
+                continue
+            if entry.expiration < now:
+                self._stats['expirations'] += 1
                 self.delete(key)
+            else:
+                heapq.heappush(heap, (entry.expiration, next(self._counter), key, entry))
 
     def delete_all(self):
         """Clear the internal dictionary."""
         for key in self._dict.keys():
             self.delete(key)
+        self._heap = []
+        self._frequency = []
 
     def add(self, key, value):
         """Add a key to the internal dictionary, setting the expiration time.
 
+        If the dictionary is full, expired keys are deleted and then other keys
+        are evicted according to the eviction policy.
+
         @param key: key to add
         @type key: object
         @param value: value associated to the key
         @type value: object
 
         """
-        exp_time = datetime.datetime.now() + datetime.timedelta(seconds=self.expiration_time)
-        entry = {'expiration_time': exp_time, 'value': value}
-        self._dict[key] = entry
+        self._insert(key, self._entry_class(value, _monotonic() + self.expiration_time))
 
-    def get(self, key, default=None):
+    def get(self, key, default=None, refresh=True):
         """Get a key from the internal dictionary. If the key is expired, it is not
         returned.
 
@@ -201,18 +421,29 @@ class TimedDict:
         @type key: object
         @param default: value to return of the key is not valid
         @type default: object
+        @param refresh: restart the expiration time of the key?
+        @type refresh: bool
 
         @return: value associated to the key or default
 
         """
-        if key in self._dict:
-            expiration_time = self._dict[key]['expiration_time']
-            if expiration_time > datetime.datetime.now():
-                self._dict[key]['expiration_time'] = datetime.datetime.now() + datetime.timedelta(seconds=self.expiration_time)
-                return self._dict[key]['value']
-            else:
-                self.delete(key)
-        return default
+        entry = self._lookup(key, refresh)
+        if entry is None:
+            return default
+        return entry.value
+
+    def stats(self):
+        """Report hits, misses, expirations and evictions since creation.
+
+        Hits and misses are counted on get and has_key.
+
+        @return: dict with the counters, and the current number of items and bytes
+
+        """
+        stats = dict(self._stats)
+        stats['items'] = len(self._dict)
+        stats['bytes'] = self._bytes
+        return stats
 
 class TimedLockingDict(TimedDict):
     """TimedDict with blocking access to keys.
@@ -222,18 +453,7 @@ class TimedLockingDict(TimedDict):
     of usual get function will not consider the presence of the lock.
 
     """
-    def add(self, key, value):
-        """Add a key to the internal dictionary, setting the expiration time and the lock.
-
-        @param key: key to add
-        @type key: object
-        @param value: value associated to the key
-        @type value: object
-
-        """
-        exp_time = datetime.datetime.now() + datetime.timedelta(seconds=self.expiration_time)
-        entry = {'expiration_time': exp_time, 'value': value, 'lock': Lock()}
-        self._dict[key] = entry
+    _entry_class = _TimedLockingEntry
 
     def get_locking(self, key, default=None, blocking=True):
         """Get a key from the internal dictionary, locking it.
@@ -252,16 +472,25 @@ class TimedLockingDict(TimedDict):
         @return: value associated to the key or default
 
         """
-        if key in self._dict:
-            expiration_time = self._dict[key]['expiration_time']
-            if expiration_time > datetime.datetime.now():
-                self._dict[key]['expiration_time'] = datetime.datetime.now() + datetime.timedelta(seconds=self.expiration_time)
-                if not self._dict[key]['lock'].acquire(blocking):
-                    return default
-                return self._dict[key]['value']
-            else:
-                self.delete(key)
-        return default
+        return self.try_lock(key, None if blocking else 0, default)
+
+    def try_lock(self, key, timeout=None, default=None):
+        """Get a key from the internal dictionary, locking it within timeout.
+
+        @param key: key to return
+        @type key: object
+        @param timeout: maximum time (in s) to wait for the lock, None to wait forever
+        @type timeout: float
+        @param default: value to return of the key is not valid or still locked
+        @type default: object
+
+        @return: value associated to the key or default
+
+        """
+        entry = self._lookup(key, True)
+        if entry is None or not _acquire(entry.lock, timeout != 0, timeout or None):
+            return default
+        return entry.value
 
     def unlock(self, key):
         """Unlock the given key.
@@ -270,7 +499,346 @@ class TimedLockingDict(TimedDict):
         @type key: object
 
         """
-        if key in self._dict:
-            self._dict[key]['lock'].release()
+        entry = self._dict.get(key)
+        if entry is not None:
+            entry.lock.release()
+
+class _PendingLoad(object):
+    """Value of a key being loaded by ShardedTimedLockingDict.get_or_create."""
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class ShardedTimedLockingDict(object):
+    """Thread-safe TimedLockingDict.
+
+    Keys are spread by hash over a number of TimedLockingDict shards, each
+    protected by its own lock, so threads working on different shards don't
+    wait for each other. Waiting for the lock of a key (get_locking, try_lock)
+    is done outside of the shard lock.
+
+    The cleanup function is called with the shard locked, so it should be quick.
+    Limits (max_items, max_bytes) are split evenly among the shards.
+
+    """
+    def __init__(self, expiration_time, cleanup_func=None, shards=16, sweep_interval=None, **limits):
+        """Create the shards and start the expiry sweeper.
+
+        @param expiration_time: life span (in s) of the keys
+        @type expiration_time: int
+        @param cleanup_func: function to execute when the key is expired and removed
+        @type cleanup_func: callable
+        @param shards: number of shards
+        @type shards: int
+        @param sweep_interval: time (in s) between deletions of expired keys in
+            a background thread, None to disable it
+        @type sweep_interval: float
+        @param limits: max_items, max_bytes, eviction and sizeof, as in TimedDict
+
+        """
+        for limit in ('max_items', 'max_bytes'):
+            if limits.get(limit) is not None:
+                limits[limit] = -(-limits[limit] // shards)
+        self._shards = [TimedLockingDict(expiration_time, cleanup_func, **limits) for _ in range(shards)]
+        self.sweep_interval = sweep_interval
+        self._init_locks()
+
+    def _init_locks(self):
+        self._locks = [RLock() for _ in self._shards]
+        # Keys being loaded by get_or_create, per shard
+        self._loading = [{} for _ in self._shards]
+        self._sweeper = None
+        self._stop_sweeper = Event()
+        if self.sweep_interval:
+            self.start_sweeper(self.sweep_interval)
+
+    def __getstate__(self):
+        """Get the shards, without locks and threads."""
+        return {'_shards': self._shards, 'sweep_interval': self.sweep_interval}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_locks()
+
+    def _shard(self, key):
+        index = hash(key) % len(self._shards)
+        return self._shards[index], self._locks[index], index
+
+    def __iter__(self):
+        """Iterate over a snapshot of the keys."""
+        keys = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                keys.extend(shard)
+        return iter(keys)
+
+    def __len__(self):
+        """Return the number of keys, expired or not."""
+        return sum(len(shard) for shard in self._shards)
+
+    def __contains__(self, key):
+        """Check if the key is stored, without checking its expiration."""
+        shard, lock, _ = self._shard(key)
+        with lock:
+            return key in shard
+
+    def has_key(self, key):
+        """Check if key is stored and not expired. See TimedDict.has_key."""
+        shard, lock, _ = self._shard(key)
+        with lock:
+            return shard.has_key(key)
+
+    def add(self, key, value):
+        """Add a key, setting its expiration time. See TimedDict.add."""
+        shard, lock, _ = self._shard(key)
+        with lock:
+            shard.add(key, value)
+
+    def get(self, key, default=None, refresh=True):
+        """Get a key if it's not expired. See TimedDict.get."""
+        shard, lock, _ = self._shard(key)
+        with lock:
+            return shard.get(key, default, refresh)
+
+    def get_or_create(self, key, loader):
+        """Get a key, loading and adding it if it's missing or expired.
+
+        If several threads ask for the same missing key, only the first one runs
+        the loader and the others wait for its result. Errors raised by the loader
+        are raised in all of them, and nothing is added.
+
+        @param key: key to return
+        @type key: object
+        @param loader: function returning the value of a key, called as loader(key)
+        @type loader: callable
+
+        @return: value associated to the key
+
+        """
+        shard, lock, index = self._shard(key)
+        with lock:
+            entry = shard._lookup(key, True)
+            if entry is not None:
+                return entry.value
+            pending = self._loading[index].get(key)
+            loading = pending is None
+            if loading:
+                pending = self._loading[index][key] = _PendingLoad()
+        if not loading:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+        try:
+            pending.value = loader(key)
+        except Exception, error:
+            pending.error = error
+            raise
+        else:
+            with lock:
+                shard.add(key, pending.value)
+            return pending.value
+        finally:
+            with lock:
+                del self._loading[index][key]
+            pending.done.set()
+
+    def get_locking(self, key, default=None, blocking=True):
+        """Get a key, locking it. See TimedLockingDict.get_locking."""
+        return self.try_lock(key, None if blocking else 0, default)
+
+    def try_lock(self, key, timeout=None, default=None):
+        """Get a key, locking it within timeout. See TimedLockingDict.try_lock."""
+        shard, lock, _ = self._shard(key)
+        with lock:
+            entry = shard._lookup(key, True)
+        if entry is None or not _acquire(entry.lock, timeout != 0, timeout or None):
+            return default
+        return entry.value
+
+    def unlock(self, key):
+        """Unlock the given key."""
+        shard, lock, _ = self._shard(key)
+        with lock:
+            shard.unlock(key)
+
+    def delete(self, key):
+        """Delete a key and execute the cleanup function."""
+        shard, lock, _ = self._shard(key)
+        with lock:
+            shard.delete(key)
+
+    def delete_expired(self):
+        """Delete expired keys, one shard at a time."""
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                shard.delete_expired()
+
+    def delete_all(self):
+        """Clear all the shards."""
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                shard.delete_all()
+
+    def start_sweeper(self, interval):
+        """Delete expired keys every interval seconds in a daemon thread.
+
+        @param interval: time (in s) between sweeps
+        @type interval: float
+
+        """
+        self.stop_sweeper()
+        self.sweep_interval = interval
+        self._stop_sweeper = Event()
+        self._sweeper = Thread(target=self._sweep, args=(interval, self._stop_sweeper),
+                               name='htpc-timeddict-sweeper')
+        self._sweeper.daemon = True
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        """Stop the background deletion of expired keys."""
+        self._stop_sweeper.set()
+        self._sweeper = None
+
+    def _sweep(self, interval, stop):
+        while not stop.wait(interval):
+            self.delete_expired()
+
+    def stats(self):
+        """Report the counters of TimedDict.stats added over all shards."""
+        totals = {}
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                stats = shard.stats()
+            for counter, count in stats.items():
+                totals[counter] = totals.get(counter, 0) + count
+        totals['shards'] = len(self._shards)
+        return totals
+
+class RingBuffer(object):
+    """Fixed-size buffer of timestamped float samples.
+
+    Samples are kept in two array('d') of capacity elements, the oldest ones
+    being overwritten when it's full, so its memory use never grows.
+    Statistics are computed over the samples of the last window seconds (or
+    all of them if window is None) and are None if there are no samples.
+
+    The window is found by bisection, but each statistic copies its samples
+    and goes through all of them: min, max and mean with the builtins, which
+    still create a float object per sample, percentile sorting them and ewma
+    in a Python loop. They are meant for buffers of a few thousand samples.
+
+    """
+    def __init__(self, capacity):
+        """Allocate the buffer.
+
+        @param capacity: maximum number of samples
+        @type capacity: int
+
+        """
+        self.capacity = capacity
+        self._times = array('d', [0.0]) * capacity
+        self._values = array('d', [0.0]) * capacity
+        self._next = 0
+        self._count = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value, timestamp=None):
+        """Add a sample, overwriting the oldest one if the buffer is full.
+
+        @param value: value of the sample
+        @type value: float
+        @param timestamp: time of the sample, now if None
+        @type timestamp: float
+
+        """
+        with self._lock:
+            self._times[self._next] = time.time() if timestamp is None else timestamp
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def last(self):
+        """Get the latest sample.
+
+        @return: tuple (timestamp, value), None if empty
+
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            index = self._next - 1
+            return self._times[index], self._values[index]
+
+    def samples(self, window=None, now=None):
+        """Get the samples of the window, oldest first.
+
+        @param window: length (in s) of the window, None for all samples
+        @type window: float
+        @param now: end of the window, now if None
+        @type now: float
+
+        @return: tuple of arrays (timestamps, values)
+
+        """
+        with self._lock:
+            if self._count < self.capacity:
+                times, values = self._times[:self._count], self._values[:self._count]
+            else:
+                times = self._times[self._next:] + self._times[:self._next]
+                values = self._values[self._next:] + self._values[:self._next]
+        if window is not None:
+            start = bisect.bisect_left(times, (time.time() if now is None else now) - window)
+            times, values = times[start:], values[start:]
+        return times, values
+
+    def min(self, window=None):
+        values = self.samples(window)[1]
+        return min(values) if values else None
+
+    def max(self, window=None):
+        values = self.samples(window)[1]
+        return max(values) if values else None
+
+    def mean(self, window=None):
+        values = self.samples(window)[1]
+        return sum(values) / len(values) if values else None
+
+    def percentile(self, percent, window=None):
+        """Get a percentile of the values, interpolating linearly between samples.
+
+        @param percent: percentile to get, between 0 and 100
+        @type percent: float
+
+        """
+        values = sorted(self.samples(window)[1])
+        if not values:
+            return None
+        position = (len(values) - 1) * percent / 100.0
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    def ewma(self, alpha=0.3, window=None):
+        """Get the exponentially weighted moving average of the values.
+
+        @param alpha: weight of each new sample, between 0 and 1
+        @type alpha: float
+
+        """
+        values = self.samples(window)[1]
+        if not values:
+            return None
+        average = values[0]
+        for value in values[1:]:
+            average += alpha * (value - average)
+        return average
 
 # EOF
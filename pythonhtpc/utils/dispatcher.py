@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   dispatcher.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Bounded worker pool for delivering notifications to subscribers.
+
+Every subscription (a callback registered for a given notification) gets its
+own bounded FIFO queue, so ordering is kept per subscription and a slow or
+flooded subscriber cannot make the others wait. Subscriptions with pending
+work are scheduled on a fixed number of workers according to the priority
+lane of their notification (lower number means higher priority).
+
+Subscriptions can also coalesce bursts of notifications before they are
+queued: a Coalescer delivers only the latest value (LATEST) or the list of
+values (BATCH) received within its window.
+
+"""
+
+import re
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+
+from pythonhtpc.utils.containers import _monotonic
+
+DEFAULT_PRIORITY = 10
+
+# Subscription modes
+PASSTHROUGH = 'passthrough'
+LATEST = 'latest'
+BATCH = 'batch'
+
+
+class _Subscription(object):
+    """Pending notifications of a single callback."""
+    __slots__ = ('key', 'callback', 'priority', 'pending', 'scheduled', 'max_pending')
+
+    def __init__(self, key, callback, priority, max_pending):
+        self.key = key
+        self.callback = callback
+        self.priority = priority
+        self.pending = deque()
+        self.scheduled = False
+        self.max_pending = max_pending
+
+
+class _Timer(object):
+    """Single thread running delayed calls.
+
+    The thread stops when it's no longer the current thread of the timer, so
+    a call_later right after stop starts a new one without the old one
+    running calls too.
+
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('htpc.dispatcher')
+        self._cond = threading.Condition()
+        self._calls = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, func):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='htpc-dispatcher-timer')
+                self._thread.daemon = True
+                self._thread.start()
+            heapq.heappush(self._calls, (_monotonic() + delay, next(self._counter), func))
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._thread = None
+            self._cond.notify_all()
+
+    def _run(self):
+        me = threading.current_thread()
+        while True:
+            with self._cond:
+                while self._thread is me:
+                    if not self._calls:
+                        self._cond.wait()
+                        continue
+                    delay = self._calls[0][0] - _monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if self._thread is not me:
+                    return
+                _, _, func = heapq.heappop(self._calls)
+            try:
+                func()
+            except Exception:
+                self.logger.exception("Error in delayed call:")
+
+class Coalescer(object):
+    """Subscription that coalesces bursts of notifications.
+
+    The first notification received starts a window of the given length (in s).
+    When it's over, the callback gets either the latest value received
+    (LATEST) or the list of all of them (BATCH).
+
+    Values are processed by the sender (see HTPCObject._process_notification)
+    only when they are delivered.
+
+    """
+    def __init__(self, callback, mode, window):
+        if mode not in (LATEST, BATCH):
+            raise ValueError("Unknown subscription mode %s" % mode)
+        self.callback = callback
+        self.mode = mode
+        self.window = window
+        self.received = 0
+        self._lock = threading.Lock()
+        self._values = []
+        self._scheduled = False
+
+    def push(self, dispatcher, sender, notification, value):
+        """Add a notification to the current window."""
+        with self._lock:
+            self.received += 1
+            if self.mode == LATEST:
+                self._values = [value]
+            else:
+                self._values.append(value)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        dispatcher.call_later(self.window, lambda: self._flush(dispatcher, sender, notification))
+
+    def _flush(self, dispatcher, sender, notification):
+        with self._lock:
+            values, self._values = self._values, []
+            self._scheduled = False
+        processed = []
+        for value in values:
+            try:
+                processed.append(sender._process_notification(notification, value))
+            except Exception:
+                sender.logger.exception("Problem processing notification %s with value %s:" % (notification, value))
+        if not processed:
+            return
+        value = processed[-1] if self.mode == LATEST else processed
+        dispatcher.dispatch(sender, notification, [self.callback], value)
+
+class NotificationDispatcher(object):
+    """Deliver notifications to subscribers using a fixed pool of threads.
+
+    Lanes are (regex pattern, priority) pairs matched against the notification
+    name; the first matching one wins and unmatched notifications get
+    DEFAULT_PRIORITY. When the queue of a subscription is full, the oldest
+    pending notification is dropped (or the new one, if drop_oldest is False)
+    and accounted for in the stats.
+
+    """
+    def __init__(self, workers=2, max_pending=256, lanes=None, drop_oldest=True):
+        """Configure the pool. Workers are started lazily on first dispatch.
+
+        @param workers: number of worker threads
+        @type workers: int
+        @param max_pending: maximum number of queued notifications per subscription
+        @type max_pending: int
+        @param lanes: (pattern, priority) pairs
+        @type lanes: list
+        @param drop_oldest: drop the oldest notification on overflow?
+        @type drop_oldest: bool
+
+        """
+        self.logger = logging.getLogger('htpc.dispatcher')
+        self._num_workers = workers
+        self._max_pending = max_pending
+        self._drop_oldest = drop_oldest
+        self._lanes = []
+        self._priorities = {}
+        for pattern, priority in (lanes or []):
+            self.add_lane(pattern, priority)
+        self._cond = threading.Condition()
+        self._ready = []
+        self._counter = itertools.count()
+        # Subscriptions with pending notifications, removed once they are delivered
+        self._subscriptions = {}
+        # {notification: {'delivered': n, 'dropped': n}}
+        self._counters = {}
+        self._workers = []
+        self._running = False
+        self._timer = _Timer()
+
+    def add_lane(self, pattern, priority):
+        """Assign a priority to the notifications matching pattern.
+
+        @param pattern: regex to match notification names against
+        @type pattern: str
+        @param priority: priority of the lane (lower is more urgent)
+        @type priority: int
+
+        """
+        self._lanes.append((re.compile(pattern), priority))
+        self._priorities = {}
+
+    def get_priority(self, notification):
+        """Get the priority of the lane the notification belongs to.
+
+        @param notification: notification name
+        @type notification: str
+
+        @return: int
+
+        """
+        priority = self._priorities.get(notification)
+        if priority is None:
+            priority = DEFAULT_PRIORITY
+            for regex, lane_priority in self._lanes:
+                if regex.match(notification):
+                    priority = lane_priority
+                    break
+            self._priorities[notification] = priority
+        return priority
+
+    def start(self):
+        """Start the worker threads."""
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+            for i in range(self._num_workers):
+                worker = threading.Thread(target=self._work, name='htpc-dispatcher-%s' % i)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the workers after they finish their current callback.
+
+        Notifications still queued are discarded.
+
+        """
+        self._timer.stop()
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def call_later(self, delay, func):
+        """Call func after delay seconds in the timer thread of the dispatcher."""
+        self._timer.call_later(delay, func)
+
+    def dispatch(self, sender, notification, callbacks, value):
+        """Queue the notification for each of the callbacks.
+
+        Callbacks are later called as callback(sender, value).
+
+        @param sender: object sending the notification
+        @type sender: HTPCObject
+        @param notification: notification name
+        @type notification: str
+        @param callbacks: subscribed callbacks
+        @type callbacks: list
+        @param value: notification payload
+        @type value: object
+
+        """
+        if not self._running:
+            self.start()
+        priority = self.get_priority(notification)
+        with self._cond:
+            for callback in callbacks:
+                key = (id(sender), notification, callback)
+                subscription = self._subscriptions.get(key)
+                if subscription is None:
+                    subscription = _Subscription(key, callback, priority, self._max_pending)
+                    self._subscriptions[key] = subscription
+                # Lanes may have changed since the subscription was created
+                subscription.priority = priority
+                if len(subscription.pending) >= subscription.max_pending:
+                    self._count(notification, 'dropped')
+                    if not self._drop_oldest:
+                        continue
+                    subscription.pending.popleft()
+                subscription.pending.append((sender, value))
+                if not subscription.scheduled:
+                    subscription.scheduled = True
+                    heapq.heappush(self._ready, (subscription.priority, next(self._counter), subscription))
+                    self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                _, _, subscription = heapq.heappop(self._ready)
+                sender, value = subscription.pending.popleft()
+            try:
+                subscription.callback(sender, value)
+            except Exception:
+                self.logger.exception("Error in callback for notification %s:" % subscription.key[1])
+            with self._cond:
+                self._count(subscription.key[1], 'delivered')
+                # Only one worker handles a subscription at a time to keep ordering
+                if subscription.pending:
+                    heapq.heappush(self._ready, (subscription.priority, next(self._counter), subscription))
+                    self._cond.notify()
+                else:
+                    subscription.scheduled = False
+                    # Don't keep the callback (and the id of the sender) around
+                    if self._subscriptions.get(subscription.key) is subscription:
+                        del self._subscriptions[subscription.key]
+
+    def _count(self, notification, counter):
+        # Needs to be called with the condition acquired
+        counters = self._counters.get(notification)
+        if counters is None:
+            counters = self._counters[notification] = {'delivered': 0, 'dropped': 0}
+        counters[counter] += 1
+
+    def stats(self):
+        """Report queue depth, deliveries and drops.
+
+        @return: dict with totals and a {notification: counters} breakdown
+
+        """
+        with self._cond:
+            per_notification = {}
+            for notification, counters in self._counters.items():
+                per_notification[notification] = dict(counters, queued=0)
+            for subscription in self._subscriptions.values():
+                counters = per_notification.setdefault(subscription.key[1],
+                                                       {'queued': 0, 'delivered': 0, 'dropped': 0})
+                counters['queued'] += len(subscription.pending)
+        totals = {'queued': 0, 'delivered': 0, 'dropped': 0}
+        for counters in per_notification.values():
+            for counter, count in counters.items():
+                totals[counter] += count
+        totals['notifications'] = per_notification
+        return totals
+
+
+_default_dispatcher = None
+_default_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+    """Get the process-wide dispatcher shared by all HTPCObjects.
+
+    Player notifications get a higher priority lane than library updates.
+
+    @return: NotificationDispatcher
+
+    """
+    global _default_dispatcher
+    with _default_dispatcher_lock:
+        if _default_dispatcher is None:
+            _default_dispatcher = NotificationDispatcher(lanes=[(r'Player\.', 0),
+                                                                (r'(Video|Audio)Library\.', 20)])
+        return _default_dispatcher
+
+def set_dispatcher(dispatcher):
+    """Replace the process-wide dispatcher.
+
+    @param dispatcher: new dispatcher
+    @type dispatcher: NotificationDispatcher
+
+    """
+    global _default_dispatcher
+    with _default_dispatcher_lock:
+        _default_dispatcher = dispatcher
+
+# EOF
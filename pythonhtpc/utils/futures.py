@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   futures.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Results of requests and calls that may not have finished yet."""
+
+import time
+import threading
+
+class RPCError(Exception):
+    """Error returned by an RPC for a single request."""
+    def __init__(self, message, code=None, data=None):
+        super(RPCError, self).__init__(message)
+        self.code = code
+        self.data = data
+
+class RPCTimeoutError(RPCError):
+    """The RPC didn't answer a request on time."""
+    pass
+
+class RPCFuture(object):
+    """Result of a request that may not have been answered yet.
+
+    The future can have its own timeout, after which it fails with
+    RPCTimeoutError, and a transform function that is applied to the
+    result when it arrives (if it raises, the future fails with that error).
+
+    """
+    def __init__(self, request_id=None, timeout=None, transform=None):
+        self.request_id = request_id
+        self.deadline = None if timeout is None else time.time() + timeout
+        self._transform = transform
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        """Set the result of the future, if it's not already done.
+
+        @return: bool, whether the result was set
+
+        """
+        if self._transform:
+            try:
+                result = self._transform(result)
+            except Exception, error:
+                return self.set_exception(error)
+        return self._finish(result, None)
+
+    def set_exception(self, exception):
+        """Make the future fail, if it's not already done.
+
+        @return: bool, whether the exception was set
+
+        """
+        return self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._condition:
+            if self._done:
+                return False
+            self._result, self._exception = result, exception
+            self._done = True
+            self._condition.notifyAll()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once the future is done."""
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def expire(self, now=None):
+        """Fail the future if its deadline has passed.
+
+        @return: bool, whether the future expired
+
+        """
+        if self.deadline is None or (now or time.time()) < self.deadline:
+            return False
+        return self.set_exception(RPCTimeoutError("Request %s timed out" % self.request_id))
+
+    def wait(self, timeout=None):
+        """Wait for the future to be done, at most until its deadline.
+
+        @return: bool, whether the future is done
+
+        """
+        end = None if timeout is None else time.time() + timeout
+        if self.deadline is not None:
+            end = self.deadline if end is None else min(end, self.deadline)
+        with self._condition:
+            while not self._done:
+                if end is None:
+                    self._condition.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+        if not self._done:
+            self.expire()
+        return self._done
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise RPCTimeoutError("Request %s not done yet" % self.request_id)
+        return self._exception
+
+    def result(self, timeout=None):
+        """Get the result, raising the error of the request if it failed."""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+# EOF
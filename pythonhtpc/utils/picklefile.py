@@ -6,11 +6,16 @@ import cPickle
 def load(filename):
   if not os.path.exists(filename):
     return None
-  with open(filename) as f:
+  with open(filename, 'rb') as f:
     decoded = cPickle.load(f)
   return decoded
 
-def write(filename, obj):  
-  with open(filename, 'w') as f:
-    cPickle.dump(obj, f)
+def write(filename, obj, protocol=0):
+  # Write to a temporary file and rename it, so the file is never left half written
+  tmp_filename = '%s.tmp' % filename
+  with open(tmp_filename, 'wb') as f:
+    cPickle.dump(obj, f, protocol)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp_filename, filename)
 
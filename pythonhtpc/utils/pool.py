@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   pool.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Bounded pools of worker threads and processes.
+
+  * ThreadPool runs calls in a fixed number of threads, returning futures.
+  * ProcessPool runs calls in a fixed number of worker processes, so
+    CPU-heavy calls don't hold the GIL of the main process.
+  * KeyedLimiter bounds how many threads work on the same key (e.g., host)
+    at the same time.
+
+"""
+
+import logging
+import threading
+import itertools
+from collections import deque, OrderedDict
+
+from pythonhtpc.utils.futures import RPCFuture
+
+class ThreadPool(object):
+    """Run calls in a fixed number of daemon threads.
+
+    Threads are started on the first submit. Calls are run in order of
+    submission, and their result (or exception) is set in the RPCFuture
+    returned by submit.
+
+    """
+    def __init__(self, workers=4, name='pool'):
+        """Configure the pool.
+
+        @param workers: number of threads
+        @type workers: int
+        @param name: name of the pool, for the threads and logging
+        @type name: str
+
+        """
+        self.name = name
+        self.logger = logging.getLogger('htpc.%s' % name)
+        self._num_workers = workers
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._workers = []
+        self._running = False
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func(*args, **kwargs).
+
+        @return: RPCFuture with the result of the call
+
+        """
+        future = RPCFuture(request_id='%s:%s' % (self.name, getattr(func, '__name__', func)))
+        with self._cond:
+            if not self._running:
+                self._start()
+            self._queue.append((future, func, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def _start(self):
+        self._running = True
+        for i in range(self._num_workers):
+            worker = threading.Thread(target=self._work, name='htpc-%s-%s' % (self.name, i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _next_call(self):
+        # Wait for a call, None if the pool is shut down
+        with self._cond:
+            while self._running and not self._queue:
+                self._cond.wait()
+            if not self._running:
+                return None
+            return self._queue.popleft()
+
+    def _work(self):
+        while True:
+            call = self._next_call()
+            if call is None:
+                return
+            future, func, args, kwargs = call
+            try:
+                result = func(*args, **kwargs)
+            except Exception, error:
+                self.logger.debug("Error in call %s: %s" % (future.request_id, error))
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def pending(self):
+        """Number of calls waiting for a thread."""
+        with self._cond:
+            return len(self._queue)
+
+    def shutdown(self, wait=True):
+        """Stop the threads after their current call.
+
+        Calls not started yet fail with RuntimeError.
+
+        """
+        with self._cond:
+            self._running = False
+            queued, self._queue = self._queue, deque()
+            self._cond.notify_all()
+        for future, _, _, _ in queued:
+            future.set_exception(RuntimeError("Pool %s shut down" % self.name))
+        if wait:
+            for worker in self._workers:
+                worker.join()
+        self._workers = []
+
+class WorkerCrashedError(RuntimeError):
+    """The worker process running a call died."""
+    pass
+
+class WorkerTimeoutError(WorkerCrashedError):
+    """The worker process running a call was killed because it took too long."""
+    pass
+
+def _reinit_logging_locks():
+    # Locks held by other threads of the parent at fork time would never be
+    # released in the child, so logging would deadlock
+    logging._lock = threading.RLock()
+    for handler_ref in logging._handlerList:
+        handler = handler_ref()
+        if handler is not None:
+            handler.createLock()
+
+def _serve(conn, functions):
+    # Main loop of the worker processes
+    import signal
+    _reinit_logging_locks()
+    # Ctrl-C is handled by the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            return
+        if call is None:
+            return
+        key, args, kwargs = call
+        try:
+            reply = (True, functions[key](*args, **kwargs))
+        except Exception, error:
+            reply = (False, error)
+        try:
+            conn.send(reply)
+        except Exception, error:
+            # Result or exception can't be pickled
+            conn.send((False, RuntimeError("Cannot send back the result: %s" % error)))
+
+class _Process(object):
+    """Worker process of a ProcessPool, fed through a pipe.
+
+    The process is forked with a copy of the functions known at that time,
+    so only their keys and the arguments are sent to it.
+
+    """
+    def __init__(self, name, functions):
+        import multiprocessing
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.known = frozenset(functions)
+        self.calls = 0
+        self.process = multiprocessing.Process(target=_serve, args=(child_conn, functions), name=name)
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except IOError:
+            # Already dead
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+class ProcessPool(ThreadPool):
+    """Run calls in a fixed number of worker processes.
+
+    Each process is managed by a thread of the pool. Functions are not
+    pickled: workers are forked with a copy of the known functions, so bound
+    methods and closures work too. Functions should be registered before
+    they are first submitted, since workers that don't know a submitted
+    function have to be replaced. At most max_functions are kept, the
+    least recently submitted ones are forgotten first. Arguments, results
+    and exceptions are pickled.
+
+    Workers are recycled after max_calls calls, to release the memory they
+    may have accumulated. A worker that dies (or is killed because a call
+    took more than timeout seconds) only fails its current call with
+    WorkerCrashedError, and is replaced.
+
+    """
+    def __init__(self, workers=None, max_calls=100, timeout=None, max_functions=64, name='processes'):
+        """Configure the pool.
+
+        @param workers: number of processes, None for the number of CPUs
+        @type workers: int
+        @param max_calls: calls after which a worker is replaced
+        @type max_calls: int
+        @param timeout: maximum time (in s) of a call, None for no limit
+        @type timeout: float
+        @param max_functions: maximum number of known functions
+        @type max_functions: int
+        @param name: name of the pool, for the processes and logging
+        @type name: str
+
+        """
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        super(ProcessPool, self).__init__(workers, name)
+        self.max_calls = max_calls
+        self.timeout = timeout
+        self.max_functions = max_functions
+        # {function: key}, least recently used first, and {key: function}
+        self._keys = OrderedDict()
+        self._functions = {}
+        self._key_counter = itertools.count()
+        self._stats = {'calls': 0, 'crashes': 0, 'timeouts': 0, 'recycled': 0}
+
+    def _work(self):
+        worker = None
+        try:
+            while True:
+                call = self._next_call()
+                if call is None:
+                    return
+                future, func, args, kwargs = call
+                with self._cond:
+                    key = self._key(func)
+                    self._stats['calls'] += 1
+                if worker is not None and (worker.calls >= self.max_calls or key not in worker.known):
+                    worker.stop()
+                    worker = None
+                    self._count('recycled')
+                if worker is None:
+                    with self._cond:
+                        functions = dict(self._functions)
+                    worker = _Process('htpc-%s' % self.name, functions)
+                worker = self._call(worker, future, key, args, kwargs)
+        finally:
+            if worker is not None:
+                worker.stop()
+
+    def register(self, func):
+        """Make func known to the workers started from now on.
+
+        Workers started before are replaced when they get a call to func.
+
+        """
+        with self._cond:
+            self._key(func)
+
+    def _key(self, func):
+        # Needs to be called with the lock acquired
+        key = self._keys.pop(func, None)
+        if key is None:
+            key = next(self._key_counter)
+            self._functions[key] = func
+            if len(self._keys) >= self.max_functions:
+                _, forgotten = self._keys.popitem(last=False)
+                del self._functions[forgotten]
+        self._keys[func] = key
+        return key
+
+    def _count(self, counter):
+        with self._cond:
+            self._stats[counter] += 1
+
+    def _call(self, worker, future, key, args, kwargs):
+        # Run the call in the worker, return the worker if it can be reused
+        worker.calls += 1
+        try:
+            worker.conn.send((key, args, kwargs))
+        except IOError:
+            pass # The worker died, which is found out below
+        except Exception, error:
+            # Arguments can't be pickled, nothing was sent
+            future.set_exception(error)
+            return worker
+        if self.timeout is not None and not worker.conn.poll(self.timeout):
+            worker.kill()
+            self._count('timeouts')
+            self.logger.error("Call %s took more than %s s, killed its worker" % (future.request_id, self.timeout))
+            future.set_exception(WorkerTimeoutError("Call %s took more than %s s" % (future.request_id, self.timeout)))
+            return None
+        try:
+            success, result = worker.conn.recv()
+        except (EOFError, IOError):
+            worker.kill()
+            self._count('crashes')
+            self.logger.error("Worker died with exit code %s in call %s" % (worker.process.exitcode, future.request_id))
+            future.set_exception(WorkerCrashedError("Worker died with exit code %s in call %s"
+                                                    % (worker.process.exitcode, future.request_id)))
+            return None
+        except Exception, error:
+            # Reply can't be unpickled
+            future.set_exception(error)
+            return worker
+        if success:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+        return worker
+
+    def stats(self):
+        """Report calls, crashed and timed out workers, recycled workers and
+        the number of calls waiting for a worker.
+
+        @return: dict
+
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._queue)
+        return stats
+
+class KeyedLimiter(object):
+    """Limit the number of concurrent users of each key.
+
+    Use as a context manager through hold:
+
+        with limiter.hold(host):
+            ...
+
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self._cond = threading.Condition()
+        self._counts = {}
+
+    def acquire(self, key):
+        with self._cond:
+            while self._counts.get(key, 0) >= self.limit:
+                self._cond.wait()
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def release(self, key):
+        with self._cond:
+            self._counts[key] -= 1
+            if not self._counts[key]:
+                del self._counts[key]
+            self._cond.notify_all()
+
+    def hold(self, key):
+        return _Holding(self, key)
+
+class _Holding(object):
+    def __init__(self, limiter, key):
+        self._limiter = limiter
+        self._key = key
+
+    def __enter__(self):
+        self._limiter.acquire(self._key)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._limiter.release(self._key)
+
+_default_pools = {}
+_default_pools_lock = threading.Lock()
+
+def get_thread_pool():
+    """Get the process-wide pool of threads for offloaded callbacks.
+
+    @return: ThreadPool
+
+    """
+    with _default_pools_lock:
+        if 'thread' not in _default_pools:
+            _default_pools['thread'] = ThreadPool(name='callbacks')
+        return _default_pools['thread']
+
+# Maximum time (in s) of a call in the shared pool of processes
+CALLBACK_TIMEOUT = 300
+
+def get_process_pool():
+    """Get the process-wide pool of processes for CPU-heavy callbacks.
+
+    Calls taking more than CALLBACK_TIMEOUT seconds are killed, so a hung
+    callback doesn't hold a worker forever.
+
+    @return: ProcessPool
+
+    """
+    with _default_pools_lock:
+        if 'process' not in _default_pools:
+            _default_pools['process'] = ProcessPool(timeout=CALLBACK_TIMEOUT, name='callback-processes')
+        return _default_pools['process']
+
+def set_thread_pool(pool):
+    """Replace the process-wide pool of threads."""
+    with _default_pools_lock:
+        _default_pools['thread'] = pool
+
+def set_process_pool(pool):
+    """Replace the process-wide pool of processes."""
+    with _default_pools_lock:
+        _default_pools['process'] = pool
+
+# EOF
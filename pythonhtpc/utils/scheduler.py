@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   scheduler.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Process-wide scheduler for cron jobs.
+
+All CronJobs register with a single APScheduler instance, so there is only
+one scheduling thread, and their runs are executed by a bounded pool of
+threads. Each job can limit how many of its runs overlap (max_instances),
+whether missed runs are coalesced into one, and get a random start offset
+(jitter) so jobs scheduled for the same minute don't all fire at :00.
+
+Run durations and lateness (time between the scheduled time and the actual
+start of the run) are kept per job, see JobScheduler.stats.
+
+"""
+
+import time
+import random
+import logging
+import threading
+from datetime import datetime
+
+from apscheduler.scheduler import Scheduler
+from apscheduler.threadpool import ThreadPool
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+
+class _ScheduledCall(object):
+    """Function of a scheduled job, timing its runs."""
+    def __init__(self, name, func, local):
+        self.name = name
+        self.func = func
+        self._local = local
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.errors = 0
+        self.missed = 0
+        self.running = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_lateness = None
+        self.max_lateness = 0.0
+
+    def __call__(self):
+        # Start time is read by JobScheduler._job_event, called from this same thread
+        self._local.started = datetime.now()
+        with self._lock:
+            self.running += 1
+        start = time.time()
+        try:
+            return self.func()
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                self.running -= 1
+                self.runs += 1
+                self.last_duration = duration
+                self.max_duration = max(self.max_duration, duration)
+                self.total_duration += duration
+
+    def stats(self):
+        with self._lock:
+            return {'runs': self.runs,
+                    'errors': self.errors,
+                    'missed': self.missed,
+                    'running': self.running,
+                    'last_duration': self.last_duration,
+                    'max_duration': self.max_duration,
+                    'mean_duration': self.total_duration / self.runs if self.runs else None,
+                    'last_lateness': self.last_lateness,
+                    'max_lateness': self.max_lateness}
+
+class JobScheduler(object):
+    """APScheduler shared by several jobs, with a bounded number of threads.
+
+    The scheduler is started when the first job is added.
+
+    """
+    def __init__(self, workers=4, misfire_grace_time=300):
+        """Configure the scheduler.
+
+        @param workers: maximum number of jobs running at the same time
+        @type workers: int
+        @param misfire_grace_time: default time (in s) after the scheduled
+            time a run is still allowed to start
+        @type misfire_grace_time: int
+
+        """
+        self.logger = logging.getLogger('htpc.scheduler')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._scheduler = Scheduler(threadpool=ThreadPool(core_threads=0, max_threads=workers),
+                                    misfire_grace_time=misfire_grace_time)
+        self._scheduler.add_listener(self._job_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+        self._calls = []
+
+    def add_cron_job(self, name, func, day=None, hour=None, minute=None,
+                     max_instances=1, coalesce=True, misfire_grace_time=None, jitter=0):
+        """Schedule func().
+
+        @param name: name of the job, for logging and stats
+        @type name: str
+        @param func: function to run
+        @type func: callable
+        @param max_instances: maximum number of runs of the job at the same
+            time; runs over this limit are skipped and counted as missed
+        @type max_instances: int
+        @param coalesce: run only once when several runs were missed?
+        @type coalesce: bool
+        @param misfire_grace_time: time (in s) after the scheduled time the
+            run is still allowed to start, None for the scheduler default
+        @type misfire_grace_time: int
+        @param jitter: maximum start offset (in s, at most 59) of the runs,
+            chosen randomly once per job
+        @type jitter: int
+
+        @return: scheduled job, to be used in remove_job
+
+        """
+        call = _ScheduledCall(name, func, self._local)
+        options = {'name': name, 'max_instances': max_instances, 'coalesce': coalesce}
+        if misfire_grace_time is not None:
+            options['misfire_grace_time'] = misfire_grace_time
+        second = random.randint(0, min(int(jitter), 59)) if jitter else 0
+        with self._lock:
+            job = self._scheduler.add_cron_job(call, day=day, hour=hour, minute=minute, second=second, **options)
+            self._calls.append(call)
+            if not self._scheduler.running:
+                self.logger.debug("Starting scheduler")
+                self._scheduler.start()
+        return job
+
+    def remove_job(self, job):
+        """Unschedule a job. Runs already started are not interrupted."""
+        with self._lock:
+            self._scheduler.unschedule_job(job)
+            self._calls.remove(job.func)
+
+    def _job_event(self, event):
+        call = event.job.func
+        if event.code == EVENT_JOB_MISSED:
+            with call._lock:
+                call.missed += 1
+            return
+        started = getattr(self._local, 'started', None)
+        self._local.started = None
+        with call._lock:
+            if event.code == EVENT_JOB_ERROR:
+                call.errors += 1
+            if started is not None:
+                lateness = max(0.0, (started - event.scheduled_run_time).total_seconds())
+                call.last_lateness = lateness
+                call.max_lateness = max(call.max_lateness, lateness)
+
+    def stats(self):
+        """Report runs, errors, missed runs, durations and lateness of each job.
+
+        @return: {job name: counters} dict
+
+        """
+        with self._lock:
+            calls = list(self._calls)
+        return dict((call.name, call.stats()) for call in calls)
+
+    def shutdown(self, wait=True):
+        """Stop the scheduler, waiting for the running jobs if requested."""
+        with self._lock:
+            self._scheduler.shutdown(wait)
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """Get the process-wide scheduler shared by all CronJobs.
+
+    @return: JobScheduler
+
+    """
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = JobScheduler()
+        return _default_scheduler
+
+def set_scheduler(scheduler):
+    """Replace the process-wide scheduler.
+
+    @param scheduler: new scheduler
+    @type scheduler: JobScheduler
+
+    """
+    global _default_scheduler
+    with _default_scheduler_lock:
+        _default_scheduler = scheduler
+
+# EOF
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   sqlitedict.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Persistent dictionary with expiring keys stored in SQLite.
+
+SQLiteTimedDict has the TimedDict API, but every change is written to the
+database as it happens (in WAL mode, so a crash can't leave it half
+written), expired keys are deleted with a single indexed DELETE and opening
+it doesn't load anything into memory.
+
+Several dictionaries can share a file, each in its own table, through the
+single connection of a SQLiteStore.
+
+Caches pickled with picklefile can be converted with migrate_pickle.
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+import cPickle
+from threading import Lock
+
+from pythonhtpc.utils.containers import _monotonic
+import pythonhtpc.utils.picklefile as picklefile
+
+SQLITE_HEADER = 'SQLite format 3\x00'
+
+def is_sqlite_file(filename):
+    """Check if the file is a SQLite database.
+
+    @arg  filename: file to check
+    @type filename: str
+
+    @return: bool
+
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except IOError:
+        return False
+
+class SQLiteStore(object):
+    """SQLite database shared by several SQLiteTimedDicts, one per table.
+
+    All the tables use the same connection, so they never lock each other
+    out. Other processes using the file are waited for up to busy_timeout.
+
+    """
+    def __init__(self, filename, busy_timeout=30):
+        """Open (or create) the database.
+
+        @param filename: database file
+        @type filename: str
+        @param busy_timeout: time (in s) to wait for other connections to
+            release the database before failing
+        @type busy_timeout: float
+
+        """
+        self.filename = filename
+        self.lock = Lock()
+        # Autocommit: each statement is its own transaction
+        self.connection = sqlite3.connect(filename, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self.connection.text_factory = str
+        with self.lock:
+            self.connection.execute('PRAGMA busy_timeout=%d' % (busy_timeout * 1000))
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    def timed_dict(self, expiration_time, cleanup_func=None, table='timeddict'):
+        """Get the dictionary stored in a table of the database.
+
+        See SQLiteTimedDict for the arguments.
+
+        @return: SQLiteTimedDict
+
+        """
+        return SQLiteTimedDict(self, expiration_time, cleanup_func, table)
+
+    def close(self):
+        """Close the database, and with it all its dictionaries."""
+        with self.lock:
+            self.connection.close()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.filename)
+
+class SQLiteTimedDict(object):
+    """TimedDict stored in a SQLite table.
+
+    Keys are stored in a canonical text form, so equal keys are always found
+    ('x' and u'x', for instance). Only strings, integers, None and tuples of
+    them can be keys, and strings come back as unicode. Values are pickled.
+    Expiration times are stored as wall clock times, so they survive restarts.
+
+    The cleanup function, if given, requires loading the values of the deleted
+    keys, so deletions are not a single statement anymore.
+
+    """
+    def __init__(self, filename, expiration_time, cleanup_func=None, table='timeddict'):
+        """Open (or create) the database.
+
+        @param filename: database file, or store shared with other tables
+        @type filename: str or SQLiteStore
+        @param expiration_time: life span (in s) of the keys
+        @type expiration_time: int
+        @param cleanup_func: function to execute when the key is expired and removed
+        @type cleanup_func: callable
+        @param table: name of the table, to keep several dictionaries in one file
+        @type table: str
+
+        """
+        if isinstance(filename, SQLiteStore):
+            self._store = filename
+            self._own_store = False
+        else:
+            self._store = SQLiteStore(filename)
+            self._own_store = True
+        self.filename = self._store.filename
+        self.expiration_time = expiration_time
+        self._cleanup_func = cleanup_func
+        self._table = table
+        self._lock = self._store.lock
+        self._connection = self._store.connection
+        self._stats = {'hits': 0, 'misses': 0, 'expirations': 0}
+        columns = self._execute('PRAGMA table_info(%(table)s)')
+        if columns and columns[0][2] == 'BLOB':
+            self._convert_pickled_keys()
+        self._execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value BLOB, expiration REAL NOT NULL)' % table)
+        self._execute('CREATE INDEX IF NOT EXISTS %s_expiration ON %s (expiration)' % (table, table))
+
+    def _convert_pickled_keys(self):
+        # Tables created before keys were canonical had pickled keys
+        rows = self._execute('SELECT key, value, expiration FROM %(table)s')
+        with self._lock:
+            with self._connection:
+                self._connection.execute('BEGIN')
+                self._connection.execute('DROP TABLE %s' % self._table)
+                self._connection.execute('CREATE TABLE %s (key TEXT PRIMARY KEY, value BLOB, expiration REAL NOT NULL)' % self._table)
+                self._connection.executemany('INSERT OR REPLACE INTO %s (key, value, expiration) VALUES (?, ?, ?)' % self._table,
+                                             ((self._dump_key(self._load(key)), value, expiration)
+                                              for key, value, expiration in rows))
+
+    def _execute(self, statement, params=()):
+        with self._lock:
+            return self._connection.execute(statement % {'table': self._table}, params).fetchall()
+
+    @staticmethod
+    def _dump(obj):
+        return sqlite3.Binary(cPickle.dumps(obj, -1))
+
+    @staticmethod
+    def _load(data):
+        return cPickle.loads(str(data))
+
+    @classmethod
+    def _dump_key(cls, key):
+        return json.dumps(cls._canonical(key), separators=(',', ':'))
+
+    @classmethod
+    def _canonical(cls, key):
+        if isinstance(key, str):
+            return key.decode('utf-8')
+        if isinstance(key, (unicode, int, long)) or key is None:
+            return key
+        if isinstance(key, tuple):
+            return [cls._canonical(element) for element in key]
+        raise TypeError("Unsupported key type %s" % type(key).__name__)
+
+    @classmethod
+    def _load_key(cls, data):
+        return cls._from_canonical(json.loads(data))
+
+    @classmethod
+    def _from_canonical(cls, key):
+        if isinstance(key, list):
+            return tuple(cls._from_canonical(element) for element in key)
+        return key
+
+    def close(self):
+        """Close the database, unless it belongs to a SQLiteStore."""
+        if self._own_store:
+            self._store.close()
+
+    def __iter__(self):
+        """Iterate over a snapshot of the keys."""
+        return iter([self._load_key(key) for key, in self._execute('SELECT key FROM %(table)s')])
+
+    def __len__(self):
+        """Return the number of keys, expired or not."""
+        return self._execute('SELECT COUNT(*) FROM %(table)s')[0][0]
+
+    def __contains__(self, key):
+        """Check if the key is stored, without checking its expiration."""
+        return bool(self._execute('SELECT 1 FROM %(table)s WHERE key = ?', (self._dump_key(key),)))
+
+    def __repr__(self):
+        return '%s(%r, table=%r)' % (self.__class__.__name__, self.filename, self._table)
+
+    def has_key(self, key):
+        """Check if the database has given key. If the key is expired, delete
+        it and return False.
+
+        @param key: key to check
+        @type key: object
+
+        @return: bool
+
+        """
+        return self._lookup(key, False) is not None
+
+    def _lookup(self, key, refresh):
+        # Get the row of key if it's valid, accounting for the hit or miss
+        dumped_key = self._dump_key(key)
+        rows = self._execute('SELECT value, expiration FROM %(table)s WHERE key = ?', (dumped_key,))
+        if rows:
+            now = time.time()
+            if rows[0][1] > now:
+                self._count('hits')
+                if refresh:
+                    self._execute('UPDATE %(table)s SET expiration = ? WHERE key = ?',
+                                  (now + self.expiration_time, dumped_key))
+                return rows[0]
+            self._count('expirations')
+            self.delete(key)
+        self._count('misses')
+        return None
+
+    def _count(self, counter, increment=1):
+        with self._lock:
+            self._stats[counter] += increment
+
+    def delete(self, key):
+        """Delete a given key and execute the cleanup function.
+
+        @param key: key to delete
+        @type key: object
+
+        """
+        dumped_key = self._dump_key(key)
+        if self._cleanup_func:
+            rows = self._execute('SELECT value FROM %(table)s WHERE key = ?', (dumped_key,))
+            if not rows:
+                return
+            self._cleanup_func(self._load(rows[0][0]))
+        self._execute('DELETE FROM %(table)s WHERE key = ?', (dumped_key,))
+
+    def delete_expired(self):
+        """Delete expired keys.
+
+        @return: number of deleted keys
+
+        """
+        now = time.time()
+        if self._cleanup_func:
+            for value, in self._execute('SELECT value FROM %(table)s WHERE expiration < ?', (now,)):
+                self._cleanup_func(self._load(value))
+        with self._lock:
+            deleted = self._connection.execute('DELETE FROM %s WHERE expiration < ?' % self._table, (now,)).rowcount
+        self._count('expirations', deleted)
+        return deleted
+
+    def delete_all(self):
+        """Clear the table."""
+        if self._cleanup_func:
+            for value, in self._execute('SELECT value FROM %(table)s'):
+                self._cleanup_func(self._load(value))
+        self._execute('DELETE FROM %(table)s')
+
+    def add(self, key, value):
+        """Add a key to the database, setting the expiration time.
+
+        @param key: key to add
+        @type key: object
+        @param value: value associated to the key
+        @type value: object
+
+        """
+        self._execute('INSERT OR REPLACE INTO %(table)s (key, value, expiration) VALUES (?, ?, ?)',
+                      (self._dump_key(key), self._dump(value), time.time() + self.expiration_time))
+
+    def items_with_expiration(self):
+        """Get a snapshot of the keys, expired or not.
+
+        @return: list of tuples (key, value, expiration), with the expiration
+            as a wall clock time
+
+        """
+        return [(self._load_key(key), self._load(value), expiration)
+                for key, value, expiration in self._execute('SELECT key, value, expiration FROM %(table)s')]
+
+    def update_many(self, rows):
+        """Add or replace several keys in a single transaction.
+
+        @param rows: tuples (key, value, expiration), with the expiration as
+            a wall clock time
+        @type rows: iterable
+
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute('BEGIN')
+                self._connection.executemany('INSERT OR REPLACE INTO %s (key, value, expiration) VALUES (?, ?, ?)' % self._table,
+                                             ((self._dump_key(key), self._dump(value), expiration)
+                                              for key, value, expiration in rows))
+
+    def get(self, key, default=None, refresh=True):
+        """Get a key from the database. If the key is expired, it is not
+        returned.
+
+        @param key: key to return
+        @type key: object
+        @param default: value to return of the key is not valid
+        @type default: object
+        @param refresh: restart the expiration time of the key?
+        @type refresh: bool
+
+        @return: value associated to the key or default
+
+        """
+        row = self._lookup(key, refresh)
+        if row is None:
+            return default
+        return self._load(row[0])
+
+    def stats(self):
+        """Report hits, misses and expirations since opening, and the number of keys.
+
+        @return: dict
+
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['items'] = len(self)
+        return stats
+
+def migrate_pickle(pickle_file, db_file, expiration_time=None, table='timeddict'):
+    """Copy a TimedDict pickled with picklefile into a SQLiteTimedDict.
+
+    Keys keep their expiration times. The pickle file is then renamed with a
+    .migrated suffix, so the migration only happens once. pickle_file and
+    db_file can be the same file.
+
+    @arg  pickle_file: pickled TimedDict
+    @type pickle_file: str
+    @arg  db_file: database file
+    @type db_file: str
+    @arg  expiration_time: life span (in s) of the keys, None to keep the pickled one
+    @type expiration_time: int
+    @arg  table: table of the database
+    @type table: str
+
+    @return: SQLiteTimedDict
+
+    """
+    timed_dict = picklefile.load(pickle_file)
+    if expiration_time is None:
+        expiration_time = timed_dict.expiration_time
+    # The database is built aside and moved in place once complete, so a
+    # failure leaves the pickle where it was
+    temp_file = db_file + '.tmp'
+    os.rename(pickle_file, pickle_file + '.migrated')
+    try:
+        _remove_database(temp_file)
+        db = SQLiteTimedDict(temp_file, expiration_time, table=table)
+        offset = time.time() - _monotonic()
+        db.update_many((key, entry.value, entry.expiration + offset)
+                     for key, entry in timed_dict._dict.items())
+        db._execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        db.close()
+        os.rename(temp_file, db_file)
+    except:
+        _remove_database(temp_file)
+        if not os.path.exists(pickle_file):
+            os.rename(pickle_file + '.migrated', pickle_file)
+        raise
+    return SQLiteTimedDict(db_file, expiration_time, table=table)
+
+def _remove_database(filename):
+    # Remove a database file and its WAL files, if they exist
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+# EOF
@@ -6,23 +6,198 @@
 # =============================================================================
 """System-related utilities."""
 
-def run_command(cmd, *args):
+import os
+import re
+import time
+import asyncore
+import threading
+import collections
+
+class CommandError(Exception):
+    """A command could not be run as expected."""
+    def __init__(self, message, returncode=None):
+        super(CommandError, self).__init__(message)
+        self.returncode = returncode
+
+class CommandTimeoutError(CommandError):
+    """A command was killed because it ran for too long."""
+    pass
+
+def _as_list(args):
+    if not args:
+        return []
+    if not isinstance(args, (tuple, list)):
+        return [args]
+    return list(args)
+
+class Command(object):
+    """Command, or pipeline of commands, whose output is read as it arrives.
+
+    The processes run in their own process group, so on timeout (or when the
+    output is not needed anymore) the whole group is killed, including any
+    children they may have started.
+
+        for line in Command(['ffprobe', filename], timeout=10).lines():
+            ...
+
+    """
+    def __init__(self, *argvs, **kwargs):
+        """Configure the command.
+
+        Several argument lists are run as a pipeline, with the output of each
+        command going to the input of the next one.
+
+        @arg  argvs: command and its arguments, as a list
+        @type argvs: list
+        @kwarg timeout: maximum time (in s) the command can run, None for no limit
+        @kwarg merge_stderr: read the error output of the last command too
+            (True by default for single commands)
+
+        """
+        self.argvs = argvs
+        self.timeout = kwargs.get('timeout')
+        self.merge_stderr = kwargs.get('merge_stderr', len(argvs) == 1)
+        self.returncode = None
+        self.timed_out = False
+        self._processes = []
+        self._pgid = None
+        self._timer = None
+
+    def start(self):
+        """Start the processes."""
+        import subprocess
+        stdin = None
+        for index, argv in enumerate(self.argvs):
+            last = index == len(self.argvs) - 1
+            # The first process leads a new group, the others join it
+            pgid = self._pgid or 0
+            preexec_fn = lambda: os.setpgid(0, pgid)
+            try:
+                process = subprocess.Popen(argv, stdin=stdin, stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT if last and self.merge_stderr else None,
+                                           preexec_fn=preexec_fn, close_fds=True)
+            except OSError, error:
+                self.kill()
+                raise CommandError("Cannot run %s: %s" % (' '.join(argv), error))
+            if stdin is not None:
+                stdin.close() # Allow the previous command to receive a SIGPIPE if this one exits
+            stdin = process.stdout
+            if self._pgid is None:
+                self._pgid = process.pid
+            self._processes.append(process)
+        if self.timeout is not None:
+            self._timer = threading.Timer(self.timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    @property
+    def stdout(self):
+        return self._processes[-1].stdout
+
+    def _expire(self):
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        """Kill the process group."""
+        import signal
+        if self._pgid is None:
+            return
+        try:
+            os.killpg(self._pgid, signal.SIGKILL)
+        except OSError:
+            # Already finished
+            pass
+
+    def wait(self):
+        """Wait for the processes to finish.
+
+        @return: return code of the last command
+
+        """
+        for process in self._processes:
+            process.wait()
+        if self._timer:
+            self._timer.cancel()
+        self.returncode = self._processes[-1].returncode
+        return self.returncode
+
+    def lines(self, check=False):
+        """Run the command, yielding the lines of its output as they arrive.
+
+        Lines keep no trailing newline. If the generator is closed before the
+        end of the output, the command is killed.
+
+        Errors are only known once the output ends, so on timeout (or with
+        check, on failure) the lines read until then have already been
+        yielded when the exception is raised. Callers that act on each line
+        must be ready to undo or discard that partial output; use
+        run_command to get all the lines or only the exception.
+
+        @arg  check: raise CommandError if the command exits with an error?
+        @type check: bool
+
+        @raise CommandTimeoutError: the command didn't finish on time
+
+        """
+        if not self._processes:
+            self.start()
+        finished = False
+        try:
+            for line in iter(self.stdout.readline, ''):
+                yield line.rstrip('\n')
+            finished = True
+        finally:
+            if not finished:
+                self.kill()
+            self.stdout.close()
+            self.wait()
+        if self.timed_out:
+            raise CommandTimeoutError("%s timed out after %s s" % (self, self.timeout), self.returncode)
+        if check and self.returncode:
+            raise CommandError("%s exited with code %s" % (self, self.returncode), self.returncode)
+
+    def __str__(self):
+        return ' | '.join(' '.join(argv) for argv in self.argvs)
+
+def stream_command(cmd, *args, **kwargs):
+    """Run given command, yielding the lines of its output as they arrive.
+
+    As with Command.lines, a timeout or error is raised after the lines read
+    until then have been yielded.
+
+    @arg  cmd: command to execute
+    @type cmd: string
+    @arg  args: arguments of the command
+    @type args: list
+    @kwarg timeout: maximum time (in s) the command can run
+    @kwarg check: raise CommandError if the command exits with an error?
+
+    @return: generator of lines
+
+    """
+    return Command([cmd] + list(args), timeout=kwargs.get('timeout')).lines(kwargs.get('check', False))
+
+def run_command(cmd, *args, **kwargs):
     """Run given command with args on the command line.
 
     @arg  cmd: command to execute
     @type cmd: string
     @arg  args: arguments of the command
     @type args: list
+    @kwarg timeout: maximum time (in s) the command can run, after which
+        CommandTimeoutError is raised
+
+    The output is buffered, so on timeout the exception is raised and the
+    partial output is discarded.
 
     @return: list of lines of the output
 
     """
-    import subprocess
-    return [line for line in subprocess.Popen([cmd]+list(args),
-                                              stdout=subprocess.PIPE,
-                                              stderr=subprocess.STDOUT).communicate()[0].split('\n') if line]
+    return [line for line in stream_command(cmd, *args, **kwargs) if line]
 
-def run_command_with_pipe(cmd1, args1, cmd2, args2):
+def run_command_with_pipe(cmd1, args1, cmd2, args2, timeout=None):
     """Run given command piping its result to another one.
 
     Sequence run is equivalent to:
@@ -36,44 +211,295 @@ def run_command_with_pipe(cmd1, args1, cmd2, args2):
     @type cmd2: string
     @arg  args2: arguments of the second command
     @type args2: list
+    @arg  timeout: maximum time (in s) the commands can run, after which
+        CommandTimeoutError is raised
+    @type timeout: float
 
     @return: list of lines of the output
 
     """
-    import subprocess
-    if not args1:
-        args1 = []
-    if not args2:
-        args2 = []
-    if not isinstance(args1, (tuple, list)):
-        args1 = [args1]
-    if not isinstance(args2, (tuple, list)):
-        args2 = [args2]
-    #print "About to execute: %s | %s" %(' '.join([cmd1]+args1), ' '.join([cmd2]+args2))
-    p1 = subprocess.Popen([cmd1]+args1, stdout=subprocess.PIPE)
-    p2 = subprocess.Popen([cmd2]+args2, stdin=p1.stdout, stdout=subprocess.PIPE)
-    p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
-    # return p2.communicate()[0].split('\n')
-    return [line for line in p2.communicate()[0].split('\n') if line]
-
-def is_running(executable):
+    command = Command([cmd1] + _as_list(args1), [cmd2] + _as_list(args2), timeout=timeout)
+    return [line for line in command.lines() if line]
+
+class CommandPool(object):
+    """Run many commands at once, with a bounded number of them running.
+
+    Results are RPCFutures. With a line callback, lines are passed to it as
+    they arrive instead of being collected, and the future gets the return
+    code, so memory stays flat whatever the size of the outputs.
+
+    """
+    def __init__(self, workers=4, name='commands'):
+        from pythonhtpc.utils.pool import ThreadPool
+        self._pool = ThreadPool(workers, name=name)
+
+    def submit(self, cmd, *args, **kwargs):
+        """Run given command when a worker is free.
+
+        @kwarg timeout: maximum time (in s) the command can run
+        @kwarg check: fail if the command exits with an error?
+        @kwarg callback: function called with each line of the output
+
+        @return: RPCFuture with the list of non-empty lines, or the return
+            code if there is a callback
+
+        """
+        return self._pool.submit(self._run, Command([cmd] + list(args), timeout=kwargs.get('timeout')),
+                                 kwargs.get('check', False), kwargs.get('callback'))
+
+    @staticmethod
+    def _run(command, check, callback):
+        if callback is None:
+            return [line for line in command.lines(check) if line]
+        for line in command.lines(check):
+            callback(line)
+        return command.returncode
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait)
+
+class AsyncCommand(asyncore.file_dispatcher):
+    """Command whose output is read by the asyncore loop.
+
+    Use run_command_async to create it.
+
+    """
+    def __init__(self, command, callback=None, check=False, socket_map=None):
+        from pythonhtpc.core import RPCFuture
+        self.command = command.start()
+        self.future = RPCFuture(request_id=str(command))
+        self._callback = callback
+        self._check = check
+        self._partial = ''
+        self._lines = []
+        asyncore.file_dispatcher.__init__(self, command.stdout.fileno(), map=socket_map)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            lines = (self._partial + data).split('\n')
+            self._partial = lines.pop()
+            for line in lines:
+                self._handle_line(line)
+
+    def _handle_line(self, line):
+        if self._callback is not None:
+            try:
+                self._callback(line)
+            except Exception, error:
+                self.command.kill()
+                self.future.set_exception(error)
+        elif line:
+            self._lines.append(line)
+
+    def handle_close(self):
+        if not self.connected:
+            return
+        self.close()
+        if self._partial:
+            self._handle_line(self._partial)
+        command = self.command
+        command.stdout.close()
+        returncode = command.wait()
+        if command.timed_out:
+            self.future.set_exception(CommandTimeoutError("%s timed out after %s s" % (command, command.timeout), returncode))
+        elif self._check and returncode:
+            self.future.set_exception(CommandError("%s exited with code %s" % (command, returncode), returncode))
+        else:
+            self.future.set_result(self._lines if self._callback is None else returncode)
+
+    def handle_error(self):
+        self.command.kill()
+        self.handle_close()
+
+def run_command_async(cmd, *args, **kwargs):
+    """Run given command with its output read by the asyncore loop.
+
+    Same as CommandPool.submit, but without any thread reading the output:
+    the returned future is done once the loop (see asyncxbmcrpc.loop) has
+    read the whole output.
+
+    @kwarg timeout: maximum time (in s) the command can run
+    @kwarg check: fail if the command exits with an error?
+    @kwarg callback: function called with each line of the output
+    @kwarg socket_map: asyncore map to use
+
+    @return: RPCFuture with the list of non-empty lines, or the return code
+        if there is a callback
+
+    """
+    command = Command([cmd] + list(args), timeout=kwargs.get('timeout'))
+    return AsyncCommand(command, kwargs.get('callback'), kwargs.get('check', False), kwargs.get('socket_map')).future
+
+class ProcessInfo(collections.namedtuple('ProcessInfo', 'pid name cmdline state ppid cpu_time rss threads')):
+    """Snapshot of a process.
+
+    name is the executable name given by the kernel (truncated to 15
+    characters), cmdline is the tuple of arguments (empty for kernel threads),
+    cpu_time is the user + system time (in s) and rss the resident memory
+    (in bytes).
+
+    """
+    __slots__ = ()
+
+    @property
+    def exe(self):
+        """Base name of the executable in the command line, or name if there isn't one."""
+        return os.path.basename(self.cmdline[0]) if self.cmdline else self.name
+
+class ProcessTable(object):
+    """Table of running processes read from /proc.
+
+    Scans are cached for ttl seconds, so many queries in a short time share a
+    single scan. Processes are indexed by name, executable and command line.
+
+    """
+    def __init__(self, ttl=1.0, proc='/proc'):
+        """Configure the table.
+
+        @arg  ttl: time (in s) a scan is valid
+        @type ttl: float
+        @arg  proc: location of the proc filesystem
+        @type proc: str
+
+        """
+        self.ttl = ttl
+        self.proc = proc
+        self._lock = threading.Lock()
+        self._scan_time = None
+        self._processes = {}
+        self._by_name = {}
+        self._by_cmdline = {}
+        self._clock_ticks = os.sysconf('SC_CLK_TCK')
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def _read_process(self, pid):
+        with open(os.path.join(self.proc, pid, 'stat')) as f:
+            stat = f.read()
+        with open(os.path.join(self.proc, pid, 'cmdline')) as f:
+            cmdline = f.read().split('\0')
+        if cmdline and not cmdline[-1]:
+            cmdline.pop()
+        # The name is between parentheses, and it can contain anything
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        return ProcessInfo(pid=int(pid), name=name, cmdline=tuple(cmdline), state=fields[0], ppid=int(fields[1]),
+                           cpu_time=float(int(fields[11]) + int(fields[12])) / self._clock_ticks,
+                           rss=int(fields[21]) * self._page_size, threads=int(fields[17]))
+
+    def snapshot(self, max_age=None):
+        """Get the running processes, scanning /proc if the last scan is too old.
+
+        @arg  max_age: maximum age (in s) of the scan, ttl if None
+        @type max_age: float
+
+        @return: dict {pid: ProcessInfo}
+
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            now = time.time()
+            if self._scan_time is None or now - self._scan_time >= max_age:
+                processes = {}
+                by_name = {}
+                by_cmdline = {}
+                for pid in os.listdir(self.proc):
+                    if not pid.isdigit():
+                        continue
+                    try:
+                        process = self._read_process(pid)
+                    except (IOError, OSError, ValueError, IndexError):
+                        # Finished while reading it
+                        continue
+                    processes[process.pid] = process
+                    for name in set((process.name, process.exe)):
+                        by_name.setdefault(name, []).append(process)
+                    by_cmdline.setdefault(' '.join(process.cmdline), []).append(process)
+                self._processes, self._by_name, self._by_cmdline = processes, by_name, by_cmdline
+                self._scan_time = now
+            return self._processes
+
+    def find(self, pattern, regex=False, cmdline=False):
+        """Find processes.
+
+        Without regex, processes whose name or executable (or whole command
+        line, with arguments separated by spaces, if cmdline is True) are
+        exactly pattern are returned. With regex, the pattern is searched in
+        them instead. The current process is never returned.
+
+        @arg  pattern: name or regex to look for
+        @type pattern: str
+        @arg  regex: is pattern a regex?
+        @type regex: bool
+        @arg  cmdline: match the command line instead of the name?
+        @type cmdline: bool
+
+        @return: list of ProcessInfo, sorted by pid
+
+        """
+        self.snapshot()
+        with self._lock:
+            index = self._by_cmdline if cmdline else self._by_name
+        if not regex:
+            found = index.get(pattern, [])
+        else:
+            compiled = re.compile(pattern)
+            found = [process for key, indexed in index.items() if compiled.search(key)
+                     for process in indexed]
+        own_pid = os.getpid()
+        return sorted(dict((process.pid, process) for process in found if process.pid != own_pid).values())
+
+    def pids(self, pattern, regex=False, cmdline=False):
+        """Get the pids of the processes found with find."""
+        return [process.pid for process in self.find(pattern, regex, cmdline)]
+
+    def is_running(self, pattern, regex=False, cmdline=False):
+        """Check if any process is found with find."""
+        return bool(self.find(pattern, regex, cmdline))
+
+_process_table = ProcessTable()
+
+def get_process_table():
+    """Get the ProcessTable shared by is_running and find_processes."""
+    return _process_table
+
+def find_processes(executable, regex=False):
+    """Get the running processes of an executable.
+
+    @arg  executable: name of the executable, or regex to search in the command line
+    @type executable: str
+    @arg  regex: search executable as a regex in the command line instead of matching the name?
+    @type regex: bool
+
+    @return: list of ProcessInfo
+
+    """
+    if regex:
+        return _process_table.find(executable, regex=True, cmdline=True)
+    return _process_table.find(executable)
+
+def is_running(executable, regex=False):
     """Determine if an executable is running.
 
-    It makes use of ps axw and then regex matching. Therefore, be very careful:
-    if anything that is running matches executable, even if partially,
-    you will get a false positive.
+    The process table is read from /proc and shared for a second, so
+    checking many executables costs a single scan. By default, only processes
+    whose name or executable path is exactly executable are considered, so
+    is_running('kodi') doesn't match 'vim kodi.log'. With regex, executable is
+    searched in the command line of the processes, as with the ps axw output
+    in the past, so be careful: anything running that matches executable,
+    even partially, gives a positive.
 
-    @arg  executable: name of the executable to check
+    @arg  executable: name of the executable to check, or regex if regex is True
     @type executable: str
+    @arg  regex: search executable as a regex in the command line?
+    @type regex: bool
 
     @return: bool
 
     """
-    import re
-    regex = re.compile(executable)
-    for line in run_command('ps', 'axw'):
-        if regex.search(line):
-            return True
-    return False
+    return bool(find_processes(executable, regex))
 
 # EOF
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   validation.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""JSON schema validation compiled into closures.
+
+compile_schema turns a (draft 3) schema into a function that validates data
+with the same semantics as validictory.validate, without interpreting the
+schema dict on every call. Unlike validictory, it also follows resolved
+$ref and extends, and minimum and maximum only apply to numbers (of any
+type, validictory skips long and Decimal values but compares anything else
+against exclusive bounds). Keywords that are rarely used in the XBMC schema
+are delegated to validictory for the node they appear in.
+
+ValidatorCache compiles schemas on first use and applies a per-name policy
+(always, sampled or never), keeping counters of the validation time.
+
+resolve_references links $ref and extends to the shared type definitions
+they point to, which compile_schema then follows.
+
+"""
+
+import re
+import time
+import random
+import threading
+from decimal import Decimal
+from collections import Mapping
+
+import validictory
+from validictory import ValidationError, SchemaError
+
+ALWAYS = 'always'
+SAMPLED = 'sampled'
+NEVER = 'never'
+
+# Keywords delegated to validictory
+_FALLBACK_KEYWORDS = frozenset(['patternProperties', 'additionalItems', 'dependencies', 'format',
+                                'divisibleBy', 'disallow', 'minProperties', 'maxProperties',
+                                'uniqueItems'])
+
+_NUMBER_TYPES = (int, long, float, Decimal)
+
+_TYPE_CHECKERS = {'string': lambda value: isinstance(value, basestring),
+                  'integer': lambda value: type(value) in (int, long),
+                  'number': lambda value: type(value) in _NUMBER_TYPES,
+                  'boolean': lambda value: type(value) == bool,
+                  'object': lambda value: isinstance(value, Mapping) or (hasattr(value, 'keys') and hasattr(value, 'items')),
+                  'array': lambda value: isinstance(value, (list, tuple)),
+                  'null': lambda value: value is None,
+                  'any': lambda value: True}
+
+def resolve_references(node, types, _visited=None):
+    """Replace the type names in $ref and extends by their definitions, in place.
+
+    Every reference to a type points to the same definition object, which is
+    also resolved, so recursive types become cyclic structures. Unknown
+    names are left as they are.
+
+    @arg  node: schema to resolve
+    @type node: dict or list
+    @arg  types: {name: definition} pairs
+    @type types: dict
+
+    @return: node
+
+    """
+    if _visited is None:
+        _visited = set()
+    # Iterative walk, recursive types would be too deep otherwise
+    stack = [node]
+    while stack:
+        element = stack.pop()
+        if id(element) in _visited:
+            continue
+        _visited.add(id(element))
+        if isinstance(element, dict):
+            reference = element.get('$ref')
+            if isinstance(reference, basestring) and reference in types:
+                element['$ref'] = types[reference]
+            extends = element.get('extends')
+            if isinstance(extends, basestring) and extends in types:
+                element['extends'] = types[extends]
+            elif isinstance(extends, list):
+                element['extends'] = [types.get(base, base) if isinstance(base, basestring) else base
+                                      for base in extends]
+            stack.extend(value for value in element.values() if isinstance(value, (dict, list)))
+        elif isinstance(element, list):
+            stack.extend(value for value in element if isinstance(value, (dict, list)))
+    return node
+
+def _inherited_properties(schema, _visited=None):
+    """Get the names of the properties of schema and the types it extends."""
+    if _visited is None:
+        _visited = set()
+    if not isinstance(schema, dict) or id(schema) in _visited:
+        return set()
+    _visited.add(id(schema))
+    properties = set(schema.get('properties') or {})
+    bases = schema.get('extends') or []
+    for base in (bases if isinstance(bases, list) else [bases]):
+        properties.update(_inherited_properties(base, _visited))
+    return properties
+
+def compile_schema(schema, required_by_default=True, blank_by_default=False):
+    """Compile a schema into a validation function.
+
+    The returned function raises ValidationError if the data is not valid.
+    Recursive schemas are supported.
+
+    @arg  schema: schema to compile
+    @type schema: dict
+    @arg  required_by_default: are properties required unless specified?
+    @type required_by_default: bool
+    @arg  blank_by_default: can strings be empty unless specified?
+    @type blank_by_default: bool
+
+    @return: callable(data)
+
+    """
+    root = _SchemaCompiler(required_by_default, blank_by_default).node(schema)
+    def validate(data):
+        root(data, True, 'data')
+        return data
+    return validate
+
+class _SchemaCompiler(object):
+    def __init__(self, required_by_default, blank_by_default):
+        self.required_by_default = required_by_default
+        self.blank_by_default = blank_by_default
+        # {id(schema): check}, schemas are kept to make ids stable
+        self._nodes = {}
+        self._schemas = []
+
+    def node(self, schema):
+        """Get the check(value, present, path) function of a schema node."""
+        key = id(schema)
+        if key in self._nodes:
+            return self._nodes[key]
+        # Placeholder in case the schema is recursive
+        cell = []
+        self._nodes[key] = lambda value, present, path: cell[0](value, present, path)
+        self._schemas.append(schema)
+        check = self._build(schema)
+        cell.append(check)
+        self._nodes[key] = check
+        return check
+
+    def _build(self, schema):
+        if schema is None:
+            return lambda value, present, path: None
+        if not isinstance(schema, dict):
+            raise SchemaError("Schema must be a dict, got %s" % type(schema).__name__)
+        required = schema.get('required', self.required_by_default)
+        if _FALLBACK_KEYWORDS.intersection(schema) or isinstance(schema.get('items'), (list, tuple)):
+            checks = [self._fallback(schema)]
+        else:
+            checks = []
+            for keyword, builder in self._builders:
+                if keyword in schema:
+                    checks.append(builder(self, schema, schema[keyword]))
+            if not schema.get('blank', self.blank_by_default):
+                checks.append(_check_not_blank)
+        def check(value, present, path):
+            if not present:
+                if required:
+                    raise ValidationError("Required field '%s' is missing" % path)
+                return
+            for subcheck in checks:
+                subcheck(value, path)
+        return check
+
+    def _fallback(self, schema):
+        options = {'required_by_default': self.required_by_default,
+                   'blank_by_default': self.blank_by_default}
+        def check(value, path):
+            validictory.validate(value, schema, **options)
+        return check
+
+    def _type(self, schema, fieldtype):
+        if isinstance(fieldtype, (list, tuple)):
+            alternatives = [self._type(schema, element) for element in fieldtype]
+            def check(value, path):
+                for alternative in alternatives:
+                    try:
+                        alternative(value, path)
+                        return
+                    except ValidationError:
+                        pass
+                raise ValidationError("Value %r for field '%s' doesn't match any of the types in %s" % (value, path, fieldtype))
+            return check
+        if isinstance(fieldtype, dict):
+            subnode = self.node(fieldtype)
+            return lambda value, path: subnode(value, True, path)
+        checker = _TYPE_CHECKERS.get(fieldtype)
+        if checker is None:
+            raise SchemaError("Field type '%s' is not supported." % fieldtype)
+        def check(value, path):
+            if not checker(value):
+                raise ValidationError("Value %r for field '%s' is not of type %s" % (value, path, fieldtype))
+        return check
+
+    def _properties(self, schema, properties):
+        if not isinstance(properties, dict):
+            raise SchemaError("Properties definition is not an object")
+        subnodes = [(name, self.node(subschema)) for name, subschema in properties.items()]
+        def check(value, path):
+            if isinstance(value, dict):
+                for name, subnode in subnodes:
+                    subnode(value.get(name), name in value, path + '.' + name)
+        return check
+
+    def _items(self, schema, items):
+        subnode = self.node(items)
+        def check(value, path):
+            if isinstance(value, (list, tuple)):
+                path = path + '[]'
+                for item in value:
+                    subnode(item, True, path)
+        return check
+
+    def _reference(self, schema, reference):
+        if not isinstance(reference, dict):
+            # Unresolved
+            return lambda value, path: None
+        subnode = self.node(reference)
+        return lambda value, path: subnode(value, True, path)
+
+    def _extends(self, schema, bases):
+        subnodes = [self.node(base) for base in (bases if isinstance(bases, list) else [bases])
+                    if isinstance(base, dict)]
+        def check(value, path):
+            for subnode in subnodes:
+                subnode(value, True, path)
+        return check
+
+    def _additional_properties(self, schema, additional):
+        known = frozenset(_inherited_properties(schema))
+        if additional is True:
+            return lambda value, path: None
+        if additional is False:
+            def check(value, path):
+                if isinstance(value, dict):
+                    for name in value:
+                        if name not in known:
+                            raise ValidationError("Field '%s' contains additional property '%s'" % (path, name))
+            return check
+        if not isinstance(additional, dict):
+            raise SchemaError("additionalProperties definition is not an object")
+        subnode = self.node(additional)
+        def check(value, path):
+            if isinstance(value, dict):
+                for name in value:
+                    if name not in known:
+                        subnode(value[name], True, path + '.' + name)
+        return check
+
+    def _minimum(self, schema, minimum):
+        exclusive = schema.get('exclusiveMinimum', False)
+        def check(value, path):
+            if type(value) in _NUMBER_TYPES and (value <= minimum if exclusive else value < minimum):
+                raise ValidationError("Value %r for field '%s' is less than minimum value: %s" % (value, path, minimum))
+        return check
+
+    def _maximum(self, schema, maximum):
+        exclusive = schema.get('exclusiveMaximum', False)
+        def check(value, path):
+            if type(value) in _NUMBER_TYPES and (value >= maximum if exclusive else value > maximum):
+                raise ValidationError("Value %r for field '%s' is more than maximum value: %s" % (value, path, maximum))
+        return check
+
+    def _min_length(self, schema, length):
+        def check(value, path):
+            if isinstance(value, (basestring, list, tuple)) and len(value) < length:
+                raise ValidationError("Field '%s' must have length greater than or equal to %s" % (path, length))
+        return check
+
+    def _max_length(self, schema, length):
+        def check(value, path):
+            if isinstance(value, (basestring, list, tuple)) and len(value) > length:
+                raise ValidationError("Field '%s' must have length less than or equal to %s" % (path, length))
+        return check
+
+    def _enum(self, schema, options):
+        blank = schema.get('blank', self.blank_by_default)
+        try:
+            options_set = frozenset(options)
+        except TypeError:
+            options_set = options
+        def check(value, path):
+            if value is not None:
+                try:
+                    valid = value in options_set
+                except TypeError:
+                    valid = value in options
+                if not valid and not (value == '' and blank):
+                    raise ValidationError("Value %r for field '%s' is not in the enumeration: %r" % (value, path, options))
+        return check
+
+    def _pattern(self, schema, pattern):
+        regex = re.compile(pattern) if isinstance(pattern, basestring) else pattern
+        def check(value, path):
+            if isinstance(value, basestring) and not regex.match(value):
+                raise ValidationError("Value %r for field '%s' does not match regular expression '%s'" % (value, path, pattern))
+        return check
+
+    _builders = [('$ref', _reference),
+                 ('extends', _extends),
+                 ('type', _type),
+                 ('properties', _properties),
+                 ('items', _items),
+                 ('additionalProperties', _additional_properties),
+                 ('minimum', _minimum),
+                 ('maximum', _maximum),
+                 ('minLength', _min_length),
+                 ('maxLength', _max_length),
+                 ('minItems', _min_length),
+                 ('maxItems', _max_length),
+                 ('enum', _enum),
+                 ('pattern', _pattern)]
+
+def _check_not_blank(value, path):
+    if isinstance(value, basestring) and not value:
+        raise ValidationError("Field '%s' cannot be blank" % path)
+
+class ValidatorCache(object):
+    """Validate data against schemas compiled on first use.
+
+    Each validated schema is identified by a name (the method or notification
+    it belongs to). Policies are (regex pattern, policy, rate) tuples, the
+    first one matching the name is used: ALWAYS validates every call,
+    SAMPLED only a fraction rate of the calls, and NEVER skips validation.
+
+    """
+    def __init__(self, default_policy=ALWAYS, default_rate=1.0, required_by_default=True, blank_by_default=False):
+        self._default_policy = (default_policy, default_rate)
+        self._options = {'required_by_default': required_by_default,
+                         'blank_by_default': blank_by_default}
+        self._policies = []
+        self._policy_cache = {}
+        self._validators = {}
+        # {name: [calls, validated, failed, time]}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def set_policy(self, pattern, policy, rate=1.0):
+        """Set the validation policy for the names matching pattern.
+
+        Policies set later take precedence.
+
+        @arg  pattern: regex to match names against
+        @type pattern: str
+        @arg  policy: ALWAYS, SAMPLED or NEVER
+        @type policy: str
+        @arg  rate: fraction of validated calls for SAMPLED
+        @type rate: float
+
+        """
+        if policy not in (ALWAYS, SAMPLED, NEVER):
+            raise ValueError("Unknown validation policy %s" % policy)
+        self._policies.insert(0, (re.compile(pattern), policy, rate))
+        self._policy_cache = {}
+
+    def get_policy(self, name):
+        """Get the (policy, rate) tuple that applies to name."""
+        policy = self._policy_cache.get(name)
+        if policy is None:
+            policy = self._default_policy
+            for regex, regex_policy, rate in self._policies:
+                if regex.match(name):
+                    policy = (regex_policy, rate)
+                    break
+            self._policy_cache[name] = policy
+        return policy
+
+    def clear(self):
+        """Forget the compiled validators, e.g., because the schema changed."""
+        with self._lock:
+            self._validators = {}
+
+    def validate(self, name, schema, data):
+        """Validate data according to the policy of name.
+
+        The schema is only used the first time name is validated.
+
+        @return: data
+
+        """
+        policy, rate = self.get_policy(name)
+        with self._lock:
+            counters = self._counters.setdefault(name, [0, 0, 0, 0.0])
+            counters[0] += 1
+        if policy == NEVER or (policy == SAMPLED and random.random() >= rate):
+            return data
+        validator = self._validators.get(name)
+        start = time.time()
+        if validator is None:
+            validator = compile_schema(schema, **self._options)
+            self._validators[name] = validator
+        try:
+            validator(data)
+        except:
+            with self._lock:
+                counters[2] += 1
+            raise
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                counters[1] += 1
+                counters[3] += elapsed
+        return data
+
+    def stats(self):
+        """Report the validation counters.
+
+        @return: {name: {'calls', 'validated', 'failed', 'time'}} dict
+
+        """
+        with self._lock:
+            return dict((name, {'calls': calls, 'validated': validated, 'failed': failed, 'time': elapsed})
+                        for name, (calls, validated, failed, elapsed) in self._counters.items())
+
+# EOF
@@ -18,7 +18,6 @@ setup(
     description='Library for managing an HTPC from Python.',
     #long_description=open('README.txt').read(),
     install_requires=[
-        "pebble >= 1.0.0",
         "APScheduler >= 2.1.2",
         "symmetricjsonrpc >= 0.1.0",
         "validictory >= 0.9.3"
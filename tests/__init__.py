@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   __init__.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Tests of pythonhtpc.
+
+Run them with:
+    $ python -m unittest discover -s tests -t .
+
+"""
+
+# EOF
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   baseline.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Pickles in the format written by the original TimedDict."""
+
+import datetime
+import cPickle
+
+import pythonhtpc.utils.containers as containers
+
+class TimedDict:
+    """Original TimedDict, storing expiration datetimes."""
+    def __init__(self, expiration_time, cleanup_func=None):
+        self._dict = {}
+        self._cleanup_func = cleanup_func
+        self.expiration_time = expiration_time
+
+    def add(self, key, value, expiration_time=None):
+        if expiration_time is None:
+            expiration_time = self.expiration_time
+        exp_time = datetime.datetime.now() + datetime.timedelta(seconds=expiration_time)
+        self._dict[key] = {'expiration_time': exp_time, 'value': value}
+
+def write_pickle(filename, timed_dict):
+    """Pickle timed_dict as the original picklefile.write did.
+
+    The class is pickled under the name of the current TimedDict, like the
+    pickles in existing caches.
+
+    """
+    current = containers.TimedDict
+    TimedDict.__module__ = 'pythonhtpc.utils.containers'
+    containers.TimedDict = TimedDict
+    try:
+        with open(filename, 'w') as f:
+            cPickle.dump(timed_dict, f)
+    finally:
+        containers.TimedDict = current
+        TimedDict.__module__ = __name__
+
+# EOF
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   test_containers.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Tests of the TimedDict family of containers."""
+
+import os
+import time
+import shutil
+import threading
+import datetime
+import tempfile
+import unittest
+
+from pythonhtpc.utils import containers
+from pythonhtpc.utils import picklefile
+from pythonhtpc.utils.containers import TimedDict, ShardedTimedLockingDict, LRU, LFU
+
+from tests import baseline
+
+class FakeClock(object):
+    """Replacement of the monotonic clock of containers."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self._monotonic = containers._monotonic
+        containers._monotonic = self.clock
+
+    def tearDown(self):
+        containers._monotonic = self._monotonic
+
+class TestTimedDictExpiration(ClockTestCase):
+    def test_delete_expired(self):
+        cleaned = []
+        timed_dict = TimedDict(10, cleanup_func=cleaned.append)
+        timed_dict.add('a', 1)
+        self.clock.now += 5
+        timed_dict.add('b', 2)
+        self.clock.now += 6
+        timed_dict.delete_expired()
+        self.assertEqual(list(timed_dict), ['b'])
+        self.assertEqual(cleaned, [1])
+        self.clock.now += 5
+        timed_dict.delete_expired()
+        self.assertEqual(len(timed_dict), 0)
+        self.assertEqual(cleaned, [1, 2])
+        self.assertEqual(timed_dict.stats()['expirations'], 2)
+
+    def test_refreshed_keys_are_kept(self):
+        timed_dict = TimedDict(10)
+        timed_dict.add('a', 1)
+        timed_dict.add('b', 2)
+        self.clock.now += 8
+        self.assertEqual(timed_dict.get('a'), 1)
+        self.assertEqual(timed_dict.get('b', refresh=False), 2)
+        self.clock.now += 5
+        timed_dict.delete_expired()
+        self.assertEqual(list(timed_dict), ['a'])
+        # The refreshed key was pushed back with its new expiration time
+        self.assertEqual([item[2] for item in timed_dict._heap], ['a'])
+        self.clock.now += 6
+        self.assertEqual(timed_dict.get('a'), None)
+        self.assertEqual(len(timed_dict), 0)
+
+    def test_replaced_keys(self):
+        cleaned = []
+        timed_dict = TimedDict(10, cleanup_func=cleaned.append)
+        for value in range(1000):
+            timed_dict.add('a', value)
+        # Stale heap items are dropped once they are too many
+        self.assertTrue(len(timed_dict._heap) <= 2 * len(timed_dict) + 64)
+        self.clock.now += 11
+        timed_dict.delete_expired()
+        self.assertEqual(cleaned, [999])
+        self.assertEqual(timed_dict._heap, [])
+
+    def test_has_key(self):
+        timed_dict = TimedDict(10)
+        timed_dict.add('a', 1)
+        self.assertTrue(timed_dict.has_key('a'))
+        self.clock.now += 10
+        self.assertFalse(timed_dict.has_key('a'))
+        self.assertNotIn('a', timed_dict)
+        self.assertEqual(timed_dict.stats()['hits'], 1)
+        self.assertEqual(timed_dict.stats()['misses'], 1)
+
+class TestTimedDictEviction(ClockTestCase):
+    def test_lru(self):
+        cleaned = []
+        timed_dict = TimedDict(10, cleanup_func=cleaned.append, max_items=2, eviction=LRU)
+        timed_dict.add('a', 1)
+        timed_dict.add('b', 2)
+        timed_dict.get('a')
+        timed_dict.add('c', 3)
+        self.assertEqual(sorted(timed_dict), ['a', 'c'])
+        self.assertEqual(cleaned, [2])
+        timed_dict.add('d', 4)
+        self.assertEqual(sorted(timed_dict), ['c', 'd'])
+        self.assertEqual(timed_dict.stats()['evictions'], 2)
+
+    def test_lfu(self):
+        timed_dict = TimedDict(10, max_items=2, eviction=LFU)
+        timed_dict.add('a', 1)
+        timed_dict.add('b', 2)
+        for _ in range(3):
+            timed_dict.get('a')
+        timed_dict.get('b')
+        timed_dict.add('c', 3)
+        self.assertEqual(sorted(timed_dict), ['a', 'c'])
+        # c has no hits yet
+        timed_dict.add('d', 4)
+        self.assertEqual(sorted(timed_dict), ['a', 'd'])
+
+    def test_expired_keys_go_first(self):
+        timed_dict = TimedDict(10, max_items=2)
+        timed_dict.add('a', 1)
+        self.clock.now += 5
+        timed_dict.add('b', 2)
+        timed_dict.get('a', refresh=False)
+        self.clock.now += 6
+        timed_dict.add('c', 3)
+        self.assertEqual(sorted(timed_dict), ['b', 'c'])
+        stats = timed_dict.stats()
+        self.assertEqual((stats['expirations'], stats['evictions']), (1, 0))
+
+    def test_max_bytes(self):
+        timed_dict = TimedDict(10, max_bytes=10, sizeof=len)
+        timed_dict.add('a', 'xxxx')
+        timed_dict.add('b', 'xxxx')
+        timed_dict.add('c', 'xxxx')
+        self.assertEqual(sorted(timed_dict), ['b', 'c'])
+        self.assertEqual(timed_dict.stats()['bytes'], 8)
+        # Values larger than the limit are kept alone
+        timed_dict.add('d', 'x' * 20)
+        self.assertEqual(list(timed_dict), ['d'])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, TimedDict, 10, eviction='fifo')
+
+class TestTimedDictPickle(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'cache.pkl')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_load_baseline_pickle(self):
+        old = baseline.TimedDict(3600)
+        old.add('valid', {'link': 'a'})
+        old.add('expired', 'b', expiration_time=-10)
+        baseline.write_pickle(self.filename, old)
+        timed_dict = picklefile.load(self.filename)
+        self.assertTrue(isinstance(timed_dict, TimedDict))
+        self.assertEqual(timed_dict.expiration_time, 3600)
+        self.assertEqual(timed_dict.get('valid', refresh=False), {'link': 'a'})
+        self.assertEqual(timed_dict.get('expired'), None)
+        remaining = timed_dict._dict['valid'].expiration - containers._monotonic()
+        self.assertTrue(3590 < remaining <= 3600)
+        # Loaded keys are in the expiration heap
+        self.assertEqual([item[2] for item in timed_dict._heap if item[2] in timed_dict], ['valid'])
+
+    def test_state_has_original_format(self):
+        timed_dict = TimedDict(60)
+        timed_dict.add('a', 1)
+        state = timed_dict.__getstate__()
+        self.assertEqual(state['expiration_time'], 60)
+        self.assertEqual(state['_dict']['a']['value'], 1)
+        self.assertTrue(isinstance(state['_dict']['a']['expiration_time'], datetime.datetime))
+
+    def test_round_trip(self):
+        timed_dict = TimedDict(60, max_items=10, eviction=LFU)
+        timed_dict.add('a', 1)
+        timed_dict.add(('b', 2), [3])
+        picklefile.write(self.filename, timed_dict)
+        loaded = picklefile.load(self.filename)
+        self.assertEqual(sorted(loaded, key=str), sorted(timed_dict, key=str))
+        self.assertEqual(loaded.get(('b', 2)), [3])
+        self.assertEqual((loaded.max_items, loaded.eviction), (10, LFU))
+
+class TestShardedTimedLockingDict(unittest.TestCase):
+    def test_get_or_create_loads_once(self):
+        sharded = ShardedTimedLockingDict(60, shards=4)
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        def loader(key):
+            calls.append(key)
+            started.set()
+            release.wait(5)
+            return key * 2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(sharded.get_or_create(21, loader)))
+                   for _ in range(8)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [42] * 8)
+        self.assertEqual(sharded.get(21), 42)
+
+    def test_get_or_create_errors(self):
+        sharded = ShardedTimedLockingDict(60, shards=4)
+        def loader(key):
+            raise KeyError(key)
+        self.assertRaises(KeyError, sharded.get_or_create, 'a', loader)
+        self.assertNotIn('a', sharded)
+        # Nothing is left pending
+        self.assertEqual(sharded.get_or_create('a', lambda key: 1), 1)
+
+    def test_try_lock_timeout(self):
+        sharded = ShardedTimedLockingDict(60, shards=4)
+        sharded.add('a', 1)
+        self.assertEqual(sharded.try_lock('a', timeout=0.1), 1)
+        start = time.time()
+        self.assertEqual(sharded.try_lock('a', timeout=0.1, default='locked'), 'locked')
+        self.assertTrue(time.time() - start >= 0.08)
+        self.assertEqual(sharded.get_locking('a', 'locked', blocking=False), 'locked')
+        threading.Timer(0.1, sharded.unlock, args=('a',)).start()
+        self.assertEqual(sharded.try_lock('a', timeout=5), 1)
+        sharded.unlock('a')
+        self.assertEqual(sharded.try_lock('missing', timeout=0.1, default='none'), 'none')
+
+    def test_sweeper_stops(self):
+        cleaned = []
+        sharded = ShardedTimedLockingDict(0.05, cleanup_func=cleaned.append, shards=4, sweep_interval=0.02)
+        sweeper = sharded._sweeper
+        sharded.add('a', 1)
+        deadline = time.time() + 5
+        while not cleaned and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cleaned, [1])
+        sharded.stop_sweeper()
+        sweeper.join(1)
+        self.assertFalse(sweeper.is_alive())
+        # Expired keys stay once it's stopped
+        sharded.add('b', 2)
+        time.sleep(0.15)
+        self.assertIn('b', sharded)
+        self.assertEqual(cleaned, [1])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   test_sqlitedict.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Tests of the SQLite-backed TimedDict."""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from pythonhtpc.utils import sqlitedict
+from pythonhtpc.utils.sqlitedict import SQLiteStore, SQLiteTimedDict, migrate_pickle, is_sqlite_file
+
+from tests import baseline
+
+class SQLiteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+class TestSQLiteTimedDict(SQLiteTestCase):
+    def test_round_trip(self):
+        db = SQLiteTimedDict(self.filename, 100)
+        db.add('episode', {'date': 1})
+        db.add(('show', 1, 2), 'value')
+        self.assertEqual(db.get('episode'), {'date': 1})
+        self.assertEqual(db.get(('show', 1, 2)), 'value')
+        db.close()
+        db = SQLiteTimedDict(self.filename, 100)
+        self.assertEqual(db.get('episode'), {'date': 1})
+        self.assertEqual(sorted(db), [('show', 1, 2), 'episode'])
+
+    def test_equal_keys_are_found(self):
+        db = SQLiteTimedDict(self.filename, 100)
+        db.add('x', 1)
+        self.assertIn(u'x', db)
+        self.assertEqual(db.get(u'x'), 1)
+        # Tuples sharing objects pickle differently than equal ones that don't
+        show = 'show name'
+        db.add((show, show), 2)
+        self.assertEqual(db.get(('show name', 'show ' + 'name')), 2)
+        db.add(u'caf\xe9', 3)
+        self.assertEqual(db.get(u'caf\xe9'.encode('utf-8')), 3)
+        self.assertEqual(len(db), 3)
+
+    def test_unsupported_keys(self):
+        db = SQLiteTimedDict(self.filename, 100)
+        self.assertRaises(TypeError, db.add, 1.5, 'value')
+        self.assertRaises(TypeError, db.get, object())
+
+    def test_expiration(self):
+        cleaned = []
+        db = SQLiteTimedDict(self.filename, 0.2, cleanup_func=cleaned.append)
+        db.add('a', 1)
+        db.add('b', 2)
+        self.assertTrue(db.has_key('a'))
+        time.sleep(0.3)
+        self.assertFalse(db.has_key('a'))
+        self.assertEqual(cleaned, [1])
+        self.assertEqual(db.delete_expired(), 1)
+        self.assertEqual(sorted(cleaned), [1, 2])
+        self.assertEqual(len(db), 0)
+        stats = db.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expirations']), (1, 1, 2))
+
+    def test_refresh(self):
+        db = SQLiteTimedDict(self.filename, 0.3)
+        db.add('a', 1)
+        time.sleep(0.2)
+        self.assertEqual(db.get('a'), 1)
+        time.sleep(0.2)
+        self.assertEqual(db.get('a', refresh=False), 1)
+        time.sleep(0.2)
+        self.assertEqual(db.get('a'), None)
+
+class TestSQLiteStore(SQLiteTestCase):
+    def test_tables_share_connection(self):
+        store = SQLiteStore(self.filename)
+        cache = store.timed_dict(100)
+        episodes = store.timed_dict(100, table='episodes')
+        cache.add('Show.S01E01', 'date')
+        episodes.add(('show', 1, 1), 'Show.S01E01')
+        self.assertEqual(list(cache), ['Show.S01E01'])
+        self.assertEqual(list(episodes), [('show', 1, 1)])
+        # Closing a table doesn't close the store
+        cache.close()
+        self.assertEqual(episodes.get(('show', 1, 1)), 'Show.S01E01')
+        store.close()
+
+    def test_update_many(self):
+        store = SQLiteStore(self.filename)
+        cache = store.timed_dict(100)
+        cache.add('a', 1)
+        cache.add(('b', 2), 2)
+        copy = store.timed_dict(100, table='copy')
+        copy.update_many(cache.items_with_expiration())
+        self.assertEqual(sorted(copy.items_with_expiration()), sorted(cache.items_with_expiration()))
+        copy.update_many([('a', 3, time.time() - 1)])
+        self.assertEqual(copy.get('a'), None)
+
+class TestMigration(SQLiteTestCase):
+    def write_pickle(self):
+        timed_dict = baseline.TimedDict(3600)
+        timed_dict.add('Show.S01E01', 'date 1')
+        timed_dict.add('Show.S01E02', 'date 2')
+        timed_dict.add('Old.S01E01', 'date 3', expiration_time=-10)
+        baseline.write_pickle(self.filename, timed_dict)
+
+    def test_migrate_baseline_pickle(self):
+        self.write_pickle()
+        db = migrate_pickle(self.filename, self.filename)
+        self.assertTrue(is_sqlite_file(self.filename))
+        self.assertTrue(os.path.exists(self.filename + '.migrated'))
+        self.assertEqual(db.expiration_time, 3600)
+        self.assertEqual(db.get('Show.S01E01'), 'date 1')
+        self.assertEqual(db.get('Show.S01E02'), 'date 2')
+        # Expiration times are kept
+        self.assertIn('Old.S01E01', db)
+        self.assertFalse(db.has_key('Old.S01E01'))
+
+    def test_rollback_on_failure(self):
+        self.write_pickle()
+        with open(self.filename) as f:
+            pickled = f.read()
+        original = SQLiteTimedDict.update_many
+        def fail(db, rows):
+            original(db, list(rows)[:1])
+            raise KeyboardInterrupt()
+        SQLiteTimedDict.update_many = fail
+        try:
+            self.assertRaises(KeyboardInterrupt, migrate_pickle, self.filename, self.filename)
+        finally:
+            SQLiteTimedDict.update_many = original
+        # The pickle is back in place and nothing else is left
+        self.assertEqual(os.listdir(self.folder), ['cache'])
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), pickled)
+        db = migrate_pickle(self.filename, self.filename)
+        self.assertEqual(len(db), 3)
+
+    def test_convert_pickled_keys(self):
+        # Databases written when keys were pickled
+        import sqlite3
+        connection = sqlite3.connect(self.filename)
+        connection.execute('CREATE TABLE timeddict (key BLOB PRIMARY KEY, value BLOB, expiration REAL NOT NULL)')
+        connection.execute('INSERT INTO timeddict VALUES (?, ?, ?)',
+                           (SQLiteTimedDict._dump(('show', 1)), SQLiteTimedDict._dump('value'), time.time() + 100))
+        connection.commit()
+        connection.close()
+        db = SQLiteTimedDict(self.filename, 100)
+        self.assertEqual(db.get(('show', 1)), 'value')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   test_validation.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Tests of the compiled schema validators."""
+
+import copy
+import unittest
+from decimal import Decimal
+
+import validictory
+
+from pythonhtpc.utils.validation import compile_schema, resolve_references, ValidationError, SchemaError
+
+# Excerpt of the types of the XBMC (JSON-RPC v6) schema
+XBMC_TYPES = {
+    'Global.Time': {'type': 'object',
+                    'properties': {'hours': {'type': 'integer', 'required': True, 'minimum': 0, 'maximum': 23},
+                                   'minutes': {'type': 'integer', 'required': True, 'minimum': 0, 'maximum': 59},
+                                   'seconds': {'type': 'integer', 'required': True, 'minimum': 0, 'maximum': 59},
+                                   'milliseconds': {'type': 'integer', 'required': True, 'minimum': 0, 'maximum': 999}},
+                    'additionalProperties': False},
+    'Global.String.NotEmpty': {'type': 'string', 'minLength': 1, 'default': ''},
+    'Optional.Boolean': {'type': ['null', 'boolean'], 'default': None},
+    'Player.Id': {'type': 'integer', 'minimum': 0, 'maximum': 2, 'default': -1},
+    'Player.Position.Percentage': {'type': 'number', 'minimum': 0.0, 'maximum': 100.0},
+    'Player.Speed': {'type': 'integer', 'enum': [-32, -16, -8, -4, -2, -1, 0, 1, 2, 4, 8, 16, 32]},
+    'List.Limits': {'type': 'object',
+                    'properties': {'start': {'type': 'integer', 'minimum': 0, 'default': 0},
+                                   'end': {'type': 'integer', 'minimum': -1, 'default': -1}},
+                    'additionalProperties': False},
+    'List.LimitsReturned': {'type': 'object',
+                            'properties': {'start': {'type': 'integer', 'minimum': 0, 'default': 0},
+                                           'end': {'type': 'integer', 'minimum': 0, 'default': 0},
+                                           'total': {'type': 'integer', 'minimum': 0, 'required': True}}},
+    'List.Sort': {'type': 'object',
+                  'properties': {'method': {'type': 'string', 'default': 'none',
+                                            'enum': ['none', 'label', 'date', 'title', 'year', 'rating']},
+                                 'order': {'type': 'string', 'default': 'ascending', 'enum': ['ascending', 'descending']},
+                                 'ignorearticle': {'type': 'boolean', 'default': False}}},
+    'Media.Artwork': {'type': 'object',
+                      'properties': {'thumb': {'$ref': 'Global.String.NotEmpty'},
+                                     'poster': {'$ref': 'Global.String.NotEmpty'},
+                                     'fanart': {'$ref': 'Global.String.NotEmpty'}},
+                      'additionalProperties': {'$ref': 'Global.String.NotEmpty'}},
+    'Video.Cast': {'type': 'array',
+                   'items': {'type': 'object',
+                             'properties': {'name': {'type': 'string', 'required': True},
+                                            'role': {'type': 'string', 'required': True},
+                                            'thumbnail': {'type': 'string'}},
+                             'additionalProperties': False}},
+    'Video.Details.Movie': {'type': 'object',
+                            'properties': {'label': {'type': 'string', 'required': True},
+                                           'movieid': {'type': 'integer', 'required': True},
+                                           'title': {'type': 'string'},
+                                           'year': {'type': 'integer'},
+                                           'rating': {'type': 'number'},
+                                           'art': {'$ref': 'Media.Artwork'},
+                                           'cast': {'$ref': 'Video.Cast'},
+                                           'genre': {'type': 'array', 'items': {'type': 'string'}}}},
+    'Application.Property.Value': {'type': 'object',
+                                   'properties': {'volume': {'type': 'integer', 'minimum': 0, 'maximum': 100},
+                                                  'muted': {'type': 'boolean'},
+                                                  'name': {'$ref': 'Global.String.NotEmpty'},
+                                                  'version': {'type': 'object',
+                                                              'properties': {'major': {'type': 'integer', 'minimum': 0, 'required': True},
+                                                                             'minor': {'type': 'integer', 'minimum': 0, 'required': True},
+                                                                             'tag': {'type': 'string', 'required': True,
+                                                                                     'enum': ['prealpha', 'alpha', 'beta', 'releasecandidate', 'stable']}}}}},
+}
+
+# (type, [data]) pairs
+XBMC_DATA = [
+    ('Global.Time', [{'hours': 1, 'minutes': 2, 'seconds': 3, 'milliseconds': 4},
+                     {'hours': 24, 'minutes': 2, 'seconds': 3, 'milliseconds': 4},
+                     {'hours': 1, 'minutes': 2, 'seconds': 3},
+                     {'hours': 1, 'minutes': 2, 'seconds': 3, 'milliseconds': 4, 'extra': 1},
+                     {'hours': '1', 'minutes': 2, 'seconds': 3, 'milliseconds': 4},
+                     {'hours': 1.5, 'minutes': 2, 'seconds': 3, 'milliseconds': 4},
+                     [], None]),
+    ('Global.String.NotEmpty', ['name', '', u'nom', 1, None]),
+    ('Optional.Boolean', [None, True, False, 0, 'true']),
+    ('Player.Id', [0, 2, 3, -1, True, 1.0, '1']),
+    ('Player.Position.Percentage', [0, 50.5, 100, 100.5, -0.1, '50']),
+    ('Player.Speed', [1, 32, 3, 0, '1']),
+    ('List.Limits', [{}, {'start': 0, 'end': 10}, {'start': -1}, {'end': -1}, {'end': -2}, {'limit': 1}]),
+    ('List.LimitsReturned', [{'start': 0, 'end': 5, 'total': 5}, {'start': 0, 'end': 5}, {'total': -1}]),
+    ('List.Sort', [{}, {'method': 'label', 'order': 'descending'}, {'method': 'size'},
+                   {'order': ''}, {'ignorearticle': 'yes'}]),
+    ('Media.Artwork', [{}, {'thumb': 'image://x'}, {'thumb': ''}, {'banner': 'image://y'}, {'banner': ''},
+                       {'banner': 1}]),
+    ('Video.Cast', [[], [{'name': 'A', 'role': 'B'}], [{'name': 'A'}], [{'name': 'A', 'role': 'B', 'order': 1}],
+                    [{'name': 'A', 'role': 1}], {}]),
+    ('Video.Details.Movie', [{'label': 'M', 'movieid': 1},
+                             {'label': 'M', 'movieid': 1, 'year': 2014, 'rating': 7.5,
+                              'art': {'poster': 'image://p'}, 'cast': [{'name': 'A', 'role': 'B'}],
+                              'genre': ['Drama']},
+                             {'label': 'M'},
+                             {'label': 'M', 'movieid': '1'},
+                             {'label': 'M', 'movieid': 1, 'art': {'poster': ''}},
+                             {'label': 'M', 'movieid': 1, 'cast': [{'name': 'A'}]},
+                             {'label': 'M', 'movieid': 1, 'genre': [1]}]),
+    ('Application.Property.Value', [{}, {'volume': 50, 'muted': False},
+                                    {'volume': 101}, {'volume': -1},
+                                    {'name': 'XBMC', 'version': {'major': 13, 'minor': 0, 'tag': 'stable'}},
+                                    {'version': {'major': 13, 'minor': 0, 'tag': 'final'}},
+                                    {'version': {'major': 13, 'tag': 'stable'}},
+                                    {'name': ''}]),
+]
+
+# (schema, [data]) pairs of edge cases
+EDGE_CASES = [
+    ({'type': 'string'}, ['', 'x', u'x', 1, None]),
+    ({'type': 'string', 'blank': False}, ['', 'x']),
+    ({'type': 'string', 'blank': True}, ['', 'x']),
+    ({'type': 'integer'}, [1, 1.0, True, None, '1']),
+    ({'type': 'number'}, [1, 1.5, True, None, '1']),
+    ({'type': 'boolean'}, [True, 0, None]),
+    ({'type': 'null'}, [None, 0, '']),
+    ({'type': 'any'}, [None, 0, '', {}]),
+    ({'type': ['string', 'integer']}, ['x', 1, 1.5, None]),
+    ({'type': [{'type': 'string', 'minLength': 2}, 'integer']}, ['xy', 'x', 1]),
+    ({'type': 'array', 'items': {'type': 'integer'}, 'minItems': 1, 'maxItems': 2}, [[], [1], [1, 2, 3], [1, 'x'], (1,)]),
+    ({'type': 'array', 'items': [{'type': 'integer'}, {'type': 'string'}]}, [[1, 'x'], ['x', 1], [1]]),
+    ({'type': 'object', 'properties': {'a': {'type': 'integer'}}}, [{}, {'a': 1}, {'a': None}, {'a': 'x'}]),
+    ({'type': 'object', 'properties': {'a': {'type': 'integer', 'required': True}}}, [{}, {'a': 1}, {'a': None}]),
+    ({'type': 'object', 'properties': {'a': {'type': 'integer', 'required': False}}}, [{}, {'a': 1}]),
+    ({'type': 'object', 'properties': {'a': {'type': ['integer', 'null']}}}, [{'a': None}, {}]),
+    ({'type': 'object', 'properties': {'a': {}}, 'additionalProperties': False}, [{'a': 1}, {'b': 1}]),
+    ({'type': 'object', 'additionalProperties': {'type': 'integer'}}, [{'a': 1}, {'a': 'x'}]),
+    ({'type': 'object', 'patternProperties': {'^x': {'type': 'integer'}}}, [{'x1': 1}, {'x1': 'a'}, {'y': 'a'}]),
+    ({'type': 'string', 'minLength': 2, 'maxLength': 3}, ['x', 'xy', 'xyzw']),
+    ({'type': 'string', 'pattern': '^[a-z]+$'}, ['abc', 'ab1', '']),
+    ({'type': 'string', 'enum': ['a', 'b']}, ['a', 'c', '']),
+    ({'type': 'string', 'enum': ['a', 'b'], 'blank': True}, ['a', 'c', '']),
+    ({'enum': [[1], {'a': 1}]}, [[1], {'a': 1}, [2]]),
+    ({'type': 'integer', 'minimum': 1, 'maximum': 3}, [0, 1, 3, 4, None]),
+    ({'type': 'number', 'minimum': 1, 'exclusiveMinimum': True}, [1, 1.5, 0.5]),
+    ({'type': 'number', 'maximum': 3, 'exclusiveMaximum': True}, [3, 2.5, 3.5]),
+    ({'type': 'integer', 'divisibleBy': 2}, [2, 3]),
+    ({'type': 'string', 'format': 'date'}, ['2014-03-01', 'March']),
+    ({'type': 'object', 'dependencies': {'a': 'b'}}, [{'a': 1, 'b': 2}, {'a': 1}]),
+    ({'disallow': 'string'}, [1, 'x']),
+]
+
+def _inline(node, types, _depth=0):
+    """Copy of a schema with $ref and extends replaced by the types, for validictory."""
+    if isinstance(node, list):
+        return [_inline(element, types, _depth) for element in node]
+    if not isinstance(node, dict):
+        return node
+    node = dict((key, _inline(value, types, _depth)) for key, value in node.items())
+    reference = node.pop('$ref', None)
+    if reference is not None:
+        inlined = _inline(copy.deepcopy(types[reference]), types, _depth + 1)
+        inlined.update(node)
+        node = inlined
+    return node
+
+class ValidationTestCase(unittest.TestCase):
+    def assertSameResult(self, schema, validictory_schema, data, **options):
+        try:
+            validictory.validate(data, validictory_schema, **options)
+            expected = True
+        except ValidationError:
+            expected = False
+        try:
+            compile_schema(schema, **options)(data)
+            valid = True
+        except ValidationError:
+            valid = False
+        self.assertEqual(valid, expected, "%r is %s by validictory but %s by compile_schema, with %s (options %s)"
+                         % (data, 'accepted' if expected else 'rejected',
+                            'accepted' if valid else 'rejected', schema, options))
+        return valid
+
+class TestCompileSchema(ValidationTestCase):
+    options = [{},
+               {'required_by_default': False, 'blank_by_default': True}]
+
+    def test_xbmc_schema(self):
+        types = copy.deepcopy(XBMC_TYPES)
+        resolve_references(types, types)
+        for options in self.options:
+            for name, values in XBMC_DATA:
+                for data in values:
+                    self.assertSameResult(types[name], _inline(XBMC_TYPES[name], XBMC_TYPES), data, **options)
+
+    def test_edge_cases(self):
+        for options in self.options:
+            for schema, values in EDGE_CASES:
+                for data in values:
+                    self.assertSameResult(schema, schema, data, **options)
+
+    def test_recursive_schema(self):
+        types = {'Tree': {'type': 'object',
+                          'properties': {'name': {'type': 'string', 'required': True},
+                                         'children': {'type': 'array', 'items': {'$ref': 'Tree'}}}}}
+        resolve_references(types, types)
+        validate = compile_schema(types['Tree'])
+        validate({'name': 'a', 'children': [{'name': 'b', 'children': [{'name': 'c', 'children': []}]}]})
+        self.assertRaises(ValidationError, validate, {'name': 'a', 'children': [{'children': []}]})
+
+    def test_extends(self):
+        types = {'Item.Details.Base': {'type': 'object', 'properties': {'label': {'type': 'string', 'required': True}}},
+                 'Media.Details.Base': {'extends': 'Item.Details.Base',
+                                        'properties': {'fanart': {'type': 'string'}},
+                                        'additionalProperties': False}}
+        resolve_references(types, types)
+        validate = compile_schema(types['Media.Details.Base'], required_by_default=False)
+        validate({'label': 'x', 'fanart': 'y'})
+        self.assertRaises(ValidationError, validate, {'fanart': 'y'})
+        self.assertRaises(ValidationError, validate, {'label': 'x', 'other': 1})
+
+    def test_numeric_bounds(self):
+        # Differences with validictory: all numeric types are compared...
+        validate = compile_schema({'type': 'number', 'minimum': 0, 'maximum': 10})
+        self.assertRaises(ValidationError, validate, 11L)
+        self.assertRaises(ValidationError, validate, Decimal('-0.5'))
+        validate(Decimal('5'))
+        # ...but only them, also for exclusive bounds
+        validate = compile_schema({'minimum': 0, 'exclusiveMinimum': True})
+        self.assertRaises(ValidationError, validate, 0)
+        validate({})
+        validate(True)
+
+    def test_bad_schema(self):
+        self.assertRaises(SchemaError, compile_schema, {'type': 'unknown'})
+        self.assertRaises(SchemaError, compile_schema, {'properties': []})
+
+class TestXBMCOptions(ValidationTestCase):
+    """XBMCRPC validates with required_by_default=False and blank_by_default=True.
+
+    XBMC writes its schema with the draft 3 defaults, where properties are
+    optional unless marked as required. The validictory defaults, used
+    before, reject most of its answers once $ref are followed.
+
+    """
+    baseline = {'required_by_default': True, 'blank_by_default': False}
+    xbmc = {'required_by_default': False, 'blank_by_default': True}
+
+    # (type, data) pairs rejected with the baseline options, accepted now
+    accepted = [('Video.Details.Movie', {'label': 'M', 'movieid': 1}),
+                ('List.Sort', {}),
+                ('List.Limits', {'start': 0}),
+                ('Application.Property.Value', {'volume': 50}),
+                ('Video.Cast', [{'name': 'A', 'role': ''}]),
+                # Empty strings are also accepted where enums apply
+                ('List.Sort', {'order': ''})]
+    # (type, data) pairs rejected with both
+    rejected = [('Video.Details.Movie', {'label': 'M'}),
+                ('Global.Time', {'hours': 1, 'minutes': 2, 'seconds': 3}),
+                ('Global.String.NotEmpty', ''),
+                ('Media.Artwork', {'poster': ''}),
+                ('List.Sort', {'order': 'up'}),
+                ('Player.Id', 3)]
+
+    def setUp(self):
+        self.types = copy.deepcopy(XBMC_TYPES)
+        resolve_references(self.types, self.types)
+
+    def check(self, name, data, options):
+        return self.assertSameResult(self.types[name], _inline(XBMC_TYPES[name], XBMC_TYPES), data, **options)
+
+    def test_accepted(self):
+        for name, data in self.accepted:
+            self.assertFalse(self.check(name, data, self.baseline), "%s %r" % (name, data))
+            self.assertTrue(self.check(name, data, self.xbmc), "%s %r" % (name, data))
+
+    def test_rejected(self):
+        for name, data in self.rejected:
+            self.assertFalse(self.check(name, data, self.baseline), "%s %r" % (name, data))
+            self.assertFalse(self.check(name, data, self.xbmc), "%s %r" % (name, data))
+
+    def test_xbmcrpc_options(self):
+        from pythonhtpc.rpcs.xbmcrpc import XBMCRPC
+        rpc = XBMCRPC('xbmc', 'localhost', discover=False)
+        self.assertEqual(rpc.validators._options, self.xbmc)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF